@@ -0,0 +1,267 @@
+"""Inline abuse checks on registrations and referrals.
+
+Each registration is checked before its rewards are credited:
+
+- duplicate_wallet: another account already registered this wallet. A
+  bloom filter over every registered wallet answers "never seen" from
+  memory; only its hits (real duplicates plus ABUSE_BLOOM_ERROR of the rest)
+  are confirmed with one indexed query.
+- referrer_wallet: the new user registered their referrer's wallet.
+- referral_velocity: the referrer has had more than ABUSE_REFERRAL_LIMIT
+  referrals in the last ABUSE_REFERRAL_WINDOW seconds.
+
+A flagged registration reward or referral reward is written to held_credits
+instead of the balance. Review them with python abuse.py list, then
+python abuse.py release|reject <hold_id>..."""
+import hashlib
+import logging
+import math
+import sys
+import threading
+import time
+
+import config
+from metrics import register_stats
+from database import (
+    get_db_connection, get_user, update_user_wallet, registration_credits, credit_batcher, hold_credit, wallet_in_use,
+    count_referrals_since, get_held_credits, release_held_credit, reject_held_credit,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """Set membership with no false negatives and about `error` false
+    positives once `capacity` items are in. Not thread-safe."""
+
+    def __init__(self, capacity, error):
+        self.size = max(8, int(-capacity * math.log(error) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        """Add item. Returns True if it may have been added before."""
+        seen = True
+        for position in self._positions(item):
+            byte, bit = divmod(position, 8)
+            if not self._bits[byte] & (1 << bit):
+                seen = False
+                self._bits[byte] |= 1 << bit
+        if not seen:
+            self.count += 1
+        return seen
+
+    def __contains__(self, item):
+        return all(self._bits[p // 8] & (1 << (p % 8)) for p in self._positions(item))
+
+
+class SlidingWindowCounter:
+    """Approximate events per key over the last `window` seconds, from the
+    current fixed window's count plus the previous one's, weighted by how
+    much of it the sliding window still covers. Three numbers per key, and
+    keys idle for two windows are dropped. Not thread-safe."""
+
+    def __init__(self, window):
+        self.window = window
+        self._counts = {}  # key -> [window index, current count, previous count]
+        self._swept = 0
+
+    def add(self, key, now=None):
+        """Count one event for key. Returns the estimate including it."""
+        now = time.time() if now is None else now
+        index, offset = divmod(now, self.window)
+        index = int(index)
+        if index > self._swept:
+            self._sweep(index)
+        entry = self._counts.get(key)
+        if entry is None or entry[0] < index - 1:
+            entry = self._counts[key] = [index, 0, 0]
+        elif entry[0] == index - 1:
+            entry[:] = [index, 0, entry[1]]
+        entry[1] += 1
+        return entry[1] + entry[2] * (1 - offset / self.window)
+
+    def _sweep(self, index):
+        self._counts = {k: v for k, v in self._counts.items() if v[0] >= index - 1}
+        self._swept = index
+
+    def __len__(self):
+        return len(self._counts)
+
+
+class AbuseDetector:
+    def __init__(self, bloom_capacity=None, bloom_error=None, referral_window=None, referral_limit=None):
+        self.bloom_capacity = bloom_capacity or config.ABUSE_BLOOM_CAPACITY
+        self.bloom_error = bloom_error or config.ABUSE_BLOOM_ERROR
+        self.referral_limit = referral_limit or config.ABUSE_REFERRAL_LIMIT
+        self.velocity = SlidingWindowCounter(referral_window or config.ABUSE_REFERRAL_WINDOW)
+        self.flags = {}
+        # Set when several processes register users (sharding.py). The filter
+        # and counters only see this process, so both checks then ask the
+        # database instead (two indexed lookups per registration).
+        self.shared = False
+        self._wallets = None
+        self._in_flight = {}  # wallet -> user_id, for registrations not committed yet
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def load(self, batch_size=None):
+        """Fill the wallet filter from users. Runs on the first check if not
+        called at startup."""
+        batch_size = batch_size or config.MIGRATION_BATCH_SIZE
+        wallets = BloomFilter(self.bloom_capacity, self.bloom_error)
+        conn = get_db_connection()
+        last_user_id = 0
+        while True:
+            rows = conn.execute(
+                'SELECT user_id, wallet_address FROM users WHERE wallet_address IS NOT NULL AND user_id > ? '
+                'ORDER BY user_id LIMIT ?',
+                (last_user_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            last_user_id = rows[-1][0]
+            for _, wallet in rows:
+                wallets.add(wallet.lower())
+        if wallets.count > self.bloom_capacity:
+            logger.warning(f"{wallets.count} wallets exceed ABUSE_BLOOM_CAPACITY ({self.bloom_capacity}); "
+                           "more registrations will need a database check")
+        with self._lock:
+            self._wallets = wallets
+        logger.info(f"Abuse checks loaded {wallets.count} wallets")
+
+    def check_registration(self, user_id, wallet_address, referrer_id=None):
+        """Flags for a registration, and for its referral if referrer_id is
+        given. Returns (registration_flags, referral_flags)."""
+        if self._wallets is None:
+            with self._load_lock:
+                if self._wallets is None:
+                    self.load()
+        wallet = wallet_address.lower()
+        with self._lock:
+            maybe_seen = self._wallets.add(wallet)
+            # The database only shows registrations that have been committed
+            racing = self._in_flight.setdefault(wallet, user_id) != user_id
+            velocity = self.velocity.add(referrer_id) if referrer_id else 0
+        if self.shared and referrer_id:
+            velocity = count_referrals_since(referrer_id, self.velocity.window) + 1
+        flags = []
+        if racing or ((maybe_seen or self.shared) and wallet_in_use(wallet_address, user_id)):
+            flags.append('duplicate_wallet')
+        referral_flags = list(flags)
+        if referrer_id:
+            referrer = get_user(referrer_id)
+            if referrer and referrer['wallet_address'] and referrer['wallet_address'].lower() == wallet_address.lower():
+                referral_flags.append('referrer_wallet')
+            if velocity > self.referral_limit:
+                referral_flags.append('referral_velocity')
+        with self._lock:
+            for flag in set(flags + referral_flags):
+                self.flags[flag] = self.flags.get(flag, 0) + 1
+        return flags, referral_flags
+
+    def done(self, user_id, wallet_address):
+        """Call once a checked registration is committed (or has failed)."""
+        with self._lock:
+            if self._in_flight.get(wallet_address.lower()) == user_id:
+                del self._in_flight[wallet_address.lower()]
+
+    def stats(self):
+        return {
+            'wallets': self._wallets.count if self._wallets else 0,
+            'referrers_tracked': len(self.velocity),
+            'flagged': dict(self.flags),
+        }
+
+
+detector = AbuseDetector()
+register_stats('mat_abuse', detector.stats, label='flag')
+
+
+def register(user_id, wallet_address):
+    """Save a confirmed wallet and credit INITIAL_REWARD, plus REFERRAL_REWARD
+    to the user's referrer, holding whichever the checks flag. Returns
+    (ok, held) where held means the registration reward is waiting for
+    review. A user who is already registered gets (False, False): the
+    rewards are paid once per account, whichever wallet it confirms."""
+    checked = _check_registration(user_id, wallet_address)
+    if checked is None:
+        return False, False
+    referrer_id, flags, referral_flags = checked
+    try:
+        if flags:
+            ok = _hold_registration(user_id, wallet_address, flags)
+        else:
+            # Both rewards in one transaction unless the referral is flagged
+            ok = update_user_wallet(user_id, wallet_address, None if referral_flags else referrer_id)
+        return _registered(ok, user_id, referrer_id, flags, referral_flags)
+    finally:
+        detector.done(user_id, wallet_address)
+
+
+async def register_async(user_id, wallet_address, run):
+    """register for async_bot.py. run(func, *args) awaits func on the SQLite
+    executor; the credit itself is awaited on the batcher, so no executor
+    thread waits for the flush."""
+    checked = await run(_check_registration, user_id, wallet_address)
+    if checked is None:
+        return False, False
+    referrer_id, flags, referral_flags = checked
+    try:
+        if flags:
+            ok = await run(_hold_registration, user_id, wallet_address, flags)
+        else:
+            ok = await credit_batcher.submit_many_async(
+                registration_credits(user_id, wallet_address, None if referral_flags else referrer_id))
+        return await run(_registered, ok, user_id, referrer_id, flags, referral_flags)
+    finally:
+        detector.done(user_id, wallet_address)
+
+
+def _check_registration(user_id, wallet_address):
+    """(referrer_id, flags, referral_flags), or None if already registered."""
+    user = get_user(user_id)
+    if user and user['registered']:
+        logger.warning(f"User {user_id} is already registered, not crediting {wallet_address}")
+        return None
+    referrer_id = user['referred_by'] if user else None
+    flags, referral_flags = detector.check_registration(user_id, wallet_address, referrer_id)
+    return referrer_id, flags, referral_flags
+
+
+def _hold_registration(user_id, wallet_address, flags):
+    logger.warning(f"Holding registration reward of user {user_id}: {', '.join(flags)}")
+    return hold_credit(user_id, 'registration', config.INITIAL_REWARD, flags, wallet_address=wallet_address) is not None
+
+
+def _registered(ok, user_id, referrer_id, flags, referral_flags):
+    if not ok:
+        return False, False
+    if referrer_id and referral_flags:
+        logger.warning(f"Holding referral reward of user {referrer_id} for {user_id}: {', '.join(referral_flags)}")
+        hold_credit(referrer_id, 'referral', config.REFERRAL_REWARD, referral_flags, referee_id=user_id)
+    return True, bool(flags)
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    from database import init_db
+    init_db()
+    command, ids = (sys.argv[1], sys.argv[2:]) if len(sys.argv) > 1 else ('list', [])
+    if command == 'list':
+        for hold in get_held_credits():
+            print(f"{hold['hold_id']}\t{hold['reason']}\tuser {hold['user_id']}\t"
+                  f"referee {hold['referee_id'] or '-'}\t{hold['flags']}\t{hold['created_at']}")
+    elif command in ('release', 'reject'):
+        decide = release_held_credit if command == 'release' else reject_held_credit
+        for hold_id in ids:
+            print(hold_id, 'done' if decide(int(hold_id)) else 'not held or failed')
+    else:
+        print('Usage: python abuse.py [list | release <hold_id>... | reject <hold_id>...]')
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from dotenv import load_dotenv
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from web3 import AsyncWeb3
+
+from config import BOT_TOKEN
+import config
+import metadata
+import metrics
+import abuse
+from outbox import AsyncOutbox, Replies
+from messages import command_name, text_action, callback_action
+
+load_dotenv()
+
+# Configure logging
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Imported once logging is set up, so the migrations init_db runs are logged
+import handlers
+from handlers import outbox, broadcaster, payout_queue, reconciler
+
+# Initialize bot. Replies are awaited on it, booked against the same rate
+# limits as the payout results and broadcasts the threaded outbox sends.
+if config.BOT_API_URL:
+    asyncio_helper.API_URL = config.BOT_API_URL
+bot = AsyncTeleBot(BOT_TOKEN)
+sender = AsyncOutbox(bot, outbox)
+
+# Only SQLite runs on this pool. Each pool thread keeps its own connection
+# (see database.get_db_connection); Telegram calls and registration credits
+# are awaited on the event loop.
+db_executor = ThreadPoolExecutor(max_workers=config.DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+async def db(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, func, *args)
+
+async def handle(handler, update):
+    replies = Replies()
+    await db(handler, update, replies)
+    await sender.deliver(replies)
+
+# Start command
+@bot.message_handler(commands=handlers.COMMANDS)
+@metrics.timed_handler(command_name)
+async def handle_commands(message):
+    await handle(handlers.handle_commands, message)
+
+@bot.message_handler(commands=['broadcast'])
+@metrics.timed_handler(command_name)
+async def broadcast_command(message):
+    await handle(handlers.broadcast_command, message)
+
+# Handle text messages
+@bot.message_handler(func=lambda message: True)
+@metrics.timed_handler(text_action)
+async def handle_text_messages(message):
+    await handle(handlers.handle_text_messages, message)
+
+# Handle button callbacks
+@bot.callback_query_handler(func=lambda call: True)
+@metrics.timed_handler(callback_action)
+async def button_handler(call):
+    if call.data != 'confirm_wallet_yes':
+        await handle(handlers.button_handler, call)
+        return
+    # The registration credit is awaited, not waited for on a pool thread
+    replies = Replies()
+    wallet_address = await db(handlers.confirmed_wallet, call, replies)
+    if wallet_address:
+        ok, held = await abuse.register_async(call.from_user.id, wallet_address, db)
+        await db(handlers.wallet_registered, call, replies, ok, held)
+    await sender.deliver(replies)
+
+async def check_nodes():
+    """Warn about RPC endpoints that are down or not on the same chain."""
+    async def chain_id(url):
+        w3 = AsyncWeb3(AsyncWeb3.AsyncHTTPProvider(url, request_kwargs={'timeout': aiohttp.ClientTimeout(config.RPC_TIMEOUT)}))
+        try:
+            return await w3.eth.chain_id
+        except Exception as e:
+            logger.warning(f"Web3 not connected to {url}: {e}")
+            return None
+    urls = [url for url, _ in config.BSC_RPC_URLS]
+    chain_ids = dict(zip(urls, await asyncio.gather(*(chain_id(url) for url in urls))))
+    if len(set(chain_ids.values()) - {None}) > 1:
+        logger.warning(f"RPC endpoints are on different chains: {chain_ids}")
+
+async def main():
+    loop = asyncio.get_running_loop()
+    metrics.start_server()
+    await loop.run_in_executor(None, metadata.warm)
+    await check_nodes()
+    await loop.run_in_executor(None, abuse.detector.load)
+    outbox.start()
+    await db(broadcaster.resume)
+    await loop.run_in_executor(None, payout_queue.start)
+    reconciler.start()
+    await bot.infinity_polling()
+
+# Main function
+if __name__ == '__main__':
+    print("🤖 MAT Airdrop Bot (asyncio) is starting...")
+    print("🔹 Available commands: /start, /dashboard, /withdraw, /referral, /help")
+    asyncio.run(main())
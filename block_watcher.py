@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+
+import config
+from rpc import quantity
+
+logger = logging.getLogger(__name__)
+
+
+class _Waiter:
+    __slots__ = ('hashes', 'event', 'receipt')
+
+    def __init__(self, hashes):
+        self.hashes = hashes
+        self.event = threading.Event()
+        self.receipt = None
+
+
+class BlockWatcher:
+    """Resolves receipt waits for every payout thread from one loop.
+
+    The loop polls eth_blockNumber every BLOCK_POLL_INTERVAL seconds while
+    anything is being waited for. Each new block is fetched once (transaction
+    hashes only) and matched against all watched hashes, so the RPC load no
+    longer grows with the number of payouts in flight. Receipts are only
+    requested for matches, and a hash is only reported once it is
+    PAYOUT_CONFIRMATIONS blocks deep and its receipt is still there, so a
+    transaction dropped by a reorg is watched again.
+
+    Hashes registered since the last tick get one direct receipt lookup,
+    which covers transactions mined before the watcher saw their block."""
+
+    def __init__(self, pool, confirmations=None, poll_interval=None, max_blocks=None):
+        self.pool = pool
+        self.confirmations = max(1, confirmations or config.PAYOUT_CONFIRMATIONS)
+        self.poll_interval = poll_interval or config.BLOCK_POLL_INTERVAL
+        self.max_blocks = max_blocks or config.BLOCK_SCAN_LIMIT
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._watched = {}   # tx_hash -> [waiter, ...]
+        self._new = set()    # hashes without a direct lookup yet
+        self._mined = {}     # tx_hash -> block number it was seen in
+        self._last_block = None
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="block-watcher", daemon=True)
+            self._thread.start()
+
+    def wait(self, tx_hashes, timeout):
+        """Block until one of tx_hashes has a confirmed receipt and return it,
+        or return None after timeout seconds."""
+        self.start()
+        waiter = _Waiter([h.lower() for h in tx_hashes])
+        with self._lock:
+            for h in waiter.hashes:
+                self._watched.setdefault(h, []).append(waiter)
+                self._new.add(h)
+            self._wakeup.notify()
+        try:
+            waiter.event.wait(timeout)
+            return waiter.receipt
+        finally:
+            with self._lock:
+                for h in waiter.hashes:
+                    waiters = self._watched.get(h)
+                    if waiters and waiter in waiters:
+                        waiters.remove(waiter)
+                        if not waiters:
+                            del self._watched[h]
+                            self._new.discard(h)
+                            self._mined.pop(h, None)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._watched:
+                    # Nothing to watch; catch up from the head when woken
+                    self._last_block = None
+                    self._wakeup.wait()
+            try:
+                self._tick()
+            except Exception as e:
+                logger.warning(f"Block watcher error: {e}")
+            time.sleep(self.poll_interval)
+
+    def _tick(self):
+        with self._lock:
+            new = list(self._new)
+            self._new.clear()
+        head = quantity(self.pool.call('eth_blockNumber', []))
+        if new:
+            self._record(new, self.pool.batch([('eth_getTransactionReceipt', [h]) for h in new]))
+
+        start = head if self._last_block is None else self._last_block + 1
+        if start < head - self.max_blocks + 1:
+            # Too far behind to scan every block; look the hashes up directly
+            start = head - self.max_blocks + 1
+            with self._lock:
+                self._new.update(self._watched)
+        if start <= head:
+            blocks = self.pool.batch([('eth_getBlockByNumber', [hex(n), False]) for n in range(start, head + 1)])
+            for number, block in zip(range(start, head + 1), blocks):
+                if block is None:
+                    # This endpoint has not seen it yet; scan it again next tick
+                    break
+                with self._lock:
+                    hits = [h.lower() for h in block['transactions'] if h.lower() in self._watched]
+                    for h in hits:
+                        self._mined[h] = number
+                self._last_block = number
+        self._settle(head)
+
+    def _record(self, hashes, receipts):
+        with self._lock:
+            for h, receipt in zip(hashes, receipts):
+                if receipt is not None and h in self._watched:
+                    self._mined[h] = quantity(receipt['blockNumber'])
+
+    def _settle(self, head):
+        with self._lock:
+            deep = [h for h, number in self._mined.items() if head - number + 1 >= self.confirmations]
+        if not deep:
+            return
+        receipts = self.pool.batch([('eth_getTransactionReceipt', [h]) for h in deep])
+        with self._lock:
+            for h, receipt in zip(deep, receipts):
+                if receipt is None:
+                    # Reorged out, or this endpoint is behind; look it up
+                    # again next tick
+                    logger.info(f"No receipt for {h} at block {head}, checking it again")
+                    self._mined.pop(h, None)
+                    if h in self._watched:
+                        self._new.add(h)
+                    continue
+                number = quantity(receipt['blockNumber'])
+                if head - number + 1 < self.confirmations:
+                    # Mined again in a later block
+                    self._mined[h] = number
+                    continue
+                self._mined.pop(h, None)
+                for waiter in self._watched.pop(h, []):
+                    if waiter.receipt is None:
+                        waiter.receipt = receipt
+                        waiter.event.set()
@@ -0,0 +1,186 @@
+import logging
+import sqlite3
+import threading
+import time
+from functools import partial
+
+from telebot.apihelper import ApiTelegramException
+
+import config
+from database import get_db_connection, set_user_blocked
+from outbox import BULK
+
+logger = logging.getLogger(__name__)
+
+# Delivery states:
+#   pending  -> recorded with its page, not sent yet
+#   queued   -> handed to the outbox
+#   sent     -> Telegram accepted it
+#   blocked  -> the user blocked the bot (users.blocked is set too)
+#   failed   -> any other error
+#   unknown  -> still queued when the bot stopped; it may or may not have
+#               gone out, so it is not sent again
+
+
+class Broadcaster:
+    """Sends a text to every registered user who hasn't blocked the bot.
+
+    Users are read BROADCAST_PAGE_SIZE at a time in user_id order, and each
+    page's delivery rows are written together with the broadcast's last_user_id,
+    so after a crash resume() sends the rest of the last page and carries on
+    after it. A message is marked queued just before it is handed over, and
+    queued messages are never sent again, so nobody gets it twice. Messages
+    go through the outbox's BULK lane, at most BROADCAST_WINDOW at a time, so
+    replies to users are never stuck behind an announcement."""
+
+    def __init__(self, outbox, page_size=None, window=None):
+        self.outbox = outbox
+        self.page_size = page_size or config.BROADCAST_PAGE_SIZE
+        self.window = window or config.BROADCAST_WINDOW
+
+    def start(self, text):
+        """Create a broadcast and send it in the background. Returns its id."""
+        broadcast_id = self.create(text)
+        if broadcast_id is not None:
+            self.send(broadcast_id)
+        return broadcast_id
+
+    def create(self, text):
+        """Record a broadcast without sending it. Returns its id or None."""
+        conn = get_db_connection()
+        try:
+            cursor = conn.execute('INSERT INTO broadcasts (text) VALUES (?)', (text,))
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f"Error creating broadcast: {e}")
+            return None
+        return cursor.lastrowid
+
+    def send(self, broadcast_id):
+        """Send a created broadcast in the background."""
+        self._spawn(broadcast_id)
+
+    def resume(self):
+        """Continue broadcasts that were running when the bot stopped."""
+        conn = get_db_connection()
+        rows = conn.execute("SELECT broadcast_id FROM broadcasts WHERE status = 'running'").fetchall()
+        for row in rows:
+            broadcast_id = row['broadcast_id']
+            cursor = conn.execute(
+                "UPDATE broadcast_deliveries SET status = 'unknown' WHERE broadcast_id = ? AND status = 'queued'",
+                (broadcast_id,)
+            )
+            conn.commit()
+            logger.info(f"Resuming broadcast {broadcast_id} ({cursor.rowcount} deliveries in doubt)")
+            self._spawn(broadcast_id)
+
+    def _spawn(self, broadcast_id):
+        t = threading.Thread(target=self._run, args=(broadcast_id,), name=f"broadcast-{broadcast_id}", daemon=True)
+        t.start()
+
+    def _run(self, broadcast_id):
+        conn = get_db_connection()
+        row = conn.execute('SELECT text, last_user_id FROM broadcasts WHERE broadcast_id = ?', (broadcast_id,)).fetchone()
+        text, last_user_id = row['text'], row['last_user_id']
+        window = threading.Semaphore(self.window)
+        progress = _Progress(broadcast_id)
+
+        # Left over from the page being sent when the bot stopped
+        page = [r['user_id'] for r in conn.execute(
+            "SELECT user_id FROM broadcast_deliveries WHERE broadcast_id = ? AND status = 'pending' ORDER BY user_id",
+            (broadcast_id,)
+        )]
+        self._send_page(conn, broadcast_id, text, page, window, progress)
+
+        while True:
+            page = [r['user_id'] for r in conn.execute(
+                'SELECT user_id FROM users WHERE user_id > ? AND registered = 1 AND blocked = 0 '
+                'ORDER BY user_id LIMIT ?',
+                (last_user_id, self.page_size)
+            )]
+            if not page:
+                break
+            try:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id, status) VALUES (?, ?, 'pending')",
+                    [(broadcast_id, user_id) for user_id in page]
+                )
+                conn.execute('UPDATE broadcasts SET last_user_id = ? WHERE broadcast_id = ?', (page[-1], broadcast_id))
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                logger.error(f"Broadcast {broadcast_id} stopped, could not record deliveries: {e}")
+                return
+            last_user_id = page[-1]
+            self._send_page(conn, broadcast_id, text, page, window, progress)
+
+        # Wait for the last messages to be delivered
+        for _ in range(self.window):
+            window.acquire()
+        conn.execute(
+            "UPDATE broadcasts SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE broadcast_id = ?",
+            (broadcast_id,)
+        )
+        conn.commit()
+        counts = dict(conn.execute(
+            'SELECT status, COUNT(*) FROM broadcast_deliveries WHERE broadcast_id = ? GROUP BY status',
+            (broadcast_id,)
+        ).fetchall())
+        logger.info(f"Broadcast {broadcast_id} finished: {counts}")
+
+    def _send_page(self, conn, broadcast_id, text, page, window, progress):
+        for user_id in page:
+            window.acquire()
+            conn.execute(
+                "UPDATE broadcast_deliveries SET status = 'queued' WHERE broadcast_id = ? AND user_id = ?",
+                (broadcast_id, user_id)
+            )
+            conn.commit()
+            self.outbox.send_message(
+                user_id, text, priority=BULK,
+                callback=partial(self._delivered, broadcast_id, user_id, window, progress),
+            )
+
+    def _delivered(self, broadcast_id, user_id, window, progress, ok, error):
+        if ok:
+            status = 'sent'
+        elif isinstance(error, ApiTelegramException) and error.error_code == 403:
+            status = 'blocked'
+            set_user_blocked(user_id, True)
+        else:
+            status = 'failed'
+        conn = get_db_connection()
+        try:
+            conn.execute(
+                'UPDATE broadcast_deliveries SET status = ? WHERE broadcast_id = ? AND user_id = ?',
+                (status, broadcast_id, user_id)
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f"Error recording delivery of broadcast {broadcast_id} to {user_id}: {e}")
+        progress.add(status)
+        window.release()
+
+
+class _Progress:
+    """Delivery counters, logged every BROADCAST_LOG_INTERVAL seconds."""
+
+    def __init__(self, broadcast_id):
+        self.broadcast_id = broadcast_id
+        self.counts = {}
+        self.started = time.monotonic()
+        self.next_log = self.started + config.BROADCAST_LOG_INTERVAL
+        self._lock = threading.Lock()
+
+    def add(self, status):
+        with self._lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+            now = time.monotonic()
+            if now < self.next_log:
+                return
+            self.next_log = now + config.BROADCAST_LOG_INTERVAL
+            total = sum(self.counts.values())
+            rate = total / (now - self.started)
+        logger.info(f"Broadcast {self.broadcast_id}: {total} delivered ({rate:.1f}/s) {self.counts}")
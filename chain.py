@@ -0,0 +1,251 @@
+import os
+import logging
+from decimal import Decimal
+from dotenv import load_dotenv
+# Web3
+from web3 import Web3
+from web3._utils.encoding import FriendlyJsonSerde
+
+import config
+import metadata
+import wallets
+from gas import GasOracle
+from nonce_manager import NonceManager
+from rpc import RpcPool, PooledProvider, quantity
+from block_watcher import BlockWatcher
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# --- Web3 / MAT setup ---
+MAT_TOKEN_ADDRESS = os.getenv('MAT_TOKEN_ADDRESS')
+PAYOUT_FROM_ADDRESS = os.getenv('PAYOUT_FROM_ADDRESS')
+PRIVATE_KEY = os.getenv('PRIVATE_KEY')
+
+TX_NOT_FOUND = "Transaction was never broadcast"
+TX_CANCELLED = "Transaction was dropped and cancelled"
+
+# Every call goes through the endpoint pool; its health probe is started
+# with the payout queue
+rpc_pool = RpcPool()
+w3 = Web3(PooledProvider(rpc_pool))
+# One loop tracks the receipts of every payout in flight
+block_watcher = BlockWatcher(rpc_pool)
+
+ERC20_ABI = [
+    {"constant":False,"inputs":[{"name":"_to","type":"address"},{"name":"_value","type":"uint256"}],"name":"transfer","outputs":[{"name":"","type":"bool"}],"type":"function"},
+    {"constant":True,"inputs":[],"name":"decimals","outputs":[{"name":"","type":"uint8"}],"type":"function"},
+    {"constant":True,"inputs":[{"name":"_owner","type":"address"}],"name":"balanceOf","outputs":[{"name":"balance","type":"uint256"}],"type":"function"},
+    {"constant":False,"inputs":[{"name":"_spender","type":"address"},{"name":"_value","type":"uint256"}],"name":"approve","outputs":[{"name":"","type":"bool"}],"type":"function"},
+    {"constant":True,"inputs":[{"name":"_owner","type":"address"},{"name":"_spender","type":"address"}],"name":"allowance","outputs":[{"name":"","type":"uint256"}],"type":"function"},
+]
+
+MAX_UINT256 = 2**256 - 1
+
+if MAT_TOKEN_ADDRESS:
+    mat_contract = w3.eth.contract(address=Web3.to_checksum_address(MAT_TOKEN_ADDRESS), abi=ERC20_ABI)
+else:
+    mat_contract = None
+
+if config.DISPERSE_CONTRACT_ADDRESS:
+    disperse_contract = w3.eth.contract(address=Web3.to_checksum_address(config.DISPERSE_CONTRACT_ADDRESS), abi=config.DISPERSE_ABI)
+else:
+    disperse_contract = None
+
+metadata.register('chain_id', lambda: w3.eth.chain_id)
+metadata.register('payout_address', lambda: Web3.to_checksum_address(PAYOUT_FROM_ADDRESS))
+metadata.register('token_decimals', lambda: mat_contract.functions.decimals().call())
+
+# Shared by every payout worker so concurrent transfers get distinct nonces
+nonces = NonceManager(w3, Web3.to_checksum_address(PAYOUT_FROM_ADDRESS)) if PAYOUT_FROM_ADDRESS else None
+gas_oracle = GasOracle(w3)
+
+def mat_to_minor_units(amount_mat: Decimal, decimals: int) -> int:
+    return int((amount_mat * (Decimal(10) ** decimals)).quantize(Decimal('1')))
+
+def sign_mat_transfer(dest_addr: str, amount_mat: Decimal, nonce: int, fees=None):
+    """Build and sign a MAT transfer with the given nonce without broadcasting it.
+    fees defaults to the gas oracle's current estimate.
+    Returns (ok:bool, signed_tx_or_error_str)."""
+    if mat_contract is None:
+        return False, "MAT contract not configured"
+    try:
+        dest = wallets.to_checksum(dest_addr)
+    except Exception:
+        dest = None
+    if dest is None:
+        return False, "Invalid wallet address"
+
+    try:
+        from_addr = metadata.get('payout_address')
+        decimals = metadata.get('token_decimals')
+    except Exception as e:
+        return False, f"Error reading token decimals: {e}"
+    amount = mat_to_minor_units(amount_mat, decimals)
+
+    try:
+        tx = mat_contract.functions.transfer(dest, amount).build_transaction(
+            _tx_params(from_addr, nonce, _transfer_gas_limit(from_addr), fees))
+        return True, w3.eth.account.sign_transaction(tx, private_key=PRIVATE_KEY)
+    except Exception as e:
+        return False, str(e)
+
+def _transfer_gas_limit(from_addr):
+    # Estimated once against a never-used recipient, the most expensive case
+    # for an ERC-20 transfer, then reused for every transfer
+    def estimate():
+        fresh = Web3.to_checksum_address(os.urandom(20))
+        return mat_contract.functions.transfer(fresh, 1).estimate_gas({'from': from_addr})
+    try:
+        return gas_oracle.gas_limit('erc20_transfer', estimate)
+    except Exception as e:
+        logger.warning(f"Transfer gas estimate failed, using fallback: {e}")
+        return 200000
+
+def _tx_params(from_addr, nonce, gas, fees=None):
+    # An explicit gas value stops build_transaction from estimating on its own
+    params = {
+        'from': from_addr,
+        'nonce': nonce,
+        'chainId': metadata.get('chain_id'),
+        'gas': gas,
+    }
+    params.update(fees or gas_oracle.fees())
+    return params
+
+def _sign(tx):
+    estimate_tx = {k: v for k, v in tx.items() if k != 'gas'}
+    try:
+        gas_est = w3.eth.estimate_gas(estimate_tx)
+        tx['gas'] = int(gas_est * 1.2)
+    except Exception:
+        pass
+    return w3.eth.account.sign_transaction(tx, private_key=PRIVATE_KEY)
+
+def batching_enabled() -> bool:
+    return disperse_contract is not None and config.PAYOUT_BATCH_SIZE > 1
+
+def disperse_allowance() -> int:
+    from_addr = metadata.get('payout_address')
+    return mat_contract.functions.allowance(from_addr, disperse_contract.address).call()
+
+def sign_disperse_approval(nonce: int):
+    """Sign an unlimited MAT approval for the disperse contract.
+    Returns (ok:bool, signed_tx_or_error_str)."""
+    try:
+        from_addr = metadata.get('payout_address')
+        tx = mat_contract.functions.approve(disperse_contract.address, MAX_UINT256).build_transaction(_tx_params(from_addr, nonce, 100000))
+        return True, _sign(tx)
+    except Exception as e:
+        return False, str(e)
+
+def sign_mat_batch(payouts, nonce: int, fees=None):
+    """Build and sign one disperse call paying every (dest_addr, amount_mat)
+    in payouts. Returns (ok:bool, signed_tx_or_error_str)."""
+    if mat_contract is None or disperse_contract is None:
+        return False, "Disperse contract not configured"
+    try:
+        recipients = [wallets.to_checksum(dest) for dest, _ in payouts]
+    except Exception:
+        recipients = [None]
+    if None in recipients:
+        return False, "Invalid wallet address"
+
+    try:
+        from_addr = metadata.get('payout_address')
+        decimals = metadata.get('token_decimals')
+    except Exception as e:
+        return False, f"Error reading token decimals: {e}"
+    values = [mat_to_minor_units(amount, decimals) for _, amount in payouts]
+
+    try:
+        disperse = getattr(disperse_contract.functions, config.DISPERSE_METHOD)
+        tx = disperse(mat_contract.address, recipients, values).build_transaction(_tx_params(from_addr, nonce, 60000 + 60000 * len(payouts), fees))
+        return True, _sign(tx)
+    except Exception as e:
+        return False, str(e)
+
+def sign_cancel(nonce: int, fees=None):
+    """Sign a zero-value self transfer that consumes nonce, used to plug a gap
+    left by a dropped payout. Returns (ok:bool, signed_tx_or_error_str)."""
+    try:
+        from_addr = metadata.get('payout_address')
+        tx = _tx_params(from_addr, nonce, 21000, fees)
+        tx.update({'to': from_addr, 'value': 0})
+        return True, w3.eth.account.sign_transaction(tx, private_key=PRIVATE_KEY)
+    except Exception as e:
+        return False, str(e)
+
+def broadcast(signed):
+    """Send a signed transaction. Returns (ok:bool|None, tx_hash_or_error_str).
+    ok is False only when a node rejected it, so it can never be mined, and
+    None when it may have reached a node anyway: a timeout, or an endpoint
+    that failed before the one that answered."""
+    body = FriendlyJsonSerde().json_encode({
+        'jsonrpc': '2.0', 'id': 0, 'method': 'eth_sendRawTransaction',
+        'params': [w3.to_hex(signed.rawTransaction)],
+    })
+    try:
+        _, response, attempts = rpc_pool.post(body, 'eth_sendRawTransaction')
+    except Exception as e:
+        return None, str(e)
+    if 'error' not in response:
+        return True, w3.to_hex(signed.hash)
+    error = str(response['error'].get('message', response['error']))
+    if 'already known' in error.lower() or 'known transaction' in error.lower():
+        return True, w3.to_hex(signed.hash)
+    return (None if attempts > 1 else False), error
+
+def send_cancel(nonce: int, fees=None):
+    """Sign and send a cancel for nonce. Returns (ok:bool|None,
+    tx_hash_or_error_str) like broadcast."""
+    ok, signed = sign_cancel(nonce, fees)
+    if not ok:
+        return False, signed
+    ok, res = broadcast(signed)
+    return ok, w3.to_hex(signed.hash) if ok is None else res
+
+def wait_for_mat(tx_hashes, timeout=180):
+    """Wait for a broadcast transfer, or any of its fee-bumped replacements, to
+    be mined and PAYOUT_CONFIRMATIONS deep. Returns (ok:bool|None,
+    tx_hash_or_error_str). ok is None when none of them is confirmed after
+    timeout."""
+    if isinstance(tx_hashes, str):
+        tx_hashes = [tx_hashes]
+    receipt = block_watcher.wait(tx_hashes, timeout)
+    if receipt is not None:
+        if quantity(receipt['status']) == 1:
+            return True, receipt['transactionHash']
+        return False, "Transaction reverted on-chain"
+
+    try:
+        found = rpc_pool.batch([('eth_getTransactionByHash', [h]) for h in tx_hashes])
+    except Exception as e:
+        return None, str(e)
+    for tx_hash, tx in zip(tx_hashes, found):
+        if tx is not None:
+            return None, f"Transaction {tx_hash} not confirmed after {timeout}s"
+    return False, TX_NOT_FOUND
+
+def send_mat(dest_addr: str, amount_mat: Decimal):
+    """Send MAT tokens to user. Returns (ok:bool, tx_hash_or_error_str)."""
+    if nonces is None:
+        return False, "Payout wallet not configured"
+    nonce = nonces.allocate()
+    ok, signed = sign_mat_transfer(dest_addr, amount_mat, nonce)
+    if not ok:
+        nonces.release(nonce)
+        return False, signed
+    ok, tx_hash = broadcast(signed)
+    if ok is False:
+        if not nonces.handle_error(tx_hash):
+            nonces.release(nonce)
+        return False, tx_hash
+    if ok is None:
+        # It may still be mined, so its nonce stays taken
+        return False, tx_hash
+    ok, res = wait_for_mat(tx_hash)
+    if ok is None:
+        return False, res
+    return ok, res
@@ -15,5 +15,129 @@ MIN_WITHDRAWAL = 4       # 4 MAT minimum to withdraw
 YOUR_TELEGRAM_ID = "@NUCLEAR05"
 TELEGRAM_GROUP = "https://t.me/fuckincarders"
 
-# Admin configuration (not used for automatic payouts)
-ADMIN_IDS = []
+# Admin configuration (not used for automatic payouts). Admins can /broadcast.
+ADMIN_IDS = [int(i) for i in os.getenv('ADMIN_IDS', '').split(',') if i.strip()]
+
+# Referral leaderboard (/leaderboard)
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', '10'))  # referrers listed
+
+# Abuse checks on registrations. Flagged rewards are held for review
+# (python abuse.py list) instead of credited.
+ABUSE_REFERRAL_WINDOW = int(os.getenv('ABUSE_REFERRAL_WINDOW', '3600'))  # seconds
+ABUSE_REFERRAL_LIMIT = int(os.getenv('ABUSE_REFERRAL_LIMIT', '30'))  # referrals per referrer per window before holding
+ABUSE_BLOOM_CAPACITY = int(os.getenv('ABUSE_BLOOM_CAPACITY', '2000000'))  # wallets the filter is sized for
+ABUSE_BLOOM_ERROR = float(os.getenv('ABUSE_BLOOM_ERROR', '0.001'))  # share of new wallets that need a database check
+
+# RPC endpoints: comma-separated URLs, each optionally weighted as url|weight
+# (default 1). BSC_RPC_URL alone still works.
+def _rpc_endpoints(value):
+    endpoints = []
+    for item in value.split(','):
+        url, _, weight = item.strip().partition('|')
+        if url:
+            endpoints.append((url, float(weight or 1)))
+    return endpoints
+
+BSC_RPC_URLS = _rpc_endpoints(os.getenv('BSC_RPC_URLS') or os.getenv('BSC_RPC_URL') or '')
+RPC_TIMEOUT = float(os.getenv('RPC_TIMEOUT', '10'))  # seconds per request
+RPC_POOL_SIZE = int(os.getenv('RPC_POOL_SIZE', '16'))  # keep-alive connections per endpoint
+RPC_BATCH_LIMIT = int(os.getenv('RPC_BATCH_LIMIT', '100'))  # calls per JSON-RPC batch request
+RPC_HEALTH_INTERVAL = float(os.getenv('RPC_HEALTH_INTERVAL', '15'))  # seconds between health probes
+RPC_MAX_BLOCK_LAG = int(os.getenv('RPC_MAX_BLOCK_LAG', '5'))  # blocks an endpoint may trail the best one
+RPC_BREAKER_FAILURES = int(os.getenv('RPC_BREAKER_FAILURES', '3'))  # failures in a row before an endpoint is skipped
+RPC_BREAKER_COOLDOWN = float(os.getenv('RPC_BREAKER_COOLDOWN', '30'))  # seconds it is skipped for
+
+# Payout workers
+PAYOUT_WORKERS = int(os.getenv('PAYOUT_WORKERS', '4'))
+PAYOUT_RECEIPT_TIMEOUT = int(os.getenv('PAYOUT_RECEIPT_TIMEOUT', '180'))
+PAYOUT_CONFIRMATIONS = int(os.getenv('PAYOUT_CONFIRMATIONS', '1'))  # blocks deep a payout must be (1 = mined)
+BLOCK_POLL_INTERVAL = float(os.getenv('BLOCK_POLL_INTERVAL', '3'))  # seconds; BSC makes a block every 3s
+BLOCK_SCAN_LIMIT = int(os.getenv('BLOCK_SCAN_LIMIT', '100'))  # most blocks fetched in one catch-up
+
+# Reconciliation of payouts left in flight (see reconciler.py)
+RECONCILE_INTERVAL = int(os.getenv('RECONCILE_INTERVAL', '60'))  # seconds between passes
+RECONCILE_BATCH_SIZE = int(os.getenv('RECONCILE_BATCH_SIZE', '200'))  # rows per JSON-RPC batch
+RECONCILE_MIN_AGE = int(os.getenv('RECONCILE_MIN_AGE', '900'))  # seconds a row must be unchanged
+
+# Batched payouts through a disperse-style contract. Batching is used when
+# DISPERSE_CONTRACT_ADDRESS is set and PAYOUT_BATCH_SIZE is above 1.
+DISPERSE_CONTRACT_ADDRESS = os.getenv('DISPERSE_CONTRACT_ADDRESS')
+PAYOUT_BATCH_SIZE = int(os.getenv('PAYOUT_BATCH_SIZE', '1'))
+PAYOUT_BATCH_WINDOW = float(os.getenv('PAYOUT_BATCH_WINDOW', '5'))  # seconds
+DISPERSE_METHOD = os.getenv('DISPERSE_METHOD', 'disperseTokenSimple')
+DISPERSE_ABI = [
+    {"inputs":[{"name":"token","type":"address"},{"name":"recipients","type":"address[]"},{"name":"values","type":"uint256[]"}],"name":"disperseToken","outputs":[],"stateMutability":"nonpayable","type":"function"},
+    {"inputs":[{"name":"token","type":"address"},{"name":"recipients","type":"address[]"},{"name":"values","type":"uint256[]"}],"name":"disperseTokenSimple","outputs":[],"stateMutability":"nonpayable","type":"function"},
+]
+
+# Gas. GAS_PRICE_GWEI is the legacy gas price floor for chains without a base fee.
+GAS_PRICE_GWEI = float(os.getenv('GAS_PRICE_GWEI', '5'))
+GAS_MAX_GWEI = float(os.getenv('GAS_MAX_GWEI', '100'))
+GAS_MIN_PRIORITY_GWEI = float(os.getenv('GAS_MIN_PRIORITY_GWEI', '0'))
+GAS_REFRESH_INTERVAL = float(os.getenv('GAS_REFRESH_INTERVAL', '15'))  # seconds
+GAS_HISTORY_BLOCKS = int(os.getenv('GAS_HISTORY_BLOCKS', '20'))
+GAS_PRIORITY_PERCENTILE = int(os.getenv('GAS_PRIORITY_PERCENTILE', '50'))
+GAS_BUMP_PERCENT = int(os.getenv('GAS_BUMP_PERCENT', '15'))
+GAS_MAX_BUMPS = int(os.getenv('GAS_MAX_BUMPS', '3'))
+
+# SQLite
+DB_BUSY_TIMEOUT = int(os.getenv('DB_BUSY_TIMEOUT', '5000'))  # ms to wait on a locked database
+DB_STATEMENT_CACHE = int(os.getenv('DB_STATEMENT_CACHE', '256'))
+CREDIT_FLUSH_MS = int(os.getenv('CREDIT_FLUSH_MS', '50'))  # max wait before reward credits are committed
+CREDIT_FLUSH_EVENTS = int(os.getenv('CREDIT_FLUSH_EVENTS', '500'))
+CREDIT_TIMEOUT = float(os.getenv('CREDIT_TIMEOUT', '30'))  # seconds a caller waits for its credit to be committed
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '50000'))  # user rows kept in memory
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))  # seconds
+WALLET_CACHE_SIZE = int(os.getenv('WALLET_CACHE_SIZE', '100000'))  # checksummed addresses kept in memory
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', '10000'))  # rows rewritten per transaction
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', '8'))  # SQLite threads used by async_bot.py
+
+# Outgoing messages. Telegram allows about 30 messages per second overall
+# and about one per second to a single chat.
+OUTBOX_GLOBAL_RATE = float(os.getenv('OUTBOX_GLOBAL_RATE', '30'))  # messages per second
+OUTBOX_CHAT_RATE = float(os.getenv('OUTBOX_CHAT_RATE', '1'))  # messages per second per chat
+OUTBOX_CHAT_BURST = int(os.getenv('OUTBOX_CHAT_BURST', '3'))
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '8'))
+BOT_API_URL = os.getenv('BOT_API_URL')  # e.g. http://127.0.0.1:8081/bot{0}/{1} for a local Bot API server
+
+# Broadcasts
+BROADCAST_PAGE_SIZE = int(os.getenv('BROADCAST_PAGE_SIZE', '500'))  # users read per query
+BROADCAST_WINDOW = int(os.getenv('BROADCAST_WINDOW', '200'))  # messages handed to the outbox at once
+BROADCAST_LOG_INTERVAL = int(os.getenv('BROADCAST_LOG_INTERVAL', '30'))  # seconds between progress logs
+
+# Exports (python export.py)
+EXPORT_DIR = os.getenv('EXPORT_DIR', 'exports')
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', '5000'))  # rows read per query
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', '1000000'))  # rows per output file
+
+# Metrics. Set METRICS_PORT to serve Prometheus metrics on /metrics; keep
+# METRICS_HOST on localhost unless the port is firewalled.
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Multi-process mode (python sharding.py). Updates are spread over
+# SHARD_PROCESSES worker processes by user id; the parent process sends all
+# payouts.
+SHARD_PROCESSES = int(os.getenv('SHARD_PROCESSES', '0'))  # 0 = one per CPU
+SHARD_QUEUE_SIZE = int(os.getenv('SHARD_QUEUE_SIZE', '1000'))  # updates waiting per worker
+SHARD_USER_CACHE_TTL = float(os.getenv('SHARD_USER_CACHE_TTL', '5'))  # seconds; other processes change user rows too
+SHARD_LEADERBOARD_REFRESH = float(os.getenv('SHARD_LEADERBOARD_REFRESH', '10'))  # seconds between leaderboard reloads
+SHARD_DRAIN_TIMEOUT = float(os.getenv('SHARD_DRAIN_TIMEOUT', '10'))  # seconds a stopping worker gets to send queued replies
+
+# Conversation state. Use STATE_BACKEND=sqlite when several bot processes
+# share one database so any of them can continue a registration.
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'memory')  # memory or sqlite
+STATE_TTL = int(os.getenv('STATE_TTL', '86400'))  # seconds an unfinished registration is remembered
+STATE_SWEEP_INTERVAL = int(os.getenv('STATE_SWEEP_INTERVAL', '60'))
+
+# Webhook mode. Set WEBHOOK_URL (public https URL Telegram should call) to
+# register the webhook; setting only WEBHOOK_PORT serves an already
+# registered webhook. Without either the bot uses long polling.
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '0'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # required; Telegram sends it with every update
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))  # per worker
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
@@ -1,15 +1,64 @@
+import asyncio
 import sqlite3
 import logging
+import threading
+import time
 from decimal import Decimal
 from contextlib import closing
 import config
+from cache import LRUCache, MISSING
+from leaderboard import Leaderboard
+from migrations import migrate, MINOR_UNITS
+from metrics import timed_query, register_stats, DB_SECONDS
 
 logger = logging.getLogger(__name__)
 
 DB_PATH = 'usdt_airdrop.db'
 
+# Every thread keeps one open connection for its lifetime instead of
+# reconnecting per query; sqlite3 caches compiled statements per connection,
+# so repeated queries also skip the parse step.
+_local = threading.local()
+
+# Rows returned by get_user; every helper that changes a user invalidates it
+_user_cache = LRUCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
+register_stats('mat_user_cache', _user_cache.stats)
+
+# Referrers ranked by referral count, updated by every credit flush and
+# loaded from referral_leaderboard at startup
+referral_leaderboard = Leaderboard()
+register_stats('mat_leaderboard', referral_leaderboard.stats)
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=config.DB_BUSY_TIMEOUT / 1000,
+                           cached_statements=config.DB_STATEMENT_CACHE)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f'PRAGMA busy_timeout = {int(config.DB_BUSY_TIMEOUT)}')
+    # With WAL, NORMAL only syncs at checkpoints: an application crash loses
+    # nothing and a power loss can at most roll back the latest commits
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+def get_db_connection():
+    """Return this thread's connection, opening it on first use. Callers must
+    commit or roll back but never close it."""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _connect()
+        _local.conn = conn
+    return conn
+
+def close_db_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
+    # Readers no longer block the writer and vice versa
+    conn.execute('PRAGMA journal_mode = WAL')
     cursor = conn.cursor()
 
     # Create users table
@@ -39,56 +88,120 @@ def init_db():
     )
     ''')
 
+    # Append-only record of every reward credited to a balance
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS credits (
+        credit_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id BIGINT,
+        reason TEXT,
+        amount_mat REAL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+    # Announcements and their per-user delivery state
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        status TEXT DEFAULT 'running',
+        last_user_id BIGINT DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        finished_at DATETIME
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+        broadcast_id INTEGER,
+        user_id BIGINT,
+        status TEXT,
+        PRIMARY KEY (broadcast_id, user_id)
+    ) WITHOUT ROWID
+    ''')
+
     conn.commit()
-    conn.close()
-    logger.info("Database initialized successfully")
+    version = migrate(conn)
+    reload_leaderboard()
+    logger.info(f"Database initialized successfully (schema version {version})")
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+def reload_leaderboard():
+    """Load referral_leaderboard into memory, e.g. to pick up credits made
+    by other processes."""
+    conn = get_db_connection()
+    referral_leaderboard.load(conn.execute('SELECT user_id, referrals FROM referral_leaderboard'))
 
-def add_user(user_id, username):
+def to_minor(amount):
+    """MAT amount (Decimal, str, int or float) as integer ledger units."""
+    return int((Decimal(str(amount)) * MINOR_UNITS).quantize(Decimal('1')))
+
+def from_minor(minor):
+    return Decimal(minor or 0) / MINOR_UNITS
+
+@timed_query
+def add_user(user_id, username, referred_by=None):
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
         cursor.execute(
-            'INSERT OR IGNORE INTO users (user_id, username, balance) VALUES (?, ?, 0)',
-            (user_id, username)
+            'INSERT OR IGNORE INTO users (user_id, username, balance, referred_by) VALUES (?, ?, 0, ?)',
+            (user_id, username, referred_by)
         )
         conn.commit()
+        _user_cache.invalidate(user_id)
         return True
     except sqlite3.Error as e:
+        conn.rollback()
         logger.error(f"Error adding user: {e}")
         return False
-    finally:
-        conn.close()
 
+@timed_query
 def get_user(user_id):
+    user = _user_cache.get(user_id)
+    if user is not MISSING:
+        return user
+    token = _user_cache.get_token()
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
     user = cursor.fetchone()
-    conn.close()
+    # Unknown users are cached too; add_user invalidates them
+    _user_cache.put(user_id, user, token)
     return user
 
-def update_user_wallet(user_id, wallet_address):
-    """Save wallet and credit initial reward defined in config.INITIAL_REWARD"""
+def invalidate_user(user_id):
+    """Drop a cached user row after changing it outside these helpers."""
+    _user_cache.invalidate(user_id)
+
+def user_cache_stats():
+    return _user_cache.stats()
+
+@timed_query
+def set_user_blocked(user_id, blocked):
     conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            'UPDATE users SET wallet_address = ?, registered = 1, balance = balance + ? WHERE user_id = ?',
-            (wallet_address, float(config.INITIAL_REWARD), user_id)
-        )
+        conn.execute('UPDATE users SET blocked = ? WHERE user_id = ?', (1 if blocked else 0, user_id))
         conn.commit()
+        _user_cache.invalidate(user_id)
         return True
     except sqlite3.Error as e:
-        logger.error(f"Error updating wallet: {e}")
+        conn.rollback()
+        logger.error(f"Error updating blocked flag: {e}")
         return False
-    finally:
-        conn.close()
 
+@timed_query
+def update_user_wallet(user_id, wallet_address, referrer_id=None):
+    """Save wallet and credit initial reward defined in config.INITIAL_REWARD,
+    plus config.REFERRAL_REWARD to referrer_id, in one transaction"""
+    return credit_batcher.submit_many(registration_credits(user_id, wallet_address, referrer_id))
+
+def registration_credits(user_id, wallet_address, referrer_id=None):
+    """The credits update_user_wallet submits, for CreditBatcher.submit_many_async"""
+    credits = [(user_id, 'registration', config.INITIAL_REWARD, 0, wallet_address, None)]
+    if referrer_id:
+        credits.append((referrer_id, 'referral', config.REFERRAL_REWARD, 1, None, user_id))
+    return credits
+
+@timed_query
 def mark_tasks_completed(user_id):
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -98,46 +211,165 @@ def mark_tasks_completed(user_id):
             (user_id,)
         )
         conn.commit()
+        _user_cache.invalidate(user_id)
         return True
     except sqlite3.Error as e:
+        conn.rollback()
         logger.error(f"Error marking tasks completed: {e}")
         return False
-    finally:
-        conn.close()
 
-def add_referral(referrer_id):
-    """Credit referral reward to referrer. Uses config.REFERRAL_REWARD"""
+@timed_query
+def add_referral(referrer_id, referee_id=None):
+    """Credit referral reward to referrer and record who they referred. Uses config.REFERRAL_REWARD"""
+    return credit_batcher.submit(referrer_id, 'referral', config.REFERRAL_REWARD, referrals=1, referee_id=referee_id)
+
+@timed_query
+def hold_credit(user_id, reason, amount, flags, referee_id=None, wallet_address=None):
+    """Record a credit for review instead of paying it. With wallet_address the
+    user is also registered with that wallet, as update_user_wallet would,
+    unless they already are. Returns the hold_id or None on failure."""
     conn = get_db_connection()
-    cursor = conn.cursor()
     try:
-        cursor.execute(
-            'UPDATE users SET referrals = referrals + 1, earned_from_referrals = earned_from_referrals + ?, balance = balance + ? WHERE user_id = ?',
-            (float(config.REFERRAL_REWARD), float(config.REFERRAL_REWARD), referrer_id)
+        if wallet_address is not None:
+            cur = conn.execute('UPDATE users SET wallet_address = ?, registered = 1 WHERE user_id = ? AND registered = 0',
+                               (wallet_address, user_id))
+            if not cur.rowcount:
+                conn.rollback()
+                logger.warning(f"Not holding {reason} credit for user {user_id}: already registered")
+                return None
+        cur = conn.execute(
+            'INSERT INTO held_credits (user_id, reason, amount_minor, referee_id, flags) VALUES (?, ?, ?, ?, ?)',
+            (user_id, reason, to_minor(amount), referee_id, ','.join(flags))
         )
         conn.commit()
+        _user_cache.invalidate(user_id)
+        return cur.lastrowid
+    except sqlite3.Error as e:
+        conn.rollback()
+        logger.error(f"Error holding {reason} credit for user {user_id}: {e}")
+        return None
+
+def get_held_credits(limit=100):
+    conn = get_db_connection()
+    return conn.execute(
+        "SELECT * FROM held_credits WHERE status = 'held' ORDER BY hold_id LIMIT ?", (limit,)
+    ).fetchall()
+
+def _decide_held_credit(conn, hold_id, from_status, to_status):
+    cur = conn.execute(
+        'UPDATE held_credits SET status = ?, decided_at = CURRENT_TIMESTAMP WHERE hold_id = ? AND status = ?',
+        (to_status, hold_id, from_status)
+    )
+    conn.commit()
+    return cur.rowcount == 1
+
+@timed_query
+def release_held_credit(hold_id):
+    """Pay a held credit. Returns False if it is not held or the credit failed."""
+    conn = get_db_connection()
+    try:
+        if not _decide_held_credit(conn, hold_id, 'held', 'released'):
+            return False
+        hold = conn.execute('SELECT * FROM held_credits WHERE hold_id = ?', (hold_id,)).fetchone()
+    except sqlite3.Error as e:
+        conn.rollback()
+        logger.error(f"Error releasing held credit {hold_id}: {e}")
+        return False
+    referral = hold['reason'] == 'referral'
+    if credit_batcher.submit(hold['user_id'], hold['reason'], from_minor(hold['amount_minor']),
+                             referrals=1 if referral else 0, referee_id=hold['referee_id']):
         return True
+    # Keep it held so it can be released again
+    try:
+        _decide_held_credit(conn, hold_id, 'released', 'held')
     except sqlite3.Error as e:
-        logger.error(f"Error adding referral: {e}")
+        conn.rollback()
+        logger.error(f"Held credit {hold_id} was not paid and could not be put back on hold: {e}")
+    return False
+
+@timed_query
+def reject_held_credit(hold_id):
+    conn = get_db_connection()
+    try:
+        return _decide_held_credit(conn, hold_id, 'held', 'rejected')
+    except sqlite3.Error as e:
+        conn.rollback()
+        logger.error(f"Error rejecting held credit {hold_id}: {e}")
         return False
-    finally:
-        conn.close()
 
+@timed_query
+def wallet_in_use(wallet_address, user_id):
+    """Whether another user has registered wallet_address."""
+    conn = get_db_connection()
+    return conn.execute(
+        'SELECT 1 FROM users WHERE wallet_address = ? AND user_id != ? LIMIT 1', (wallet_address, user_id)
+    ).fetchone() is not None
+
+@timed_query
+def get_leaderboard(limit=None):
+    """Top referrers as (user_id, username, referrals), best first."""
+    rows = []
+    for user_id, referrals in referral_leaderboard.top(limit or config.LEADERBOARD_SIZE):
+        user = get_user(user_id)
+        rows.append((user_id, user['username'] if user else None, referrals))
+    return rows
+
+@timed_query
+def get_referral_stats(user_id):
+    """A user's leaderboard rank (None without referrals) and referral counts:
+    direct, second_level (people their referees invited) and last_hour.
+    Referrals from before the referrals table existed only count as direct."""
+    conn = get_db_connection()
+    ranked = referral_leaderboard.rank(user_id)
+    last_hour = count_referrals_since(user_id, 3600)
+    second_level = conn.execute(
+        'SELECT COUNT(*) FROM referrals AS r1 JOIN referrals AS r2 ON r2.referrer_id = r1.referee_id '
+        'WHERE r1.referrer_id = ?',
+        (user_id,)
+    ).fetchone()[0]
+    return {
+        'rank': ranked[0] if ranked else None,
+        'direct': ranked[1] if ranked else 0,
+        'second_level': second_level,
+        'last_hour': last_hour,
+    }
+
+@timed_query
+def count_referrals_since(referrer_id, seconds):
+    """Referrals credited to referrer_id in the last `seconds`."""
+    conn = get_db_connection()
+    return conn.execute(
+        "SELECT COUNT(*) FROM referrals WHERE referrer_id = ? AND created_at >= datetime('now', ?)",
+        (referrer_id, f'-{int(seconds)} seconds')
+    ).fetchone()[0]
+
+@timed_query
+def count_recent_referrals(seconds=3600):
+    """Referrals recorded in the last `seconds` across all users."""
+    conn = get_db_connection()
+    return conn.execute(
+        "SELECT COUNT(*) FROM referrals WHERE created_at >= datetime('now', ?)", (f'-{int(seconds)} seconds',)
+    ).fetchone()[0]
+
+@timed_query
 def update_balance(user_id, amount):
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
+        minor = to_minor(amount)
         cursor.execute(
-            'UPDATE users SET balance = balance + ? WHERE user_id = ?',
-            (amount, user_id)
+            f'UPDATE users SET balance_minor = balance_minor + ?, balance = (balance_minor + ?) / {MINOR_UNITS}.0 WHERE user_id = ?',
+            (minor, minor, user_id)
         )
         conn.commit()
+        _user_cache.invalidate(user_id)
         return True
     except sqlite3.Error as e:
+        conn.rollback()
         logger.error(f"Error updating balance: {e}")
         return False
-    finally:
-        conn.close()
 
+@timed_query
 def reset_user_progress(user_id):
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -147,18 +379,19 @@ def reset_user_progress(user_id):
             (user_id,)
         )
         conn.commit()
+        _user_cache.invalidate(user_id)
         return True
     except sqlite3.Error as e:
+        conn.rollback()
         logger.error(f"Error resetting user progress: {e}")
         return False
-    finally:
-        conn.close()
 
 # Transaction helpers
 def create_transaction(conn, user_id, amount_mat, dest_wallet, status='pending'):
     cur = conn.cursor()
-    cur.execute('INSERT INTO transactions (user_id, amount_mat, dest_wallet, status) VALUES (?, ?, ?, ?)',
-                (user_id, float(amount_mat), dest_wallet, status))
+    minor = to_minor(amount_mat)
+    cur.execute('INSERT INTO transactions (user_id, amount_mat, amount_minor, dest_wallet, status) VALUES (?, ?, ?, ?, ?)',
+                (user_id, minor / MINOR_UNITS, minor, dest_wallet, status))
     return cur.lastrowid
 
 def update_transaction_status(conn, tx_id, status, tx_hash=None):
@@ -168,3 +401,283 @@ def update_transaction_status(conn, tx_id, status, tx_hash=None):
     else:
         cur.execute('UPDATE transactions SET status=? WHERE tx_id=?', (status, tx_id))
     conn.commit()
+
+@timed_query
+def create_withdrawal(user_id, amount_mat, dest_wallet):
+    """Deduct amount_mat from the user's balance and record a pending payout in
+    one transaction. Returns the new tx_id or None on failure."""
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        minor = to_minor(amount_mat)
+        cur = conn.execute(f'UPDATE users SET balance_minor = balance_minor - ?, balance = (balance_minor - ?) / {MINOR_UNITS}.0 '
+                           'WHERE user_id = ? AND balance_minor >= ?',
+                           (minor, minor, user_id, minor))
+        if cur.rowcount != 1:
+            # Balance changed since it was read (e.g. a double-tapped withdraw)
+            conn.rollback()
+            return None
+        tx_id = create_transaction(conn, user_id, amount_mat, dest_wallet, status='pending')
+        conn.commit()
+        _user_cache.invalidate(user_id)
+        return tx_id
+    except sqlite3.Error as e:
+        conn.rollback()
+        logger.error(f"Error creating withdrawal: {e}")
+        return None
+
+@timed_query
+def get_transaction(tx_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM transactions WHERE tx_id = ?', (tx_id,))
+    tx = cursor.fetchone()
+    return tx
+
+@timed_query
+def get_transactions_by_status(*statuses):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # One `status = ?` branch per status so each uses its partial index;
+    # SQLite can't match `status IN (...)` against them
+    query = ' UNION ALL '.join(['SELECT * FROM transactions WHERE status = ?'] * len(statuses))
+    cursor.execute(f'{query} ORDER BY tx_id', statuses)
+    rows = cursor.fetchall()
+    return rows
+
+@timed_query
+def claim_transaction(tx_id, from_status, to_status, tx_hash=None, nonce=None, cancel_hash=None):
+    """Move a transaction between states only if it is still in from_status.
+    A new tx_hash is also appended to tx_hashes (see sent_hashes).
+    Returns True if this caller won the transition."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            '''UPDATE transactions SET status = ?1, tx_hash = COALESCE(?2, tx_hash), nonce = COALESCE(?3, nonce),
+                cancel_hash = COALESCE(?4, cancel_hash), updated_at = CURRENT_TIMESTAMP,
+                tx_hashes = CASE
+                    WHEN ?2 IS NULL THEN tx_hashes
+                    WHEN tx_hashes IS NULL THEN ?2
+                    WHEN instr(',' || tx_hashes || ',', ',' || ?2 || ',') THEN tx_hashes
+                    ELSE tx_hashes || ',' || ?2 END
+            WHERE tx_id = ?5 AND status = ?6''',
+            (to_status, tx_hash, nonce, cancel_hash, tx_id, from_status)
+        )
+        conn.commit()
+        return cursor.rowcount == 1
+    except sqlite3.Error as e:
+        conn.rollback()
+        logger.error(f"Error updating transaction {tx_id}: {e}")
+        return False
+
+def sent_hashes(tx):
+    """Every hash sent for a transaction row, oldest first: the original
+    and each fee-bump replacement."""
+    if tx['tx_hashes']:
+        return tx['tx_hashes'].split(',')
+    return [tx['tx_hash']] if tx['tx_hash'] else []
+
+@timed_query
+def fail_transaction(tx_id, from_status=None):
+    """Mark a payout failed and give the amount back to the user atomically.
+    With from_status, only a payout still in that state is failed."""
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        tx = conn.execute('SELECT user_id, amount_minor, status FROM transactions WHERE tx_id = ?', (tx_id,)).fetchone()
+        if tx is None or tx['status'] in ('completed', 'failed') or (from_status and tx['status'] != from_status):
+            conn.rollback()
+            return False
+        conn.execute(f'UPDATE users SET balance_minor = balance_minor + ?, balance = (balance_minor + ?) / {MINOR_UNITS}.0 WHERE user_id = ?',
+                     (tx['amount_minor'], tx['amount_minor'], tx['user_id']))
+        conn.execute("UPDATE transactions SET status = 'failed', updated_at = CURRENT_TIMESTAMP WHERE tx_id = ?", (tx_id,))
+        conn.commit()
+        _user_cache.invalidate(tx['user_id'])
+        return True
+    except sqlite3.Error as e:
+        conn.rollback()
+        logger.error(f"Error failing transaction {tx_id}: {e}")
+        return False
+
+
+class _PendingCredit:
+    __slots__ = ('user_id', 'reason', 'amount', 'referrals', 'wallet_address', 'referee_id', 'done', 'ok', 'notify')
+
+    def __init__(self, user_id, reason, amount, referrals, wallet_address, referee_id, notify=None):
+        self.user_id = user_id
+        self.reason = reason
+        self.amount = amount
+        self.referrals = referrals
+        self.wallet_address = wallet_address
+        self.referee_id = referee_id
+        self.done = threading.Event()
+        self.ok = False
+        # Called from the flusher once done is set (used by submit_many_async)
+        self.notify = notify
+
+
+class CreditBatcher:
+    """Group commit for reward credits.
+
+    Callers queue a credit and block until it is committed. A background
+    thread flushes every CREDIT_FLUSH_MS or CREDIT_FLUSH_EVENTS credits,
+    whichever comes first, in a single transaction: one ledger row per credit
+    plus one merged UPDATE per user, so five referrals to the same referrer
+    cost one UPDATE and the whole batch costs one fsync. Referral credits also
+    store their referrer->referee edge and the referrer's leaderboard count in
+    the same transaction; one whose referee already has an edge is skipped, so
+    a referee is only ever paid for once. Likewise a registration credit for a
+    user who is already registered is skipped. A credit is only reported as
+    saved once its ledger row is on disk, and callers give up after
+    CREDIT_TIMEOUT seconds. Coroutines use submit_many_async, which waits
+    for the flush without holding a thread."""
+
+    def __init__(self, flush_ms=None, max_events=None, timeout=None):
+        self.flush_interval = (flush_ms or config.CREDIT_FLUSH_MS) / 1000
+        self.max_events = max_events or config.CREDIT_FLUSH_EVENTS
+        self.timeout = timeout or config.CREDIT_TIMEOUT
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, user_id, reason, amount, referrals=0, wallet_address=None, referee_id=None):
+        return self.submit_many([(user_id, reason, amount, referrals, wallet_address, referee_id)])
+
+    def submit_many(self, credits):
+        """Queue (user_id, reason, amount, referrals, wallet_address,
+        referee_id) tuples together, so they are committed in the same flush.
+        Returns True if they were saved."""
+        batch = self._enqueue(credits)
+        deadline = time.monotonic() + self.timeout
+        for credit in batch:
+            if not credit.done.wait(max(0, deadline - time.monotonic())):
+                return self._abandon(batch)
+        return all(credit.ok for credit in batch)
+
+    async def submit_many_async(self, credits):
+        """submit_many for the event loop: the flusher wakes the waiting
+        coroutine instead of a blocked thread."""
+        loop = asyncio.get_running_loop()
+        flushed = asyncio.Event()
+        batch = self._enqueue(credits, lambda: loop.call_soon_threadsafe(flushed.set))
+        try:
+            await asyncio.wait_for(flushed.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            return self._abandon(batch)
+        return all(credit.ok for credit in batch)
+
+    def _enqueue(self, credits, notify=None):
+        batch = [_PendingCredit(u, r, to_minor(a), n, w, e, notify) for u, r, a, n, w, e in credits]
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="credit-batcher", daemon=True)
+                self._thread.start()
+            self._pending.extend(batch)
+            # Wake the flusher for the first credits of a batch and when it is full
+            if len(self._pending) == len(batch) or len(self._pending) >= self.max_events:
+                self._cond.notify()
+        return batch
+
+    def _abandon(self, batch):
+        with self._cond:
+            # Credits the flusher has not taken yet are dropped and never saved
+            taken = [c for c in batch if c not in self._pending]
+            self._pending = [c for c in self._pending if c not in batch]
+        if taken:
+            logger.error(f"Credits for users {sorted({c.user_id for c in taken})} not committed after "
+                         f"{self.timeout}s; they may still be saved")
+        return False
+
+    def _run(self):
+        conn = get_db_connection()
+        # One fsync per flush, so every acknowledged credit survives power loss
+        conn.execute('PRAGMA synchronous = FULL')
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                if len(self._pending) < self.max_events:
+                    # Give the batch time to fill
+                    self._cond.wait(self.flush_interval)
+                batch, self._pending = self._pending, []
+            try:
+                with DB_SECONDS.time(helper='credit_flush'):
+                    self._flush(conn, batch)
+            except Exception as e:
+                # Keep flushing: every later credit waits on this thread
+                logger.exception(f"Credit flush crashed: {e}")
+            finally:
+                for credit in batch:
+                    credit.done.set()
+                for credit in batch:
+                    if credit.notify is not None:
+                        try:
+                            credit.notify()
+                        except Exception as e:
+                            # e.g. the caller's event loop has been closed
+                            logger.error(f"Could not wake the caller of credit for user {credit.user_id}: {e}")
+
+    def _flush(self, conn, batch):
+        ok = False
+        try:
+            credits = []
+            for credit in batch:
+                if credit.wallet_address is not None:
+                    cursor = conn.execute('UPDATE users SET wallet_address = ?, registered = 1 WHERE user_id = ? AND registered = 0',
+                                          (credit.wallet_address, credit.user_id))
+                    if not cursor.rowcount:
+                        # A second confirm of the same registration
+                        logger.warning(f"Skipping registration credit of user {credit.user_id}: already registered")
+                        continue
+                if credit.referee_id is not None:
+                    cursor = conn.execute('INSERT OR IGNORE INTO referrals (referee_id, referrer_id) VALUES (?, ?)',
+                                          (credit.referee_id, credit.user_id))
+                    if not cursor.rowcount:
+                        # Each referee pays one referral; this one already did
+                        logger.warning(f"Skipping referral credit of user {credit.user_id}: "
+                                       f"user {credit.referee_id} was already referred")
+                        continue
+                credits.append(credit)
+
+            merged = {}
+            for credit in credits:
+                totals = merged.setdefault(credit.user_id, [0, 0, 0])
+                totals[0] += credit.amount
+                totals[1] += credit.referrals
+                if credit.reason == 'referral':
+                    totals[2] += credit.amount
+
+            conn.executemany(
+                'INSERT INTO credits (user_id, reason, amount_mat, amount_minor) VALUES (?, ?, ?, ?)',
+                [(c.user_id, c.reason, c.amount / MINOR_UNITS, c.amount) for c in credits]
+            )
+            conn.executemany(
+                f'''UPDATE users SET
+                    balance_minor = balance_minor + ?1, balance = (balance_minor + ?1) / {MINOR_UNITS}.0,
+                    earned_minor = earned_minor + ?2, earned_from_referrals = (earned_minor + ?2) / {MINOR_UNITS}.0,
+                    referrals = referrals + ?3
+                WHERE user_id = ?4''',
+                [(balance, earned, referrals, user_id) for user_id, (balance, referrals, earned) in merged.items()]
+            )
+            referred = [(user_id, referrals) for user_id, (_, referrals, _) in merged.items() if referrals]
+            if referred:
+                conn.executemany(
+                    'INSERT INTO referral_leaderboard (user_id, referrals) VALUES (?, ?) '
+                    'ON CONFLICT(user_id) DO UPDATE SET referrals = referrals + excluded.referrals',
+                    referred
+                )
+            conn.commit()
+            _user_cache.invalidate(*merged)
+            for user_id, referrals in referred:
+                referral_leaderboard.add(user_id, referrals)
+            ok = True
+        except Exception as e:
+            # Not only sqlite3.Error: a bad value raises e.g. OverflowError
+            conn.rollback()
+            logger.error(f"Error flushing {len(batch)} credits: {e}")
+        for credit in batch:
+            credit.ok = ok
+
+
+credit_batcher = CreditBatcher()
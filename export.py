@@ -0,0 +1,245 @@
+"""Export users, transactions and credits for accounting and audits.
+
+    python export.py transactions                   # CSV, everything
+    python export.py transactions --incremental     # only rows added since the last run
+    python export.py users --format parquet         # needs pyarrow
+    python export.py snapshot backup.db             # consistent copy of the database
+
+Rows are read from a read-only connection inside one transaction, so the
+whole export sees a single WAL snapshot while the bot keeps writing, and are
+paged by primary key (EXPORT_PAGE_SIZE rows per query), so memory use does
+not grow with the table. Output is split into files of at most
+EXPORT_CHUNK_ROWS rows. With --incremental only rows after the watermark
+(the last exported key, kept next to the files) are exported. Rows that can
+still change are not covered by it: the transactions watermark stops just
+before the oldest payout still pending, processing or submitted, so that row
+and those after it are exported again (keep the newest copy of each tx_id)
+until it settles. users rows change at any time, so export them in full."""
+import argparse
+import csv
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+import config
+from database import DB_PATH
+
+logger = logging.getLogger(__name__)
+
+# Exported tables and their keyset column
+TABLES = {
+    'users': 'user_id',
+    'transactions': 'tx_id',
+    'credits': 'credit_id',
+}
+
+# Statuses of rows that will still change; the watermark stops before them
+OPEN_STATUSES = {
+    'transactions': ('pending', 'processing', 'submitted'),
+}
+
+
+def open_snapshot(path=None):
+    """A read-only connection with an open read transaction. Every query on it
+    sees the database as it was at its first read, until it is closed."""
+    conn = sqlite3.connect(f'file:{path or DB_PATH}?mode=ro', uri=True, isolation_level=None)
+    conn.execute('PRAGMA query_only = ON')
+    conn.execute('BEGIN')
+    # The snapshot starts with the first read, not with BEGIN
+    conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+    return conn
+
+
+def iter_pages(conn, table, after=0, page_size=None):
+    """Yield (columns, rows) pages of rows with key > after, in key order."""
+    key = TABLES[table]
+    page_size = page_size or config.EXPORT_PAGE_SIZE
+    while True:
+        cursor = conn.execute(f'SELECT * FROM {table} WHERE {key} > ? ORDER BY {key} LIMIT ?', (after, page_size))
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        columns = [d[0] for d in cursor.description]
+        after = rows[-1][columns.index(key)]
+        yield columns, rows
+
+
+def first_open_key(conn, table, after=0):
+    """The lowest key above after whose row can still change, or None."""
+    key = TABLES[table]
+    # One query per status, so each uses that status's partial index
+    keys = [conn.execute(f'SELECT MIN({key}) FROM {table} WHERE status = ? AND {key} > ?', (status, after)).fetchone()[0]
+            for status in OPEN_STATUSES.get(table, ())]
+    keys = [k for k in keys if k is not None]
+    return min(keys) if keys else None
+
+
+class CsvWriter:
+    extension = 'csv'
+
+    def __init__(self, path, columns, table_info, compress=False):
+        self.path = path + ('.gz' if compress else '')
+        self._file = gzip.open(self.path, 'wt', newline='') if compress else open(self.path, 'w', newline='')
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(columns)
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    """One row group per page, zstd compressed. Column types come from the
+    table's declared types, since SQLite values carry none of their own."""
+    extension = 'parquet'
+
+    def __init__(self, path, columns, table_info, compress=True):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Parquet export needs pyarrow: pip install pyarrow")
+        self._pa = pa
+        declared = {name: decl.upper() for name, decl in table_info}
+        self.schema = pa.schema([(name, self._arrow_type(declared.get(name, ''))) for name in columns])
+        self.path = path
+        self._writer = pq.ParquetWriter(path, self.schema, compression='zstd' if compress else 'none')
+
+    def _arrow_type(self, declared):
+        pa = self._pa
+        if 'INT' in declared:
+            return pa.int64()
+        if any(t in declared for t in ('REAL', 'FLOA', 'DOUB')):
+            return pa.float64()
+        return pa.string()
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        arrays = [self._pa.array(values, type=field.type) for values, field in zip(columns, self.schema)]
+        self._writer.write_table(self._pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self._writer.close()
+
+
+WRITERS = {'csv': CsvWriter, 'parquet': ParquetWriter}
+
+
+def _watermark_path(out_dir, table):
+    return os.path.join(out_dir, f'{table}.watermark.json')
+
+
+def read_watermark(out_dir, table):
+    try:
+        with open(_watermark_path(out_dir, table)) as f:
+            return json.load(f)['last_key']
+    except FileNotFoundError:
+        return 0
+
+
+def write_watermark(out_dir, table, last_key, files):
+    # Written only after every file is complete, and replaced atomically, so
+    # an interrupted export is simply repeated by the next run
+    path = _watermark_path(out_dir, table)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'last_key': last_key, 'exported_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                   'files': files}, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def export_table(table, out_dir=None, fmt='csv', incremental=False, after=None, chunk_rows=None,
+                 page_size=None, compress=False, db_path=None):
+    """Export rows of `table` with a key above the watermark (or `after`).
+    Returns (files, rows, last_key), where last_key is the new watermark."""
+    out_dir = out_dir or config.EXPORT_DIR
+    chunk_rows = chunk_rows or config.EXPORT_CHUNK_ROWS
+    writer_class = WRITERS[fmt]
+    os.makedirs(out_dir, exist_ok=True)
+    if after is None:
+        after = read_watermark(out_dir, table) if incremental else 0
+
+    conn = open_snapshot(db_path)
+    try:
+        table_info = [(row[1], row[2]) for row in conn.execute(f'PRAGMA table_info({table})')]
+        key_index = [name for name, _ in table_info].index(TABLES[table])
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+        files = []
+        writer = None
+        written = total = 0
+        last_key = after
+        for columns, rows in iter_pages(conn, table, after, page_size):
+            while rows:
+                if writer is None or written >= chunk_rows:
+                    if writer is not None:
+                        writer.close()
+                    base = os.path.join(out_dir, f'{table}-{stamp}-{len(files) + 1:04d}.{writer_class.extension}')
+                    writer = writer_class(base, columns, table_info, compress)
+                    files.append(os.path.basename(writer.path))
+                    written = 0
+                part, rows = rows[:chunk_rows - written], rows[chunk_rows - written:]
+                writer.write(part)
+                written += len(part)
+                total += len(part)
+                last_key = part[-1][key_index]
+        if writer is not None:
+            writer.close()
+        open_key = first_open_key(conn, table, after)
+        if open_key is not None and open_key <= last_key:
+            # Exported, but not final: the next run exports it again
+            last_key = open_key - 1
+    finally:
+        conn.close()
+
+    if files:
+        write_watermark(out_dir, table, last_key, files)
+    logger.info(f"Exported {total} {table} rows to {len(files)} file(s) in {out_dir}")
+    return files, total, last_key
+
+
+def snapshot(dest, db_path=None):
+    """Write a consistent, compacted copy of the database to dest. Runs in a
+    read transaction, so the bot keeps writing meanwhile."""
+    if os.path.exists(dest):
+        raise SystemExit(f"{dest} already exists")
+    conn = sqlite3.connect(f'file:{db_path or DB_PATH}?mode=ro', uri=True)
+    try:
+        conn.execute('VACUUM INTO ?', (dest,))
+    finally:
+        conn.close()
+    logger.info(f"Database snapshot written to {dest}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export tables or snapshot the database without blocking the bot.')
+    parser.add_argument('what', choices=sorted(TABLES) + ['snapshot'])
+    parser.add_argument('dest', nargs='?', help='snapshot: path of the copy')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='csv')
+    parser.add_argument('--out', help=f'output directory (default {config.EXPORT_DIR})')
+    parser.add_argument('--incremental', action='store_true', help='only rows after the saved watermark')
+    parser.add_argument('--after', type=int, help='only rows with a key above this one')
+    parser.add_argument('--chunk-rows', type=int, help='rows per output file')
+    parser.add_argument('--gzip', action='store_true', help='gzip CSV files')
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    if args.what == 'snapshot':
+        if not args.dest:
+            parser.error('snapshot needs a destination path')
+        snapshot(args.dest)
+        return 0
+    files, total, last_key = export_table(
+        args.what, args.out, args.format, args.incremental, args.after, args.chunk_rows,
+        compress=args.gzip or args.format == 'parquet')
+    for name in files:
+        print(name)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import logging
+import statistics
+import threading
+
+from web3 import Web3
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class GasOracle:
+    """Rolling EIP-1559 fee estimate shared by all payouts.
+
+    A background thread refreshes the estimate from eth_feeHistory every
+    GAS_REFRESH_INTERVAL seconds, so building a transaction never waits on a
+    fee RPC. Chains without a base fee fall back to a legacy gasPrice of
+    GAS_PRICE_GWEI."""
+
+    def __init__(self, w3):
+        self.w3 = w3
+        self._lock = threading.Lock()
+        self._fees = None
+        self._gas_limits = {}
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.refresh()
+        self._thread = threading.Thread(target=self._run, name="gas-oracle", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(config.GAS_REFRESH_INTERVAL):
+            self.refresh()
+
+    def refresh(self):
+        try:
+            history = self.w3.eth.fee_history(config.GAS_HISTORY_BLOCKS, 'latest', [config.GAS_PRIORITY_PERCENTILE])
+            # The last entry is the base fee of the next block
+            base_fee = history['baseFeePerGas'][-1]
+            rewards = [r[0] for r in history.get('reward', []) if r]
+            priority = int(statistics.median(rewards)) if rewards else 0
+        except Exception as e:
+            logger.warning(f"Fee history unavailable, using legacy gas price: {e}")
+            base_fee = None
+
+        floor = Web3.to_wei(config.GAS_PRICE_GWEI, 'gwei')
+        if not base_fee:
+            # No base fee (or a zero one, as on BSC): price everything as priority
+            fees = {'gasPrice': max(floor, self._legacy_gas_price())}
+        else:
+            priority = max(priority, Web3.to_wei(config.GAS_MIN_PRIORITY_GWEI, 'gwei'))
+            fees = {
+                'maxPriorityFeePerGas': priority,
+                # Twice the base fee covers six full blocks of base fee growth
+                'maxFeePerGas': 2 * base_fee + priority,
+            }
+        with self._lock:
+            self._fees = self._cap(fees)
+
+    def _legacy_gas_price(self):
+        try:
+            return self.w3.eth.gas_price
+        except Exception:
+            return 0
+
+    def _cap(self, fees):
+        cap = Web3.to_wei(config.GAS_MAX_GWEI, 'gwei')
+        return {k: min(v, cap) for k, v in fees.items()}
+
+    def fees(self):
+        """Fee fields for a new transaction."""
+        with self._lock:
+            fees = self._fees
+        if fees is None:
+            self.refresh()
+            with self._lock:
+                fees = self._fees
+        return dict(fees)
+
+    def bump(self, previous):
+        """Fee fields for a replacement of a transaction sent with previous.
+        Nodes only accept a replacement that raises every fee by at least 10%."""
+        current = self.fees()
+        factor = 100 + config.GAS_BUMP_PERCENT
+        bumped = {}
+        for key, value in previous.items():
+            bumped[key] = max(current.get(key, 0), value * factor // 100 + 1)
+        return self._cap(bumped)
+
+    def gas_limit(self, shape, estimate):
+        """Gas limit for a transaction shape, estimated once with estimate()
+        and reused for every later transaction of the same shape."""
+        limit = self._gas_limits.get(shape)
+        if limit is None:
+            limit = int(estimate() * 1.2)
+            self._gas_limits[shape] = limit
+            logger.info(f"Cached gas limit {limit} for {shape}")
+        return limit
@@ -0,0 +1,308 @@
+"""Update handlers shared by the threaded (bot.py) and asyncio (async_bot.py)
+runtimes, and the objects they use: outbox, conversation state, payout queue,
+broadcaster and reconciler.
+
+The handlers are plain functions that block on SQLite and make their replies
+through the replies argument. bot.py passes the outbox, which queues them;
+async_bot.py runs the handlers on its SQLite executor with an outbox.Replies
+and awaits the sends on the event loop. Registration is split around
+abuse.register (confirmed_wallet, then wallet_registered) so async_bot.py
+can await the credit instead of blocking an executor thread on it."""
+import logging
+from decimal import Decimal
+
+import telebot
+
+from database import init_db, add_user, get_user, mark_tasks_completed, reset_user_progress, create_withdrawal, set_user_blocked, get_leaderboard, get_referral_stats, count_recent_referrals
+from config import BOT_TOKEN, MIN_WITHDRAWAL
+from payouts import PayoutQueue
+from outbox import Outbox, HIGH
+from broadcast import Broadcaster
+from reconciler import Reconciler
+import config
+import metadata
+import metrics
+import abuse
+from state_store import create_state_store
+from wallets import validate as validate_wallet
+from messages import (
+    REGISTER_FIRST, CHOOSE_OPTION, BROADCAST_USAGE, DB_ERROR, TASKS_VERIFIED, WALLET_SAVE_ERROR, WALLET_NOT_FOUND, WALLET_AGAIN, REF_COPIED,
+    HELP_TEXT, AIRDROP_TASKS_TEXT, MAIN_MENU_KEYBOARD, TASKS_KEYBOARD, REGISTRATION_SUCCESS_KEYBOARD, CONFIRM_WALLET_KEYBOARD,
+    menu_action, welcome_text, already_registered_text, registration_success_text, registration_held_text, confirm_wallet_text, invalid_wallet_text,
+    dashboard_text, referral_text, withdraw_minimum_text, withdraw_processing_text, withdraw_success_text, withdraw_failed_text,
+    broadcast_started_text, leaderboard_text,
+)
+
+logger = logging.getLogger(__name__)
+
+COMMANDS = ['start', 'help', 'dashboard', 'withdraw', 'referral', 'leaderboard']
+
+# Bot API client for replies; updates are received by the runtime's own bot
+if config.BOT_API_URL:
+    telebot.apihelper.API_URL = config.BOT_API_URL
+client = telebot.TeleBot(BOT_TOKEN, threaded=False)
+
+# Replies are queued and sent within Telegram's rate limits
+outbox = Outbox(client)
+broadcaster = Broadcaster(outbox)
+
+# Initialize database
+init_db()
+
+metadata.register('bot_username', lambda: client.get_me().username)
+
+# Conversation state (registration step and wallet awaiting confirmation)
+states = create_state_store()
+
+def handle_commands(message, replies):
+    command = message.text.split()[0].lower()
+
+    if command == '/start':
+        start_command(message, replies)
+    elif command == '/help':
+        help_command(message, replies)
+    elif command == '/dashboard':
+        dashboard_command(message, replies)
+    elif command == '/withdraw':
+        withdraw_command(message, replies)
+    elif command == '/referral':
+        referral_command(message, replies)
+    elif command == '/leaderboard':
+        leaderboard_command(message, replies)
+
+def start_command(message, replies):
+    user_id = message.from_user.id
+    username = message.from_user.username or message.from_user.first_name
+
+    # Reset any existing state
+    states.clear(user_id)
+
+    # Check if this is a referral (start <referrer_id>)
+    referral_id = None
+    if message.text and len(message.text.split()) > 1:
+        try:
+            referral_id = int(message.text.split()[1])
+            logger.info(f"New user came from referral: {referral_id}")
+        except ValueError:
+            pass
+
+    # Register new user or get existing
+    user = get_user(user_id)
+    if user is None:
+        # The referrer is rewarded once this user has registered a wallet
+        if referral_id == user_id or (referral_id and not get_user(referral_id)):
+            referral_id = None
+        add_user(user_id, username, referral_id)
+    elif user['blocked']:
+        # Writing to the bot again means they unblocked it
+        set_user_blocked(user_id, False)
+
+    # Returning users get the same welcome text
+    replies.send_message(message.chat.id, welcome_text(username), reply_markup=MAIN_MENU_KEYBOARD)
+
+def help_command(message, replies):
+    replies.send_message(message.chat.id, HELP_TEXT, reply_markup=MAIN_MENU_KEYBOARD)
+
+def broadcast_command(message, replies):
+    if message.from_user.id not in config.ADMIN_IDS:
+        replies.send_message(message.chat.id, CHOOSE_OPTION, reply_markup=MAIN_MENU_KEYBOARD)
+        return
+    text = message.text.partition(' ')[2].strip()
+    if not text:
+        replies.send_message(message.chat.id, BROADCAST_USAGE)
+        return
+    broadcast_id = broadcaster.start(text)
+    replies.send_message(message.chat.id, broadcast_started_text(broadcast_id) if broadcast_id else DB_ERROR)
+
+def handle_text_messages(message, replies):
+    user_id = message.from_user.id
+    text = message.text.strip()
+
+    action = menu_action(text)
+
+    if action == 'join':
+        join_airdrop(message, replies)
+    elif action == 'dashboard':
+        dashboard_command(message, replies)
+    elif action == 'withdraw':
+        withdraw_command(message, replies)
+    elif action == 'referral':
+        referral_command(message, replies)
+    elif action == 'help':
+        help_command(message, replies)
+    elif states.get_state(user_id) == 'awaiting_wallet':
+        handle_wallet_input(message, replies)
+    else:
+        replies.send_message(message.chat.id, CHOOSE_OPTION, reply_markup=MAIN_MENU_KEYBOARD)
+
+def join_airdrop(message, replies):
+    user_id = message.from_user.id
+    user = get_user(user_id)
+
+    # Check if user is already registered
+    if user and user['registered']:
+        replies.send_message(message.chat.id, already_registered_text(user), reply_markup=MAIN_MENU_KEYBOARD)
+        return
+
+    # Reset user progress if they start again (but not registered yet)
+    reset_user_progress(user_id)
+    states.clear(user_id)
+
+    # Airdrop registration message
+    replies.send_message(message.chat.id, AIRDROP_TASKS_TEXT, reply_markup=TASKS_KEYBOARD)
+
+def button_handler(call, replies):
+    user_id = call.from_user.id
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+
+    if call.data in ('check_tasks', 'confirm_wallet_no') and already_registered(call, replies):
+        return
+
+    if call.data == 'check_tasks':
+        # For demo purposes, we'll assume tasks are completed
+        mark_tasks_completed(user_id)
+        states.set_state(user_id, 'awaiting_wallet')
+
+        replies.edit_message_text(TASKS_VERIFIED, chat_id, message_id)
+
+    elif call.data == 'confirm_wallet_yes':
+        wallet_address = confirmed_wallet(call, replies)
+        if wallet_address:
+            # Save wallet address and credit the initial and referral rewards,
+            # unless the abuse checks hold them
+            wallet_registered(call, replies, *abuse.register(user_id, wallet_address))
+
+    elif call.data == 'confirm_wallet_no':
+        states.set_state(user_id, 'awaiting_wallet')
+        replies.edit_message_text(WALLET_AGAIN, chat_id, message_id)
+
+    elif call.data == 'dashboard':
+        dashboard_callback(call, replies)
+
+    elif call.data == 'withdraw':
+        # deprecated - kept for compatibility
+        withdraw_command(call.message, replies)
+
+    elif call.data == 'copy_ref':
+        replies.answer_callback_query(call.id, REF_COPIED, show_alert=True)
+
+def already_registered(call, replies):
+    """Refuse a registration button left over from a registration that
+    already went through."""
+    user = get_user(call.from_user.id)
+    if user and user['registered']:
+        states.clear(call.from_user.id)
+        replies.edit_message_text(already_registered_text(user), call.message.chat.id, call.message.message_id)
+        return True
+    return False
+
+def confirmed_wallet(call, replies):
+    """The wallet a confirm_wallet_yes button registers, or None if there is
+    nothing to register."""
+    if already_registered(call, replies):
+        return None
+    wallet_address = states.get_wallet(call.from_user.id)
+    if not wallet_address:
+        replies.edit_message_text(WALLET_NOT_FOUND, call.message.chat.id, call.message.message_id)
+    return wallet_address
+
+def wallet_registered(call, replies, ok, held):
+    """Reply to a confirm_wallet_yes once abuse.register has returned."""
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+    if ok:
+        text = registration_held_text if held else registration_success_text
+        replies.edit_message_text(text(call.from_user.first_name), chat_id, message_id, reply_markup=REGISTRATION_SUCCESS_KEYBOARD)
+
+        # Clear states
+        states.clear(call.from_user.id)
+    else:
+        replies.edit_message_text(WALLET_SAVE_ERROR, chat_id, message_id)
+
+def handle_wallet_input(message, replies):
+    user_id = message.from_user.id
+    ok, wallet_address = validate_wallet(message.text)
+    if not ok:
+        # Stay in awaiting_wallet so the next message is read as an address
+        replies.send_message(message.chat.id, invalid_wallet_text(wallet_address))
+        return
+
+    # Store the checksummed wallet for confirmation
+    states.set_wallet(user_id, wallet_address, 'confirm_wallet')
+
+    # Ask for confirmation
+    replies.send_message(message.chat.id, confirm_wallet_text(wallet_address), reply_markup=CONFIRM_WALLET_KEYBOARD)
+
+def dashboard_command(message, replies):
+    user = get_user(message.from_user.id)
+
+    # Check if user exists AND is registered
+    if user and user['registered']:
+        replies.send_message(message.chat.id, dashboard_text(user), reply_markup=MAIN_MENU_KEYBOARD)
+    else:
+        replies.send_message(message.chat.id, REGISTER_FIRST, reply_markup=MAIN_MENU_KEYBOARD)
+
+def dashboard_callback(call, replies):
+    user = get_user(call.from_user.id)
+
+    if user and user['registered']:
+        replies.edit_message_text(dashboard_text(user, with_commands=False), call.message.chat.id, call.message.message_id)
+    else:
+        replies.edit_message_text(REGISTER_FIRST, call.message.chat.id, call.message.message_id)
+
+def withdraw_command(message, replies):
+    user_id = message.from_user.id
+    user = get_user(user_id)
+
+    # Check if user is registered (has wallet address)
+    if not user or not user['registered'] or not user['wallet_address']:
+        replies.send_message(message.chat.id, REGISTER_FIRST, reply_markup=MAIN_MENU_KEYBOARD)
+        return
+
+    balance = Decimal(str(user['balance'] or 0))
+    if balance < Decimal(str(MIN_WITHDRAWAL)):
+        replies.send_message(message.chat.id, withdraw_minimum_text(balance), reply_markup=MAIN_MENU_KEYBOARD)
+        return
+
+    # Deduct full balance and queue the payout; a worker broadcasts it
+    tx_id = create_withdrawal(user_id, balance, user['wallet_address'])
+    if tx_id is None:
+        replies.send_message(message.chat.id, DB_ERROR, reply_markup=MAIN_MENU_KEYBOARD)
+        return
+
+    payout_queue.submit(tx_id)
+    replies.send_message(message.chat.id, withdraw_processing_text(balance))
+
+def referral_command(message, replies):
+    user_id = message.from_user.id
+    user = get_user(user_id)
+
+    if user:
+        try:
+            bot_username = metadata.get('bot_username')
+        except Exception:
+            bot_username = 'MATBot'
+        referral_link = f"https://t.me/{bot_username}?start={user_id}"
+        replies.send_message(message.chat.id, referral_text(user, referral_link), reply_markup=MAIN_MENU_KEYBOARD)
+    else:
+        replies.send_message(message.chat.id, REGISTER_FIRST, reply_markup=MAIN_MENU_KEYBOARD)
+
+def leaderboard_command(message, replies):
+    rows = get_leaderboard()
+    stats = get_referral_stats(message.from_user.id)
+    replies.send_message(message.chat.id, leaderboard_text(rows, stats, count_recent_referrals()), reply_markup=MAIN_MENU_KEYBOARD)
+
+def notify_payout(user_id, tx, ok, res):
+    balance = Decimal(str(tx['amount_mat']))
+    if ok:
+        outbox.send_message(user_id, withdraw_success_text(balance, res), priority=HIGH, reply_markup=MAIN_MENU_KEYBOARD)
+    else:
+        outbox.send_message(user_id, withdraw_failed_text(res), priority=HIGH, reply_markup=MAIN_MENU_KEYBOARD)
+
+# Shard workers replace payout_queue with a channel to the parent process
+payout_queue = PayoutQueue(notify_payout)
+reconciler = Reconciler(notify_payout, payout_queue)
+
+metrics.PAYOUT_QUEUE_DEPTH.set_function(payout_queue.qsize)
+metrics.register_stats('mat_outbox', outbox.stats)
@@ -0,0 +1,152 @@
+import random
+import threading
+
+MAX_LEVEL = 32  # enough for 2**32 entries
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        # width[i]: how many entries next[i] is ahead of this node
+        self.width = [1] * level
+
+
+class _SkipList:
+    """Indexable skip list of unique, comparable keys. insert, remove and
+    rank (the number of smaller keys) take O(log n) expected time, and the
+    smallest keys are read in order from the bottom level."""
+
+    def __init__(self, keys=()):
+        self._head = _Node(None, MAX_LEVEL)
+        self._size = 0
+        self._build(keys)
+
+    @staticmethod
+    def _level():
+        level = 1
+        while level < MAX_LEVEL and random.random() < 0.5:
+            level += 1
+        return level
+
+    def _build(self, keys):
+        # keys are sorted: link each level left to right in one pass
+        last = [self._head] * MAX_LEVEL
+        last_pos = [0] * MAX_LEVEL
+        pos = 0
+        for pos, key in enumerate(keys, 1):
+            node = _Node(key, self._level())
+            for i in range(len(node.next)):
+                last[i].next[i] = node
+                last[i].width[i] = pos - last_pos[i]
+                last[i], last_pos[i] = node, pos
+        for i in range(MAX_LEVEL):
+            last[i].width[i] = pos + 1 - last_pos[i]
+        self._size = pos
+
+    def _path(self, key):
+        """The last node before key on every level, and the rank of each."""
+        chain = [None] * MAX_LEVEL
+        ranks = [0] * MAX_LEVEL
+        node, rank = self._head, 0
+        for i in reversed(range(MAX_LEVEL)):
+            while node.next[i] is not None and node.next[i].key < key:
+                rank += node.width[i]
+                node = node.next[i]
+            chain[i], ranks[i] = node, rank
+        return chain, ranks
+
+    def insert(self, key):
+        chain, ranks = self._path(key)
+        node = _Node(key, self._level())
+        rank = ranks[0] + 1
+        for i in range(len(node.next)):
+            prev = chain[i]
+            node.next[i] = prev.next[i]
+            prev.next[i] = node
+            node.width[i] = prev.width[i] - (rank - ranks[i]) + 1
+            prev.width[i] = rank - ranks[i]
+        for i in range(len(node.next), MAX_LEVEL):
+            chain[i].width[i] += 1
+        self._size += 1
+
+    def remove(self, key):
+        chain, _ = self._path(key)
+        node = chain[0].next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for i in range(len(node.next)):
+            prev = chain[i]
+            prev.width[i] += node.width[i] - 1
+            prev.next[i] = node.next[i]
+        for i in range(len(node.next), MAX_LEVEL):
+            chain[i].width[i] -= 1
+        self._size -= 1
+
+    def rank(self, key):
+        return self._path(key)[1][0]
+
+    def first(self, limit):
+        keys = []
+        node = self._head.next[0]
+        while node is not None and len(keys) < limit:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+    def __len__(self):
+        return self._size
+
+
+class Leaderboard:
+    """Thread-safe ranking of users by a score, kept sorted as scores change.
+
+    Entries are stored as (-score, user_id) in an indexable skip list, so the
+    top k is a walk along its bottom level and a user's rank is one search.
+    A score change removes and inserts one entry, both O(log n). Users with
+    a score of zero are not stored."""
+
+    def __init__(self):
+        self._entries = _SkipList()
+        self._scores = {}
+        self._lock = threading.Lock()
+
+    def load(self, scores):
+        """Replace the contents with (user_id, score) pairs."""
+        with self._lock:
+            self._scores = {user_id: score for user_id, score in scores if score > 0}
+            self._entries = _SkipList(sorted((-score, user_id) for user_id, score in self._scores.items()))
+
+    def add(self, user_id, delta):
+        with self._lock:
+            old = self._scores.get(user_id, 0)
+            new = old + delta
+            if old > 0:
+                self._entries.remove((-old, user_id))
+            if new > 0:
+                self._entries.insert((-new, user_id))
+                self._scores[user_id] = new
+            else:
+                self._scores.pop(user_id, None)
+
+    def top(self, limit):
+        """The best `limit` users as (user_id, score), highest first. Ties go to
+        the lower user_id, i.e. the older account."""
+        with self._lock:
+            return [(user_id, -negative) for negative, user_id in self._entries.first(limit)]
+
+    def rank(self, user_id):
+        """(1-based rank, score) of a user, or None if their score is zero."""
+        with self._lock:
+            score = self._scores.get(user_id)
+            if score is None:
+                return None
+            return self._entries.rank((-score, user_id)) + 1, score
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'entries': len(self._entries)}
@@ -0,0 +1,619 @@
+"""Offline load test for bot.py.
+
+Replays synthetic Telegram traffic through the real handlers
+(handle_commands, handle_text_messages and button_handler) with a fake Bot
+API server standing in for Telegram and a stub JSON-RPC node standing in for
+BSC, then reports updates/s, handler latency and SQLite lock waits per
+scenario:
+
+    python loadtest.py --users 2000 --workers 8 --save before.json
+    python loadtest.py --users 2000 --workers 8 --compare before.json
+
+It runs in a temporary directory with its own database and a throwaway
+payout key, so nothing in .env or usdt_airdrop.db is touched. Scenarios run
+in order and each builds on the previous one: start (a /start storm, most
+with a referral), register (join, check_tasks, wallet, confirm), dashboard
+(menu, command, callback and leaderboard spam) and withdraw (every user withdraws, then
+the payouts are waited for)."""
+import argparse
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger('loadtest')
+
+BOT_TOKEN = '123456:loadtest'
+CHAIN_ID = 56
+FIRST_USER_ID = 10_000_000
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+# BEGIN IMMEDIATE takes a few microseconds when nobody holds the write lock
+LOCK_WAIT_THRESHOLD = 0.001
+SCENARIOS = ('start', 'register', 'dashboard', 'withdraw')
+
+
+def _serve(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+
+class FakeBotApi:
+    """Answers the Bot API methods the bot uses and counts the calls."""
+
+    def __init__(self):
+        self.calls = {}
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        api = self
+
+        class Handler(_QuietHandler):
+            def do_POST(self):
+                self._reply(api.handle(self.path, self._body()))
+
+            do_GET = do_POST
+
+        self.server = _serve(Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/bot{{0}}/{{1}}'
+
+    def handle(self, path, body):
+        url = urlparse(path)
+        method = url.path.rsplit('/', 1)[-1]
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        params.update({k: v[0] for k, v in parse_qs(body.decode(errors='replace')).items()})
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getMe':
+            return {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'MAT', 'username': 'MATLoadTestBot'}}
+        if method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id') or 0)
+            return {'ok': True, 'result': {
+                'message_id': int(params.get('message_id') or next(self._message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'MAT'},
+                'text': params.get('text', ''),
+            }}
+        return {'ok': True, 'result': True}
+
+
+class StubChain:
+    """A JSON-RPC node that mines every sent transaction into the next block,
+    one block per block_time seconds. Enough for the payout path: nonces,
+    gas, decimals, raw transaction broadcast, blocks and receipts."""
+
+    def __init__(self, block_time):
+        self.block_time = block_time
+        self.head = 1
+        self.blocks = {1: []}
+        self.mined = {}     # tx_hash -> block number
+        self.mempool = []
+        self.nonce = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+        chain = self
+
+        class Handler(_QuietHandler):
+            def do_POST(self):
+                request = json.loads(self._body())
+                if isinstance(request, list):
+                    self._reply([chain.handle(r) for r in request])
+                else:
+                    self._reply(chain.handle(request))
+
+        self.server = _serve(Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self._mine, daemon=True).start()
+
+    def _mine(self):
+        while True:
+            time.sleep(self.block_time)
+            with self._lock:
+                self.head += 1
+                self.blocks[self.head] = self.mempool
+                for h in self.mempool:
+                    self.mined[h] = self.head
+                self.mempool = []
+
+    def handle(self, request):
+        with self._lock:
+            self.requests += 1
+            try:
+                result = self._call(request['method'], request.get('params') or [])
+            except KeyError:
+                return {'jsonrpc': '2.0', 'id': request.get('id'),
+                        'error': {'code': -32601, 'message': f"the method {request['method']} does not exist"}}
+        return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+
+    def _block(self, number):
+        return {
+            'number': hex(number), 'hash': f'0x{number:064x}', 'parentHash': f'0x{number - 1:064x}',
+            'timestamp': hex(int(time.time())), 'gasLimit': hex(140_000_000), 'gasUsed': '0x0',
+            'baseFeePerGas': '0x0', 'miner': '0x' + '00' * 20, 'transactions': list(self.blocks[number]),
+        }
+
+    def _receipt(self, tx_hash):
+        number = self.mined.get(tx_hash)
+        if number is None:
+            return None
+        return {
+            'transactionHash': tx_hash, 'transactionIndex': '0x0', 'blockNumber': hex(number),
+            'blockHash': f'0x{number:064x}', 'status': '0x1', 'gasUsed': hex(52_000),
+            'cumulativeGasUsed': hex(52_000), 'effectiveGasPrice': hex(5 * 10**9), 'logs': [],
+            'contractAddress': None, 'type': '0x0',
+        }
+
+    def _call(self, method, params):
+        if method == 'eth_chainId':
+            return hex(CHAIN_ID)
+        if method == 'eth_blockNumber':
+            return hex(self.head)
+        if method == 'eth_getBlockByNumber':
+            number = self.head if params[0] in ('latest', 'pending', 'safe', 'finalized') else int(params[0], 16)
+            return self._block(number) if number in self.blocks else None
+        if method == 'eth_getTransactionCount':
+            return hex(self.nonce)
+        if method in ('eth_gasPrice', 'eth_maxPriorityFeePerGas'):
+            return hex(5 * 10**9) if method == 'eth_gasPrice' else '0x0'
+        if method == 'eth_feeHistory':
+            # BSC has no base fee, so the gas oracle prices transactions as legacy
+            count = int(params[0], 16) if isinstance(params[0], str) else int(params[0])
+            return {'oldestBlock': hex(max(1, self.head - count + 1)), 'baseFeePerGas': ['0x0'] * (count + 1),
+                    'gasUsedRatio': [0.5] * count, 'reward': [['0x0']] * count}
+        if method == 'eth_call':
+            # decimals() of an 18 decimal token
+            return '0x' + '00' * 31 + '12'
+        if method == 'eth_estimateGas':
+            return hex(52_000)
+        if method == 'eth_sendRawTransaction':
+            from web3 import Web3
+            tx_hash = Web3.to_hex(Web3.keccak(hexstr=params[0]))
+            self.nonce += 1
+            self.mempool.append(tx_hash)
+            return tx_hash
+        if method == 'eth_getTransactionReceipt':
+            return self._receipt(params[0].lower())
+        if method == 'eth_getTransactionByHash':
+            tx_hash = params[0].lower()
+            if tx_hash not in self.mined and tx_hash not in self.mempool:
+                return None
+            number = self.mined.get(tx_hash)
+            return {'hash': tx_hash, 'blockNumber': hex(number) if number else None}
+        raise KeyError(method)
+
+
+class LockTimer:
+    """Collects how long write transactions waited for SQLite's write lock."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.writes = 0
+            self.waits = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def record(self, seconds):
+        with self._lock:
+            self.writes += 1
+            if seconds >= LOCK_WAIT_THRESHOLD:
+                self.waits += 1
+                self.wait_total += seconds
+                self.wait_max = max(self.wait_max, seconds)
+
+
+class _TimedConnection:
+    """Wraps a sqlite3 connection so every write transaction starts with a
+    timed BEGIN IMMEDIATE. That statement blocks (up to DB_BUSY_TIMEOUT) while
+    another connection holds the write lock, so its duration is the lock wait
+    the helper would otherwise have paid inside its first write. Reads are
+    untouched."""
+
+    def __init__(self, conn, timer):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_timer', timer)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self._conn.__exit__(*exc)
+
+    def _begin(self, sql):
+        if self._conn.in_transaction:
+            return False
+        head = sql.lstrip()[:7].upper()
+        if head.startswith('BEGIN'):
+            return True
+        if head.startswith(WRITE_STATEMENTS):
+            started = time.perf_counter()
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._timer.record(time.perf_counter() - started)
+        return False
+
+    def _run(self, target, sql, *args):
+        if not self._begin(sql):
+            return target(sql, *args)
+        # An explicit BEGIN: its own duration is the wait
+        started = time.perf_counter()
+        try:
+            return target(sql, *args)
+        finally:
+            self._timer.record(time.perf_counter() - started)
+
+    def execute(self, sql, *args):
+        return self._run(self._conn.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._run(self._conn.executemany, sql, *args)
+
+    def cursor(self, *args):
+        return _TimedCursor(self._conn.cursor(*args), self)
+
+
+class _TimedCursor:
+    def __init__(self, cursor, conn):
+        self._cursor = cursor
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, sql, *args):
+        self._conn._run(self._cursor.execute, sql, *args)
+        return self
+
+    def executemany(self, sql, *args):
+        self._conn._run(self._cursor.executemany, sql, *args)
+        return self
+
+
+class Traffic:
+    """Builds Telegram updates as the JSON the Bot API would deliver."""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+    def message(self, user_id, text):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': f'User{user_id}'},
+            'from': self.user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def callback(self, user_id, data):
+        # The bot's own message the inline keyboard was attached to
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': f'User{user_id}'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'MAT'},
+            'text': '...',
+        }
+        return {'update_id': next(self._update_ids), 'callback_query': {
+            'id': str(next(self._update_ids)),
+            'from': self.user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': message,
+        }}
+
+
+class Dispatcher:
+    """Feeds updates to the bot on worker threads sharded by user id, like
+    webhook.WebhookServer, and times each bot.process_new_updates call."""
+
+    def __init__(self, bot, workers):
+        self.bot = bot
+        self.bot.threaded = False
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        for i, q in enumerate(self._queues):
+            threading.Thread(target=self._worker, args=(q,), name=f'loadtest-{i}', daemon=True).start()
+
+    def _worker(self, q):
+        from telebot.types import Update
+        while True:
+            data = q.get()
+            started = time.perf_counter()
+            failed = False
+            try:
+                self.bot.process_new_updates([Update.de_json(data)])
+            except Exception as e:
+                failed = True
+                logger.debug(f"Update {data['update_id']} raised: {e}")
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.latencies.append(elapsed)
+                self.errors += failed
+            q.task_done()
+
+    def run(self, updates):
+        """Handle every update and return the wall time in seconds."""
+        from webhook import update_user_id
+        with self._lock:
+            self.latencies = []
+            self.errors = 0
+        started = time.perf_counter()
+        for data in updates:
+            self._queues[update_user_id(data) % len(self._queues)].put(data)
+        for q in self._queues:
+            q.join()
+        return time.perf_counter() - started
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def _wallet(user_id):
+    from eth_utils import to_checksum_address
+    return to_checksum_address(f'{user_id:040x}')
+
+
+def build_scenario(name, traffic, users, rng):
+    """The updates of one scenario, interleaved across users."""
+    if name == 'start':
+        # The first tenth arrive on their own, everyone else through one of them
+        seeds = users[:max(1, len(users) // 10)]
+        updates = [traffic.message(u, '/start') for u in seeds]
+        updates += [traffic.message(u, f'/start {rng.choice(seeds)}') for u in users[len(seeds):]]
+        return updates
+    if name == 'register':
+        steps = [
+            lambda u: traffic.message(u, '🚀 Join Airdrop'),
+            lambda u: traffic.callback(u, 'check_tasks'),
+            # Every 20th account reuses the previous one's wallet, like a farm
+            lambda u: traffic.message(u, _wallet(u - 1 if u % 20 == 0 else u).lower()),
+            lambda u: traffic.callback(u, 'confirm_wallet_yes'),
+        ]
+        return [step(u) for step in steps for u in users]
+    if name == 'dashboard':
+        actions = [
+            lambda u: traffic.message(u, '/dashboard'),
+            lambda u: traffic.message(u, '📊 Dashboard'),
+            lambda u: traffic.callback(u, 'dashboard'),
+            lambda u: traffic.message(u, '/referral'),
+            lambda u: traffic.message(u, '/leaderboard'),
+        ]
+        return [rng.choice(actions)(rng.choice(users)) for _ in range(len(users) * 3)]
+    if name == 'withdraw':
+        return [traffic.message(u, '/withdraw') for u in users]
+    raise ValueError(f'Unknown scenario {name}')
+
+
+def wait_for_payouts(count, timeout):
+    """Wait until `count` payouts are completed or failed. Returns
+    (completed, failed, seconds)."""
+    from database import get_db_connection
+    conn = get_db_connection()
+    started = time.perf_counter()
+    while True:
+        rows = dict(conn.execute(
+            "SELECT status, COUNT(*) FROM transactions WHERE status IN ('completed', 'failed') GROUP BY status"
+        ).fetchall())
+        done = rows.get('completed', 0) + rows.get('failed', 0)
+        elapsed = time.perf_counter() - started
+        if done >= count or elapsed >= timeout:
+            return rows.get('completed', 0), rows.get('failed', 0), elapsed
+        time.sleep(0.2)
+
+
+def _prepare_environment(args, workdir, bot_api, stub):
+    from eth_account import Account
+    account = Account.create()
+    # Fixed values win over .env, which load_dotenv never overrides
+    os.environ.update({
+        'BOT_TOKEN': BOT_TOKEN,
+        'BOT_API_URL': bot_api.url,
+        'BSC_RPC_URLS': stub.url,
+        'BSC_RPC_URL': stub.url,
+        'PRIVATE_KEY': account.key.hex(),
+        'PAYOUT_FROM_ADDRESS': account.address,
+        'MAT_TOKEN_ADDRESS': '0x' + '11' * 20,
+        'DISPERSE_CONTRACT_ADDRESS': '',
+        'ADMIN_IDS': '',
+        'METRICS_PORT': '0',
+        'WEBHOOK_URL': '',
+        'WEBHOOK_PORT': '0',
+        'STATE_BACKEND': args.state_backend,
+    })
+    # Telegram's limits would only measure the outbox's pacing; keep the
+    # caller's values if set
+    for key, value in {
+        'OUTBOX_GLOBAL_RATE': '100000',
+        'OUTBOX_CHAT_RATE': '1000',
+        'OUTBOX_CHAT_BURST': '1000',
+        'BLOCK_POLL_INTERVAL': str(args.block_time),
+        'RPC_HEALTH_INTERVAL': '5',
+    }.items():
+        os.environ.setdefault(key, value)
+    os.chdir(workdir)
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix='mat-loadtest-')
+    bot_api = FakeBotApi()
+    stub = StubChain(args.block_time)
+    _prepare_environment(args, workdir, bot_api, stub)
+
+    import database
+    timer = LockTimer()
+    connect = database._connect
+    database._connect = lambda: _TimedConnection(connect(), timer)
+
+    import bot
+    import config
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    bot.outbox.start()
+    bot.payout_queue.start()
+
+    traffic = Traffic()
+    dispatcher = Dispatcher(bot.bot, args.workers)
+    users = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+    results = {}
+    for name in args.scenarios:
+        if name == 'withdraw':
+            # Registration only paid INITIAL_REWARD; make every balance withdrawable
+            for u in users:
+                database.update_balance(u, config.MIN_WITHDRAWAL)
+        updates = build_scenario(name, traffic, users, rng)
+        timer.reset()
+        seconds = dispatcher.run(updates)
+        latencies = sorted(dispatcher.latencies)
+        result = {
+            'updates': len(updates),
+            'seconds': seconds,
+            'updates_per_second': len(updates) / seconds if seconds else 0.0,
+            'p50_ms': _percentile(latencies, 0.50) * 1000,
+            'p99_ms': _percentile(latencies, 0.99) * 1000,
+            'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+            'errors': dispatcher.errors,
+            'writes': timer.writes,
+            'lock_waits': timer.waits,
+            'lock_wait_ms': timer.wait_total * 1000,
+            'lock_wait_max_ms': timer.wait_max * 1000,
+        }
+        if name == 'withdraw':
+            completed, failed, payout_seconds = wait_for_payouts(len(users), args.payout_timeout)
+            result.update({
+                'payouts_completed': completed,
+                'payouts_failed': failed,
+                'payouts_per_second': (completed + failed) / payout_seconds if payout_seconds else 0.0,
+            })
+        results[name] = result
+
+    outbox = bot.outbox.stats()
+    return {
+        'users': args.users,
+        'workers': args.workers,
+        'scenarios': results,
+        'outbox_sent': outbox['sent'],
+        'outbox_queued': outbox['queued'],
+        'bot_api_calls': dict(bot_api.calls),
+        'rpc_requests': stub.requests,
+    }
+
+
+def report(summary, baseline=None):
+    columns = ('updates', 'updates/s', 'p50 ms', 'p99 ms', 'max ms', 'errors', 'writes', 'lock waits', 'wait ms', 'max wait')
+    print(f"{'scenario':<10}" + ''.join(f'{c:>11}' for c in columns))
+    for name, r in summary['scenarios'].items():
+        values = (r['updates'], r['updates_per_second'], r['p50_ms'], r['p99_ms'], r['max_ms'], r['errors'],
+                  r['writes'], r['lock_waits'], r['lock_wait_ms'], r['lock_wait_max_ms'])
+        print(f'{name:<10}' + ''.join(f'{v:>11.1f}' if isinstance(v, float) else f'{v:>11}' for v in values))
+        if 'payouts_completed' in r:
+            print(f"{'':<10}payouts: {r['payouts_completed']} completed, {r['payouts_failed']} failed, "
+                  f"{r['payouts_per_second']:.1f}/s")
+    print(f"outbox: {summary['outbox_sent']} sent, {summary['outbox_queued']} still queued; "
+          f"Bot API calls: {summary['bot_api_calls']}; RPC requests: {summary['rpc_requests']}")
+
+    if baseline is None:
+        return []
+    regressions = []
+    print('\nagainst baseline:')
+    for name, r in summary['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if not before:
+            continue
+        throughput = _change(before['updates_per_second'], r['updates_per_second'])
+        p99 = _change(before['p99_ms'], r['p99_ms'])
+        print(f'{name:<10} updates/s {throughput:+.0%}  p99 {p99:+.0%}')
+        if throughput < -baseline.get('tolerance', 0) or p99 > baseline.get('tolerance', 0):
+            regressions.append(name)
+    return regressions
+
+
+def _change(before, after):
+    return (after - before) / before if before else 0.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--workers', type=int, default=8, help='update worker threads (WEBHOOK_WORKERS)')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--state-backend', choices=('memory', 'sqlite'), default='memory')
+    parser.add_argument('--block-time', type=float, default=0.5, help='seconds between stub chain blocks')
+    parser.add_argument('--payout-timeout', type=float, default=120, help='seconds to wait for the withdraw payouts')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction updates/s may drop or p99 may grow before --compare fails')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    # The run changes directory; resolve output paths first
+    save = os.path.abspath(args.save) if args.save else None
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        baseline['tolerance'] = args.tolerance
+
+    summary = run(args)
+    regressions = report(summary, baseline)
+    if save:
+        with open(save, 'w') as f:
+            json.dump(summary, f, indent=2)
+    if regressions:
+        print(f"Regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,242 @@
+"""Reply texts and keyboards shared by the threaded (bot.py) and asyncio
+(async_bot.py) runtimes.
+
+Everything that does not depend on the user is built once at import: config
+values are baked into the templates, so a reply only formats the per-user
+fields, and keyboards are serialized to the JSON string Telegram expects
+(telebot sends a string reply_markup as is)."""
+from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from config import REFERRAL_REWARD, INITIAL_REWARD, MIN_WITHDRAWAL, YOUR_TELEGRAM_ID, TELEGRAM_GROUP
+
+REGISTER_FIRST = "Please complete registration first using /start"
+CHOOSE_OPTION = "Please choose an option from the menu below 👇"
+DB_ERROR = "❌ Database error. Please try again later."
+TASKS_VERIFIED = (
+    "✅ Tasks verified successfully!\n\n"
+    "Please provide your BNB (BEP-20) wallet address for receiving MAT :\n\n"
+    "Enter your wallet address below:"
+)
+WALLET_SAVE_ERROR = "❌ Error saving wallet address. Please try /start again."
+WALLET_NOT_FOUND = "❌ Wallet address not found. Please try /start again."
+WALLET_AGAIN = "Please enter your wallet address again:"
+REF_COPIED = "Referral link copied to clipboard!"
+BROADCAST_USAGE = "Usage: /broadcast <text to send to every registered user>"
+
+HELP_TEXT = (
+    "🤖 MAT Airdrop Bot Help\n\n"
+    "🔹 Available Commands:\n"
+    "/start - Start/Restart the bot\n"
+    "/dashboard - View your account dashboard\n"
+    "/withdraw - Withdraw your MAT \n"
+    "/referral - Get referral link\n"
+    "/leaderboard - Top referrers\n"
+    "/help - Show this help message\n\n"
+    "📋 How to participate:\n"
+    "1. Click 'Join Airdrop' or type /start\n"
+    "2. Complete the simple tasks\n"
+    "3. Enter your wallet address\n"
+    "4. Start earning MAT!\n\n"
+    "💡 Tips:\n"
+    f"• Minimum withdrawal: {MIN_WITHDRAWAL} MAT\n"
+    f"• Each referral earns you {REFERRAL_REWARD} MAT\n"
+    "• Use Trust Wallet or MetaMask for best experience"
+)
+
+AIRDROP_TASKS_TEXT = (
+    "🔥 Welcome to Meta Asset Token Airdrop Registration!\n\n"
+    "To qualify, complete these simple tasks:\n\n"
+    f"1. SEND 'MAT TO THE MOON!' TO OUR GROUP ({YOUR_TELEGRAM_ID})\n"
+    f"2. Join our Telegram Group: {TELEGRAM_GROUP}\n\n"
+    "👇 Press the button below after completing these tasks."
+)
+
+# Templates. Literal braces in baked-in config values are escaped so only the
+# {fields} below are filled in at send time.
+def _bake(value):
+    return str(value).replace('{', '{{').replace('}', '}}')
+
+_WELCOME = (
+    "🚀 Welcome to MAT Airdrop Bot! 🚀\n\n"
+    "Hello {username}, I'm your guide to earning MAT tokens : )\n\n"
+    "🌐 Network: BNB Smart Chain (BEP-20)\n\n"
+    "🎁 What you'll get:\n"
+    f"• {_bake(INITIAL_REWARD)} MAT for registration\n"
+    f"• {_bake(REFERRAL_REWARD)} MAT per referral\n\n"
+    "⏰ Distribution: Instant\n\n"
+    "🔹 Available Commands:\n"
+    "/start - Start/Restart the bot\n"
+    "/dashboard - View your account\n"
+    "/withdraw - Withdraw your MAT\n"
+    "/referral - Get referral link\n"
+    "/help - Show help information\n\n"
+    "Press 'Join Airdrop' below or type /start to begin!"
+)
+
+_ALREADY_REGISTERED = (
+    "🎉 You're already registered for the MAT Airdrop!\n\n"
+    "💰 Your current balance: {balance} MAT\n"
+    "👥 Your referrals: {referrals}\n\n"
+    "Use /dashboard to view your account or /referral to invite friends!"
+)
+
+_REGISTRATION_SUCCESS = (
+    "✅ Registration Successful! 🎉\n\n"
+    "Congratulations {first_name}!\n"
+    f"💰 Received: {_bake(INITIAL_REWARD)} MAT\n\n"
+    "⏰ Distribution: Distribution is Live Now!!\n\n"
+    "Use the dashboard below to check your balance and invite friends!"
+)
+
+_REGISTRATION_HELD = (
+    "✅ Registration received, {first_name}!\n\n"
+    "⏳ Your registration reward is being reviewed and will be added to your balance once approved."
+)
+
+_CONFIRM_WALLET = "🔐 Please confirm your wallet address:\n\n{wallet}\n\n⚠️ Is this the address you want to use for receiving MAT?"
+
+_DASHBOARD = (
+    "📊 MAT Airdrop Dashboard 📊\n\n"
+    "👤 User: {username}\n"
+    "🔗 Wallet: {wallet}\n\n"
+    "💰 MAT Balance: {balance}\n"
+    "👥 Referrals: {referrals}\n"
+    "💸 Referral Earnings: {earned} MAT\n\n"
+    "⏰ Token Distribution: LIVE!"
+)
+_DASHBOARD_COMMANDS = _DASHBOARD + (
+    "\n\n🔹 Available Commands:\n"
+    "/withdraw - Withdraw your MAT\n"
+    "/referral - Get referral link\n"
+    "/start - Restart registration"
+)
+
+_REFERRAL = (
+    "🚀 Referral Program 🚀\n\n"
+    f"Referral Bonus: {_bake(REFERRAL_REWARD)} MAT per referral\n\n"
+    "👥 Your Referrals: {referrals}\n"
+    "💰 Total Earned: {earned} MAT\n\n"
+    "🔗 Your Referral Link:\n{link}\n\n"
+    "How to invite friends:\n"
+    "• Share your referral link\n"
+    "• Ask them to join using your link\n"
+    "• They must complete all tasks\n"
+    "• You'll receive tokens automatically\n\n"
+    "💡 Tip: Copy the link above and share it with friends!"
+)
+
+_WITHDRAW_MINIMUM = f"❌ Withdrawal Failed\n\nMinimum withdrawal amount: {_bake(MIN_WITHDRAWAL)} MAT\nYour current balance: {{balance}} MAT\n\n💡 Tip: Refer more friends to earn more MAT!"
+_WITHDRAW_PROCESSING = "⏳ Processing automatic withdrawal of {balance} MAT to your wallet...\n\nYou'll get a message here as soon as it is confirmed."
+_WITHDRAW_SUCCESS = "✅ Withdrawal successful! 🎉\n\n💰 Amount: {balance} MAT\n🔗 Transaction Hash: {txhash}\n\nView on BscScan: https://bscscan.com/tx/{txhash}"
+_WITHDRAW_FAILED = "❌ Withdrawal failed: {error}\nYour balance has been restored."
+_INVALID_WALLET = "❌ {reason}\n\nPlease enter your wallet address again:"
+_LEADERBOARD = "🏆 Top Referrers 🏆\n\n{rows}\n\n🔥 Referrals in the last hour: {recent}\n\n{own}"
+_LEADERBOARD_ROW = "{position}. {name} - {referrals}"
+_LEADERBOARD_EMPTY = "No referrals yet. Be the first!"
+_LEADERBOARD_RANK = (
+    "👤 Your rank: #{rank} with {direct} referrals\n"
+    "👥 Invited by your referrals: {second_level}\n"
+    "⏱ Your referrals in the last hour: {last_hour}"
+)
+_LEADERBOARD_UNRANKED = "👤 You have no referrals yet. Share your link from /referral to get on the board!"
+_BROADCAST_STARTED = "📣 Broadcast #{broadcast_id} started. Progress is in the bot log."
+
+# Keyboards, serialized once
+def _main_menu_keyboard():
+    keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
+    keyboard.add(KeyboardButton("🚀 Join Airdrop"))
+    keyboard.add(KeyboardButton("📊 Dashboard"), KeyboardButton("💸 Withdraw MAT"))
+    keyboard.add(KeyboardButton("👥 Referral Program"), KeyboardButton("ℹ️ Help"))
+    return keyboard.to_json()
+
+MAIN_MENU_KEYBOARD = _main_menu_keyboard()
+TASKS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ I Completed Tasks", callback_data='check_tasks')]
+]).to_json()
+REGISTRATION_SUCCESS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 Dashboard", callback_data='dashboard')],
+    [InlineKeyboardButton("👥 Refer Friends", callback_data='copy_ref')]
+]).to_json()
+CONFIRM_WALLET_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Yes, use this address", callback_data='confirm_wallet_yes')],
+    [InlineKeyboardButton("❌ No, enter different address", callback_data='confirm_wallet_no')]
+]).to_json()
+
+_MENU_ACTIONS = {
+    "🚀 Join Airdrop": 'join', 'join airdrop': 'join',
+    "📊 Dashboard": 'dashboard', 'dashboard': 'dashboard',
+    "💸 Withdraw MAT": 'withdraw', 'withdraw mat': 'withdraw', 'withdraw': 'withdraw',
+    "👥 Referral Program": 'referral', 'referral program': 'referral',
+    "ℹ️ Help": 'help', 'help': 'help',
+}
+
+def menu_action(text):
+    """Map a menu button (or its typed name) to an action, or None."""
+    return _MENU_ACTIONS.get(text) or _MENU_ACTIONS.get(text.lower())
+
+# Metric labels for updates. Callback data comes from the client, so unknown
+# values share one label.
+_CALLBACK_DATA = {'check_tasks', 'confirm_wallet_yes', 'confirm_wallet_no', 'dashboard', 'withdraw', 'copy_ref'}
+
+def command_name(message):
+    return message.text.split()[0].split('@')[0].lower()
+
+def text_action(message):
+    return menu_action(message.text) or 'text'
+
+def callback_action(call):
+    return call.data if call.data in _CALLBACK_DATA else 'other'
+
+def welcome_text(username):
+    return _WELCOME.format(username=username)
+
+def already_registered_text(user):
+    return _ALREADY_REGISTERED.format(balance=user['balance'], referrals=user['referrals'])
+
+def registration_success_text(first_name):
+    return _REGISTRATION_SUCCESS.format(first_name=first_name)
+
+def registration_held_text(first_name):
+    return _REGISTRATION_HELD.format(first_name=first_name)
+
+def invalid_wallet_text(reason):
+    return _INVALID_WALLET.format(reason=reason)
+
+def confirm_wallet_text(wallet_address):
+    return _CONFIRM_WALLET.format(wallet=wallet_address)
+
+def dashboard_text(user, with_commands=True):
+    template = _DASHBOARD_COMMANDS if with_commands else _DASHBOARD
+    return template.format(
+        username=user['username'] or 'N/A',
+        wallet=user['wallet_address'] or 'Not set',
+        balance=user['balance'],
+        referrals=user['referrals'],
+        earned=user['earned_from_referrals'],
+    )
+
+def referral_text(user, referral_link):
+    return _REFERRAL.format(referrals=user['referrals'], earned=user['earned_from_referrals'], link=referral_link)
+
+def withdraw_minimum_text(balance):
+    return _WITHDRAW_MINIMUM.format(balance=balance)
+
+def withdraw_processing_text(balance):
+    return _WITHDRAW_PROCESSING.format(balance=balance)
+
+def withdraw_success_text(balance, txhash):
+    return _WITHDRAW_SUCCESS.format(balance=balance, txhash=txhash)
+
+def withdraw_failed_text(error):
+    return _WITHDRAW_FAILED.format(error=error)
+
+def leaderboard_text(rows, stats, recent):
+    """rows from get_leaderboard, stats from get_referral_stats."""
+    lines = [
+        _LEADERBOARD_ROW.format(position=i, name=username or 'Anonymous', referrals=referrals)
+        for i, (_, username, referrals) in enumerate(rows, 1)
+    ]
+    own = _LEADERBOARD_RANK.format(**stats) if stats['rank'] else _LEADERBOARD_UNRANKED
+    return _LEADERBOARD.format(rows='\n'.join(lines) or _LEADERBOARD_EMPTY, recent=recent, own=own)
+
+def broadcast_started_text(broadcast_id):
+    return _BROADCAST_STARTED.format(broadcast_id=broadcast_id)
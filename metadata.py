@@ -0,0 +1,44 @@
+"""Startup cache for values that never change while the bot runs
+(token decimals, checksummed addresses, chain id, bot username)"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+_loaders = {}
+_values = {}
+_lock = threading.Lock()
+
+
+def register(name, loader):
+    _loaders[name] = loader
+
+
+def get(name):
+    try:
+        return _values[name]
+    except KeyError:
+        pass
+    with _lock:
+        if name not in _values:
+            # Failed loads are not cached, so the next call retries
+            _values[name] = _loaders[name]()
+        return _values[name]
+
+
+def warm():
+    """Load every registered value now, logging the ones that fail."""
+    for name in list(_loaders):
+        try:
+            get(name)
+        except Exception as e:
+            logger.warning(f"Could not load {name}: {e}")
+
+
+def reload(name=None):
+    """Forget one cached value, or all of them, so they are loaded again."""
+    with _lock:
+        if name is None:
+            _values.clear()
+        else:
+            _values.pop(name, None)
@@ -0,0 +1,281 @@
+"""In-process metrics in the Prometheus text format, served on
+METRICS_HOST:METRICS_PORT/metrics when METRICS_PORT is set.
+
+Recording is a dict lookup and a few additions under a lock, so it stays on
+in production. Values computed from other components (queue depths, outbox
+and RPC endpoint stats) are read only when /metrics is scraped."""
+import asyncio
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Seconds; fine-grained at the low end where SQLite and cached lookups sit
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_metrics = []
+_stats = []  # (prefix, fn, label)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=''):
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(labels[n] for n in self.labelnames)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{_labels(self.labelnames, key)} {_number(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, fn):
+        """Read the (unlabelled) value from fn() at scrape time."""
+        self._function = fn
+
+    def render(self):
+        if self._function is not None:
+            try:
+                self.set(self._function())
+            except Exception as e:
+                logger.warning(f"Could not read {self.name}: {e}")
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Per-bucket counts, then sum and count
+                entry = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            entry[bisect_left(self.buckets, value)] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = [(key, list(entry)) for key, entry in self._values.items()]
+        for key, entry in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry):
+                cumulative += count
+                le = f'le="{_number(bound)}"'
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {_number(entry[-2])}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {entry[-1]}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+HANDLER_SECONDS = Histogram('mat_handler_seconds', 'Time spent in a Telegram update handler.', ('handler', 'action'))
+HANDLER_ERRORS = Counter('mat_handler_errors_total', 'Update handlers that raised.', ('handler', 'action'))
+DB_SECONDS = Histogram('mat_db_seconds', 'Time spent in a database.py helper.', ('helper',))
+RPC_SECONDS = Histogram('mat_rpc_seconds', 'JSON-RPC request latency, including failover.', ('method',))
+RPC_ERRORS = Counter('mat_rpc_errors_total', 'JSON-RPC requests that failed on every endpoint.', ('method',))
+PAYOUT_QUEUE_DEPTH = Gauge('mat_payout_queue_depth', 'Payouts waiting for a payout worker.')
+
+
+def timed_query(func):
+    """Record a database helper's duration in mat_db_seconds."""
+    helper = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            DB_SECONDS.observe(time.perf_counter() - started, helper=helper)
+    return wrapper
+
+
+def timed_handler(action):
+    """Record an update handler's duration in mat_handler_seconds, labelled
+    with action(update), e.g. the command or callback data. Works on plain
+    and async handlers."""
+    def decorator(func):
+        handler = func.__name__
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(update):
+                label = action(update)
+                started = time.perf_counter()
+                try:
+                    return await func(update)
+                except Exception:
+                    HANDLER_ERRORS.inc(handler=handler, action=label)
+                    raise
+                finally:
+                    HANDLER_SECONDS.observe(time.perf_counter() - started, handler=handler, action=label)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(update):
+            label = action(update)
+            started = time.perf_counter()
+            try:
+                return func(update)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=handler, action=label)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - started, handler=handler, action=label)
+        return wrapper
+    return decorator
+
+
+def register_stats(prefix, fn, label='key'):
+    """Export a component's stats() at scrape time as gauges named
+    prefix_<field>. fn() returns a dict of numbers, where a nested dict becomes
+    one labelled series per key, or a list of such dicts that each carry their
+    own `label` value (e.g. one per RPC endpoint)."""
+    _stats.append((prefix, fn, label))
+
+
+def _render_stats(prefix, fn, label):
+    try:
+        stats = fn()
+    except Exception as e:
+        logger.warning(f"Could not read {prefix} stats: {e}")
+        return []
+    rows = stats if isinstance(stats, list) else [stats]
+    series = {}
+    for row in rows:
+        own = {label: row[label]} if isinstance(stats, list) else {}
+        for field, value in row.items():
+            if field == label and own:
+                continue
+            if isinstance(value, dict):
+                for key, v in value.items():
+                    series.setdefault(field, []).append(({**own, label: key}, v))
+            else:
+                series.setdefault(field, []).append((own, value))
+    lines = []
+    for field, samples in series.items():
+        name = f'{prefix}_{field}'
+        lines.append(f'# TYPE {name} gauge')
+        for labels, value in samples:
+            if value is None:
+                continue
+            lines.append(f'{name}{_labels(labels.keys(), labels.values())} {_number(float(value))}')
+    return lines
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for prefix, fn, label in _stats:
+        lines.extend(_render_stats(prefix, fn, label))
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(host=None, port=None):
+    """Serve /metrics in a background thread. Does nothing unless a port is
+    configured."""
+    host = host or config.METRICS_HOST
+    port = port or config.METRICS_PORT
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Metrics served on http://{host}:{port}/metrics")
+    return server
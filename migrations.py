@@ -0,0 +1,177 @@
+"""Versioned schema changes, applied by init_db. The version is kept in
+PRAGMA user_version; each step must be safe to re-run, since a crash can
+interrupt it before the version is bumped."""
+import logging
+
+import config
+
+logger = logging.getLogger(__name__)
+
+MINOR_UNITS = 1000000  # ledger amounts are stored in micro-MAT
+
+
+def _columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def _add_column(conn, table, column, definition):
+    # ADD COLUMN only rewrites the schema, never the table, so it is instant
+    if column not in _columns(conn, table):
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def _in_batches(conn, table, sql, batch_size):
+    """Run sql (an UPDATE with a rowid range as its two parameters) over the
+    whole table, committing after every batch so other connections can write
+    in between."""
+    last = conn.execute(f'SELECT MAX(rowid) FROM {table}').fetchone()[0] or 0
+    start = 0
+    while start < last:
+        conn.execute(sql, (start, start + batch_size))
+        conn.commit()
+        start += batch_size
+        logger.info(f"{table}: {min(start, last)}/{last} rows")
+
+
+def add_blocked_column(conn, batch_size):
+    _add_column(conn, 'users', 'blocked', 'INTEGER DEFAULT 0')
+
+
+def add_ledger_indexes(conn, batch_size):
+    # Payout scans only look at in-flight rows. Partial indexes stay as small
+    # as the number of open payouts however long the ledger grows, and each
+    # is matched by a `status = ?` query.
+    for status in ('pending', 'processing', 'submitted'):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_transactions_{status} ON transactions (tx_id) WHERE status = '{status}'")
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions (user_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_created ON transactions (created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_transactions_hash ON transactions (tx_hash) WHERE tx_hash IS NOT NULL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_credits_user ON credits (user_id)')
+
+
+def add_minor_units(conn, batch_size):
+    # Integer amounts are authoritative from here on; the REAL columns are kept
+    # for display and are always written as minor / MINOR_UNITS
+    _add_column(conn, 'users', 'balance_minor', 'INTEGER DEFAULT 0')
+    _add_column(conn, 'users', 'earned_minor', 'INTEGER DEFAULT 0')
+    _add_column(conn, 'transactions', 'amount_minor', 'INTEGER')
+    _add_column(conn, 'credits', 'amount_minor', 'INTEGER')
+    conn.commit()
+
+    _in_batches(conn, 'users', f'''
+        UPDATE users SET
+            balance_minor = CAST(ROUND(COALESCE(balance, 0) * {MINOR_UNITS}) AS INTEGER),
+            earned_minor = CAST(ROUND(COALESCE(earned_from_referrals, 0) * {MINOR_UNITS}) AS INTEGER),
+            balance = ROUND(COALESCE(balance, 0) * {MINOR_UNITS}) / {MINOR_UNITS}.0,
+            earned_from_referrals = ROUND(COALESCE(earned_from_referrals, 0) * {MINOR_UNITS}) / {MINOR_UNITS}.0
+        WHERE rowid > ? AND rowid <= ?
+    ''', batch_size)
+    for table in ('transactions', 'credits'):
+        _in_batches(conn, table, f'''
+            UPDATE {table} SET amount_minor = CAST(ROUND(amount_mat * {MINOR_UNITS}) AS INTEGER)
+            WHERE rowid > ? AND rowid <= ? AND amount_minor IS NULL
+        ''', batch_size)
+
+
+def add_reconciler_state(conn, batch_size):
+    _add_column(conn, 'transactions', 'nonce', 'INTEGER')
+    _add_column(conn, 'transactions', 'updated_at', 'DATETIME')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS reconciler_checkpoints (
+            name TEXT PRIMARY KEY,
+            last_tx_id INTEGER NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def add_referral_graph(conn, batch_size):
+    # One row per referred user; the referrer index answers "who did I invite"
+    # and time-window questions without touching users
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS referrals (
+            referee_id BIGINT PRIMARY KEY,
+            referrer_id BIGINT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals (referrer_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_referrals_created ON referrals (created_at)')
+    # Referral counts of everyone with at least one, loaded into the in-memory
+    # leaderboard at startup. Earlier referrals were only counted, so they are
+    # seeded from users.referrals.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS referral_leaderboard (
+            user_id BIGINT PRIMARY KEY,
+            referrals INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    _in_batches(conn, 'users', '''
+        INSERT OR IGNORE INTO referral_leaderboard (user_id, referrals)
+        SELECT user_id, referrals FROM users WHERE rowid > ? AND rowid <= ? AND referrals > 0
+    ''', batch_size)
+
+
+def add_abuse_holds(conn, batch_size):
+    # Referrers are remembered at /start and credited once the referee has
+    # registered
+    _add_column(conn, 'users', 'referred_by', 'BIGINT')
+    # Confirms a bloom filter hit on a wallet without scanning users
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_wallet ON users (wallet_address) WHERE wallet_address IS NOT NULL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS held_credits (
+            hold_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id BIGINT NOT NULL,
+            reason TEXT NOT NULL,
+            amount_minor INTEGER NOT NULL,
+            referee_id BIGINT,
+            flags TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'held',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            decided_at DATETIME
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_held_credits_held ON held_credits (hold_id) WHERE status = 'held'")
+
+
+def add_cancel_hash(conn, batch_size):
+    # A dropped payout is refunded only once this cancel, sent with its nonce,
+    # is mined
+    _add_column(conn, 'transactions', 'cancel_hash', 'TEXT')
+
+
+def add_tx_hashes(conn, batch_size):
+    # Every hash sent for a payout, comma separated and oldest first: a fee
+    # bump replaces tx_hash, but the original may still be the one mined
+    _add_column(conn, 'transactions', 'tx_hashes', 'TEXT')
+    _in_batches(conn, 'transactions',
+                'UPDATE transactions SET tx_hashes = tx_hash '
+                'WHERE tx_hashes IS NULL AND tx_hash IS NOT NULL AND rowid > ? AND rowid <= ?',
+                batch_size)
+
+
+MIGRATIONS = [
+    (1, 'users.blocked column', add_blocked_column),
+    (2, 'ledger indexes', add_ledger_indexes),
+    (3, 'integer amounts in minor units', add_minor_units),
+    (4, 'payout nonces and reconciler checkpoints', add_reconciler_state),
+    (5, 'referral edges and leaderboard', add_referral_graph),
+    (6, 'referrer column and held credits', add_abuse_holds),
+    (7, 'payout cancel hashes', add_cancel_hash),
+    (8, 'payout replacement hashes', add_tx_hashes),
+]
+
+
+def migrate(conn, batch_size=None):
+    """Apply every migration newer than the database's user_version."""
+    batch_size = batch_size or config.MIGRATION_BATCH_SIZE
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for target, description, step in MIGRATIONS:
+        if target <= version:
+            continue
+        logger.info(f"Migrating database to version {target}: {description}")
+        step(conn, batch_size)
+        conn.execute(f'PRAGMA user_version = {target}')
+        conn.commit()
+        version = target
+    return version
@@ -0,0 +1,91 @@
+import heapq
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Node error fragments that mean our local view of the nonce is wrong
+RESYNC_ERRORS = (
+    'nonce too low',
+    'replacement transaction underpriced',
+    'replacement underpriced',
+    'already known',
+    'known transaction',
+)
+
+
+def is_nonce_error(error) -> bool:
+    msg = str(error).lower()
+    return any(fragment in msg for fragment in RESYNC_ERRORS)
+
+
+class NonceManager:
+    """Hands out nonces for one sending address to many threads at once.
+
+    The counter is seeded from the node's 'pending' transaction count and then
+    advanced locally, so concurrent payouts never read the same nonce. Nonces
+    that never made it onto the chain are released and reused first, so a
+    dropped transaction does not leave a gap that stalls every later one."""
+
+    def __init__(self, w3, address):
+        self.w3 = w3
+        self.address = address
+        self._lock = threading.Lock()
+        self._next = None
+        self._gaps = []
+
+    def sync(self):
+        """Reload the next nonce from the node, discarding local state."""
+        with self._lock:
+            self._sync_locked()
+
+    def _sync_locked(self):
+        chain_next = self.w3.eth.get_transaction_count(self.address, 'pending')
+        if self._next is not None and chain_next != self._next:
+            logger.info(f"Nonce resync for {self.address}: local {self._next}, node {chain_next}")
+        self._next = chain_next
+        # Everything below the node's count is taken and everything above it
+        # will be handed out again from _next
+        self._gaps = []
+
+    def allocate(self) -> int:
+        with self._lock:
+            if self._next is None:
+                self._sync_locked()
+            if self._gaps:
+                return heapq.heappop(self._gaps)
+            nonce = self._next
+            self._next += 1
+            return nonce
+
+    def release(self, nonce):
+        """Return a nonce whose transaction was never accepted by the node."""
+        with self._lock:
+            if self._next is None or nonce >= self._next:
+                return
+            if nonce not in self._gaps:
+                heapq.heappush(self._gaps, nonce)
+            # Gaps at the top of the range are not gaps, just unused nonces
+            while self._gaps and max(self._gaps) == self._next - 1:
+                self._gaps.remove(self._next - 1)
+                self._next -= 1
+            heapq.heapify(self._gaps)
+
+    def take_gaps(self):
+        """Remove and return all released nonces, lowest first."""
+        with self._lock:
+            gaps = sorted(self._gaps)
+            self._gaps = []
+            return gaps
+
+    def handle_error(self, error) -> bool:
+        """Resync if error says our nonce is stale. Returns True if the caller
+        should retry with a freshly allocated nonce."""
+        if not is_nonce_error(error):
+            return False
+        try:
+            self.sync()
+        except Exception as e:
+            logger.error(f"Nonce resync failed: {e}")
+            return False
+        return True
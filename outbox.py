@@ -0,0 +1,353 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from telebot.apihelper import ApiTelegramException
+from telebot.asyncio_helper import ApiTelegramException as AsyncApiTelegramException
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, lowest value goes first
+HIGH = 0
+NORMAL = 1
+BULK = 2
+
+LANE_NAMES = {HIGH: 'high', NORMAL: 'normal', BULK: 'bulk'}
+
+
+class TokenBucket:
+    """Token bucket used as a scheduler: reserve() takes the next token and
+    returns the time it becomes available, which may be in the future."""
+
+    __slots__ = ('rate', 'burst', 'next_free')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # Time at which the bucket is full again; up to burst - 1 tokens
+        # may be borrowed against it
+        self.next_free = 0.0
+
+    def reserve(self, now):
+        start = max(now, self.next_free - (self.burst - 1) / self.rate)
+        self.next_free = max(self.next_free, start) + 1 / self.rate
+        return start
+
+    def defer(self, until):
+        """Hold every token until the given time (used for retry_after)."""
+        self.next_free = max(self.next_free, until + (self.burst - 1) / self.rate)
+
+    def idle(self, now):
+        return self.next_free <= now
+
+
+class _Job:
+    __slots__ = ('method', 'chat_id', 'args', 'kwargs', 'priority', 'queued_at', 'attempts', 'edit_key', 'callback')
+
+    def __init__(self, method, chat_id, args, kwargs, priority, edit_key=None, callback=None):
+        self.method = method
+        self.chat_id = chat_id
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+        self.edit_key = edit_key
+        self.callback = callback
+
+
+class Outbox:
+    """Rate-limited sender for bot replies.
+
+    Handlers queue messages and return immediately. OUTBOX_WORKERS threads
+    send them, never faster than OUTBOX_GLOBAL_RATE per second overall or
+    OUTBOX_CHAT_RATE per second (bursts of OUTBOX_CHAT_BURST) to one chat,
+    which keeps the bot under Telegram's flood limits instead of retrying into
+    429s. Payout results go in the HIGH lane ahead of menu replies. On a 429
+    the chat is paused for retry_after and the message is sent again. An edit
+    of a message that still has an edit queued replaces the queued one."""
+
+    def __init__(self, bot, global_rate=None, chat_rate=None, chat_burst=None, workers=None, max_attempts=3):
+        self.bot = bot
+        global_rate = global_rate or config.OUTBOX_GLOBAL_RATE
+        self.chat_rate = chat_rate or config.OUTBOX_CHAT_RATE
+        self.chat_burst = chat_burst or config.OUTBOX_CHAT_BURST
+        self.workers = workers or config.OUTBOX_WORKERS
+        self.max_attempts = max_attempts
+        # No burst allowance: Telegram counts the global limit per second
+        self._global = TokenBucket(global_rate, 1)
+        self._chats = {}
+        self._ready = []    # (priority, seq, job)
+        self._delayed = []  # (not_before, seq, job)
+        self._edits = {}    # (chat_id, message_id) -> queued edit job
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._sent = 0
+        self._failed = 0
+        self._retried = 0
+        self._coalesced = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def send_message(self, chat_id, text, priority=NORMAL, callback=None, **kwargs):
+        """Queue a message. callback(ok, error) is called from a sender
+        thread once it is delivered or given up on."""
+        self._submit(_Job('send_message', chat_id, (chat_id, text), kwargs, priority, callback=callback))
+
+    def edit_message_text(self, text, chat_id, message_id, priority=NORMAL, **kwargs):
+        key = (chat_id, message_id)
+        with self._cond:
+            queued = self._edits.get(key)
+            if queued is not None:
+                # Only the newest text matters; keep the older job's place in line
+                queued.args = (text, chat_id, message_id)
+                queued.kwargs = kwargs
+                if priority < queued.priority:
+                    self._raise_priority(queued, priority)
+                self._coalesced += 1
+                return
+            job = _Job('edit_message_text', chat_id, (text, chat_id, message_id), kwargs, priority, edit_key=key)
+            self._edits[key] = job
+            self._schedule(job, time.monotonic())
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        """Answered right away: it is not a chat message, and the client
+        shows a spinner until it arrives."""
+        try:
+            self.bot.answer_callback_query(callback_query_id, text, **kwargs)
+        except Exception as e:
+            logger.error(f"Error answering callback query {callback_query_id}: {e}")
+
+    def reserve(self, chat_id, not_before=None):
+        """Book a send to chat_id that is made outside the queue (see
+        AsyncOutbox) and return the time it may go. not_before pauses the
+        chat until then, as for a retry_after, and counts as a retry."""
+        with self._cond:
+            now = time.monotonic()
+            if not_before is not None:
+                self._retried += 1
+            at = self._bucket(chat_id, now, not_before).reserve(now)
+            return self._global.reserve(at)
+
+    def _raise_priority(self, job, priority):
+        job.priority = priority
+        # A delayed job enters its lane once it is due; a ready one is moved
+        # to its new lane, keeping its place among jobs queued before it
+        for i, (_, seq, queued) in enumerate(self._ready):
+            if queued is job:
+                self._ready[i] = (priority, seq, job)
+                heapq.heapify(self._ready)
+                return
+
+    def _submit(self, job):
+        with self._cond:
+            self._schedule(job, time.monotonic())
+
+    def _schedule(self, job, now, not_before=None):
+        at = self._bucket(job.chat_id, now, not_before).reserve(now)
+        if at <= now:
+            heapq.heappush(self._ready, (job.priority, next(self._seq), job))
+        else:
+            heapq.heappush(self._delayed, (at, next(self._seq), job))
+        self._cond.notify()
+
+    def _bucket(self, chat_id, now, not_before=None):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= 10000:
+                self._prune(now)
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        if not_before is not None:
+            bucket.defer(not_before)
+        return bucket
+
+    def _prune(self, now):
+        # Chats whose bucket has refilled need no state
+        for chat_id in [c for c, b in self._chats.items() if b.idle(now)]:
+            del self._chats[chat_id]
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, _, job = heapq.heappop(self._delayed)
+                    heapq.heappush(self._ready, (job.priority, next(self._seq), job))
+                if self._ready:
+                    _, _, job = heapq.heappop(self._ready)
+                    if job.edit_key is not None:
+                        self._edits.pop(job.edit_key, None)
+                    return job, self._global.reserve(now)
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(timeout)
+
+    def _worker(self):
+        while True:
+            job, at = self._next_job()
+            delay = at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._send(job)
+
+    def _send(self, job):
+        job.attempts += 1
+        try:
+            getattr(self.bot, job.method)(*job.args, **job.kwargs)
+        except ApiTelegramException as e:
+            retry_after = (e.result_json.get('parameters') or {}).get('retry_after')
+            if e.error_code == 429 and retry_after and job.attempts < self.max_attempts:
+                logger.warning(f"Rate limited sending to {job.chat_id}, retrying in {retry_after}s")
+                self._retry(job, time.monotonic() + retry_after)
+            elif job.method == 'edit_message_text' and 'message is not modified' in e.description:
+                self._record(job)
+            else:
+                self._drop(job, e)
+            return
+        except Exception as e:
+            if job.attempts < self.max_attempts:
+                logger.warning(f"Error sending to {job.chat_id}, retrying: {e}")
+                self._retry(job, time.monotonic() + job.attempts)
+            else:
+                self._drop(job, e)
+            return
+        self._record(job)
+
+    def _retry(self, job, not_before):
+        with self._cond:
+            self._retried += 1
+            if job.edit_key is not None:
+                if job.edit_key in self._edits:
+                    # A newer edit of the same message is already queued
+                    return
+                self._edits[job.edit_key] = job
+            self._schedule(job, time.monotonic(), not_before)
+
+    def _drop(self, job, error):
+        logger.error(f"Dropping {job.method} to {job.chat_id} after {job.attempts} attempts: {error}")
+        with self._cond:
+            self._failed += 1
+        self._done(job, False, error)
+
+    def _record(self, job):
+        wait = time.monotonic() - job.queued_at
+        with self._cond:
+            self._sent += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+        self._done(job, True, None)
+
+    def _done(self, job, ok, error):
+        if job.callback is None:
+            return
+        try:
+            job.callback(ok, error)
+        except Exception as e:
+            logger.error(f"Outbox callback for {job.chat_id} failed: {e}")
+
+    def qsize(self):
+        with self._cond:
+            return len(self._ready) + len(self._delayed)
+
+    def stats(self):
+        with self._cond:
+            lanes = {name: 0 for name in LANE_NAMES.values()}
+            for _, _, job in itertools.chain(self._ready, self._delayed):
+                lanes[LANE_NAMES[job.priority]] += 1
+            return {
+                'queued': len(self._ready) + len(self._delayed),
+                'delayed': len(self._delayed),
+                'lanes': lanes,
+                'sent': self._sent,
+                'failed': self._failed,
+                'retried': self._retried,
+                'coalesced': self._coalesced,
+                'wait_avg': self._wait_total / self._sent if self._sent else 0.0,
+                'wait_max': self._wait_max,
+            }
+
+
+class Replies:
+    """Records the replies of a handler so they can be sent afterwards.
+    async_bot.py runs handlers on its SQLite executor with one of these and
+    then awaits the sends; bot.py passes the Outbox itself."""
+
+    def __init__(self):
+        self.calls = []  # (method, chat_id, args, kwargs)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.calls.append(('send_message', chat_id, (chat_id, text), kwargs))
+
+    def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        self.calls.append(('edit_message_text', chat_id, (text, chat_id, message_id), kwargs))
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        self.calls.append(('answer_callback_query', None, (callback_query_id, text), kwargs))
+
+
+class AsyncOutbox:
+    """Sends replies by awaiting an AsyncTeleBot.
+
+    Every send books its slot on the buckets of a threaded Outbox, so replies
+    sent here and the payout results and broadcasts sent by the outbox's
+    threads share one per-chat and global budget; the coroutine sleeps on the
+    event loop until its slot. 429s and unmodified edits are handled as in
+    Outbox, and the sends are counted in its stats."""
+
+    def __init__(self, bot, outbox, max_attempts=3):
+        self.bot = bot
+        self.outbox = outbox
+        self.max_attempts = max_attempts
+
+    async def deliver(self, replies):
+        for method, chat_id, args, kwargs in replies.calls:
+            await self.send(method, chat_id, args, kwargs)
+
+    async def send(self, method, chat_id, args, kwargs):
+        if chat_id is None:
+            try:
+                await getattr(self.bot, method)(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"Error answering callback query {args[0]}: {e}")
+            return
+        job = _Job(method, chat_id, args, kwargs, NORMAL)
+        not_before = None
+        while True:
+            job.attempts += 1
+            delay = self.outbox.reserve(chat_id, not_before) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await getattr(self.bot, method)(*args, **kwargs)
+            except AsyncApiTelegramException as e:
+                retry_after = (e.result_json.get('parameters') or {}).get('retry_after')
+                if e.error_code == 429 and retry_after and job.attempts < self.max_attempts:
+                    logger.warning(f"Rate limited sending to {chat_id}, retrying in {retry_after}s")
+                    not_before = time.monotonic() + retry_after
+                    continue
+                if method == 'edit_message_text' and 'message is not modified' in e.description:
+                    break
+                self.outbox._drop(job, e)
+                return
+            except Exception as e:
+                if job.attempts < self.max_attempts:
+                    logger.warning(f"Error sending to {chat_id}, retrying: {e}")
+                    not_before = time.monotonic() + job.attempts
+                    continue
+                self.outbox._drop(job, e)
+                return
+            break
+        self.outbox._record(job)
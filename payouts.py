@@ -0,0 +1,296 @@
+import logging
+import queue
+import threading
+import time
+
+from web3 import Web3
+
+import chain
+import config
+from database import get_transaction, get_transactions_by_status, claim_transaction, fail_transaction, from_minor, sent_hashes
+
+logger = logging.getLogger(__name__)
+
+# Payout lifecycle in the transactions table:
+#   pending    -> written by the withdraw handler, not yet picked up
+#   processing -> claimed by a worker, being signed
+#   submitted  -> signed, tx_hash recorded (broadcast may or may not have happened);
+#                 a dropped one also gets a cancel_hash and is only refunded
+#                 once that cancel has taken its nonce
+#   completed / failed
+IN_FLIGHT_STATUSES = ('pending', 'processing', 'submitted')
+
+
+class PayoutQueue:
+    """Worker pool that broadcasts pending withdrawals and tracks their receipts
+    off the Telegram polling thread.
+
+    When batching is enabled each worker gathers a window of pending rows and
+    pays them with a single disperse call; every row in the batch gets the same
+    tx_hash and settles on the same receipt.
+
+    notify(user_id, tx_row, ok, result) is called once a payout reaches a final
+    state; result is the tx hash on success or an error string."""
+
+    def __init__(self, notify, workers=None, receipt_timeout=None):
+        self.notify = notify
+        self.workers = workers or config.PAYOUT_WORKERS
+        self.receipt_timeout = receipt_timeout or config.PAYOUT_RECEIPT_TIMEOUT
+        self._queue = queue.Queue()
+        self._collect_lock = threading.Lock()
+        self._approve_lock = threading.Lock()
+        self._approved = False
+        self._threads = []
+
+    def start(self):
+        """Start the workers and requeue rows left in flight by a previous run."""
+        chain.rpc_pool.start()
+        chain.gas_oracle.start()
+        chain.block_watcher.start()
+        self.resume()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"payout-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logger.info(f"Payout queue started with {self.workers} workers")
+
+    def resume(self):
+        for tx in get_transactions_by_status(*IN_FLIGHT_STATUSES):
+            if tx['status'] == 'processing':
+                # Claimed but never signed: nothing reached the chain
+                claim_transaction(tx['tx_id'], 'processing', 'pending')
+            self._queue.put(tx['tx_id'])
+        if self._queue.qsize():
+            logger.info(f"Resumed {self._queue.qsize()} in-flight payouts")
+
+    def submit(self, tx_id):
+        self._queue.put(tx_id)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _worker(self):
+        while True:
+            if chain.batching_enabled():
+                tx_ids = self._next_batch()
+            else:
+                tx_ids = [self._queue.get()]
+            try:
+                self._process(tx_ids)
+            except Exception as e:
+                logger.exception(f"Payouts {tx_ids} crashed: {e}")
+            finally:
+                for _ in tx_ids:
+                    self._queue.task_done()
+
+    def _next_batch(self):
+        """Collect up to PAYOUT_BATCH_SIZE tx_ids, waiting at most
+        PAYOUT_BATCH_WINDOW seconds after the first one arrives."""
+        with self._collect_lock:
+            tx_ids = [self._queue.get()]
+            deadline = time.monotonic() + config.PAYOUT_BATCH_WINDOW
+            while len(tx_ids) < config.PAYOUT_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    tx_ids.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            return tx_ids
+
+    def _process(self, tx_ids):
+        to_send = []
+        # tx_hash -> (rows paid by that transaction, every hash sent for them,
+        # nonce and fees if we sent it)
+        in_flight = {}
+        for tx_id in tx_ids:
+            tx = get_transaction(tx_id)
+            if tx is None:
+                continue
+            if tx['status'] == 'pending':
+                if not claim_transaction(tx_id, 'pending', 'processing'):
+                    continue
+                if not Web3.is_address(tx['dest_wallet']):
+                    # Reject before a nonce is spent; in a batch one bad
+                    # address would revert every payout with it
+                    self._fail([tx], "Invalid wallet address")
+                    continue
+                to_send.append(tx)
+            elif tx['status'] == 'submitted':
+                # Rows from one batch share their hashes; wait on them once
+                in_flight.setdefault(tx['tx_hash'], ([], sent_hashes(tx), None, None))[0].append(tx)
+
+        if to_send:
+            tx_hash, nonce, fees = self._broadcast(to_send)
+            if tx_hash is not None:
+                in_flight[tx_hash] = (to_send, [tx_hash], nonce, fees)
+
+        for rows, tx_hashes, nonce, fees in in_flight.values():
+            self._settle(rows, tx_hashes, nonce, fees)
+
+    def _settle(self, rows, tx_hashes, nonce, fees):
+        tx_ids = [tx['tx_id'] for tx in rows]
+        tx_hashes = list(tx_hashes)
+        bumps = 0
+        while True:
+            ok, res = chain.wait_for_mat(tx_hashes, timeout=self.receipt_timeout)
+            if ok is not None or nonce is None or bumps >= config.GAS_MAX_BUMPS:
+                break
+            # Stuck: resend the same payouts with the same nonce and higher fees
+            bumps += 1
+            fees = chain.gas_oracle.bump(fees)
+            ok, signed = self._sign(rows, nonce, fees)
+            if ok:
+                replacement = chain.w3.to_hex(signed.hash)
+                ok, err = chain.broadcast(signed)
+            else:
+                err = signed
+            if ok is False:
+                logger.warning(f"Could not replace stuck payouts {tx_ids}: {err}")
+                continue
+            logger.info(f"Replaced stuck payouts {tx_ids} {tx_hashes[-1]} -> {replacement}")
+            tx_hashes.append(replacement)
+            for tx in rows:
+                claim_transaction(tx['tx_id'], 'submitted', 'submitted', replacement)
+
+        if not ok and res == chain.TX_NOT_FOUND and nonce is not None:
+            # The node we asked has not seen it, but another one may still
+            # mine it. Take its nonce with a cancel and refund once that lands.
+            ok, res = self._cancel(rows, tx_hashes, nonce, fees)
+        if ok is None or res == chain.TX_NOT_FOUND:
+            # Still unconfirmed, or resumed after a restart without its nonce
+            # and fees to cancel with; leave it submitted so it is checked
+            # again rather than refunding a payout that may still land
+            logger.warning(f"Payouts {tx_ids} ({tx_hashes[-1]}) not confirmed yet: {res}")
+            return
+        for tx in rows:
+            if ok:
+                # res is whichever of the original and its replacements was mined
+                claim_transaction(tx['tx_id'], 'submitted', 'completed', res)
+            else:
+                fail_transaction(tx['tx_id'])
+            self._notify(tx, ok, res)
+
+    def _cancel(self, rows, tx_hashes, nonce, fees):
+        """Replace dropped payouts with a cancel at their nonce and wait for
+        whichever is mined. Returns (ok, res) like wait_for_mat, with
+        (False, TX_CANCELLED) once the cancel has landed."""
+        tx_ids = [tx['tx_id'] for tx in rows]
+        ok, cancel_hash = chain.send_cancel(nonce, chain.gas_oracle.bump(fees) if fees else None)
+        if ok is False:
+            return None, f"Could not cancel nonce {nonce}: {cancel_hash}"
+        logger.info(f"Payouts {tx_ids} were dropped, cancelling nonce {nonce} with {cancel_hash}")
+        for tx in rows:
+            claim_transaction(tx['tx_id'], 'submitted', 'submitted', cancel_hash=cancel_hash)
+        ok, res = chain.wait_for_mat(tx_hashes + [cancel_hash], timeout=self.receipt_timeout)
+        if ok and res.lower() == cancel_hash.lower():
+            return False, chain.TX_CANCELLED
+        return ok, res
+
+    def _fail(self, rows, error):
+        for tx in rows:
+            fail_transaction(tx['tx_id'])
+            self._notify(tx, False, error)
+
+    def _sign(self, rows, nonce, fees):
+        if len(rows) == 1:
+            tx = rows[0]
+            return chain.sign_mat_transfer(tx['dest_wallet'], from_minor(tx['amount_minor']), nonce, fees)
+        return chain.sign_mat_batch([(tx['dest_wallet'], from_minor(tx['amount_minor'])) for tx in rows], nonce, fees)
+
+    def _broadcast(self, rows, retries=3):
+        """Sign and send claimed payouts as one transaction. Returns
+        (tx_hash, nonce, fees), or Nones after failing the rows."""
+        if chain.nonces is None:
+            self._fail(rows, "Payout wallet not configured")
+            return None, None, None
+
+        if len(rows) > 1:
+            if not self._ensure_allowance():
+                self._fail(rows, "Could not approve the disperse contract")
+                return None, None, None
+
+        for attempt in range(retries):
+            nonce = chain.nonces.allocate()
+            fees = chain.gas_oracle.fees()
+            ok, signed = self._sign(rows, nonce, fees)
+            if not ok:
+                self._release_nonce(nonce)
+                self._fail(rows, signed)
+                return None, None, None
+
+            # Record the hash before broadcasting so a restart can always find it
+            tx_hash = chain.w3.to_hex(signed.hash)
+            from_status = 'processing' if attempt == 0 else 'submitted'
+            for tx in rows:
+                claim_transaction(tx['tx_id'], from_status, 'submitted', tx_hash, nonce)
+
+            ok, res = chain.broadcast(signed)
+            if ok:
+                if len(rows) > 1:
+                    logger.info(f"Sent batch of {len(rows)} payouts in {tx_hash}")
+                return tx_hash, nonce, fees
+            if ok is None:
+                # It may have reached a node, so it keeps its nonce and is
+                # settled like a sent transaction
+                logger.warning(f"Broadcast of payouts {[tx['tx_id'] for tx in rows]} may have failed: {res}")
+                return tx_hash, nonce, fees
+            if chain.nonces.handle_error(res):
+                logger.warning(f"Payouts {[tx['tx_id'] for tx in rows]} hit a stale nonce {nonce}, retrying: {res}")
+                continue
+            self._release_nonce(nonce)
+            break
+
+        self._fail(rows, res)
+        return None, None, None
+
+    def _ensure_allowance(self):
+        """Approve the disperse contract once. The approval gets a lower nonce
+        than the batch that needs it, so there is no need to wait for it."""
+        with self._approve_lock:
+            if self._approved:
+                return True
+            try:
+                if chain.disperse_allowance() >= chain.MAX_UINT256 // 2:
+                    self._approved = True
+                    return True
+            except Exception as e:
+                logger.error(f"Error reading disperse allowance: {e}")
+                return False
+            nonce = chain.nonces.allocate()
+            ok, signed = chain.sign_disperse_approval(nonce)
+            if ok:
+                ok, signed = chain.broadcast(signed)
+            if not ok:
+                if not chain.nonces.handle_error(signed):
+                    chain.nonces.release(nonce)
+                logger.error(f"Disperse approval failed: {signed}")
+                return False
+            logger.info("Approved disperse contract for MAT payouts")
+            self._approved = True
+            return True
+
+    def _release_nonce(self, nonce):
+        chain.nonces.release(nonce)
+        if self._queue.empty():
+            # Nobody is about to reuse it, so plug the gap before it stalls
+            # transactions already sent with higher nonces
+            self._fill_gaps()
+
+    def _fill_gaps(self):
+        for nonce in chain.nonces.take_gaps():
+            ok, signed = chain.sign_cancel(nonce)
+            if ok:
+                ok, signed = chain.broadcast(signed)
+            if ok:
+                logger.info(f"Filled nonce gap {nonce} with a cancel transaction")
+            elif not chain.nonces.handle_error(signed):
+                logger.error(f"Could not fill nonce gap {nonce}: {signed}")
+                chain.nonces.release(nonce)
+
+    def _notify(self, tx, ok, res):
+        try:
+            self.notify(tx['user_id'], tx, ok, res)
+        except Exception as e:
+            logger.error(f"Failed to notify user {tx['user_id']} about payout {tx['tx_id']}: {e}")
@@ -0,0 +1,218 @@
+import logging
+import sqlite3
+import threading
+
+import chain
+import config
+from rpc import quantity
+from database import get_db_connection, claim_transaction, fail_transaction, sent_hashes
+
+logger = logging.getLogger(__name__)
+
+SCANNED_STATUSES = ('pending', 'processing', 'submitted')
+
+
+class Reconciler:
+    """Settles payouts the payout queue has lost track of by checking the chain.
+
+    Every RECONCILE_INTERVAL seconds each in-flight status is scanned in
+    RECONCILE_BATCH_SIZE pages from a checkpoint saved in the database, so a
+    restart continues the scan instead of starting over. Only rows that have
+    not changed for RECONCILE_MIN_AGE seconds are touched, which leaves payouts
+    the queue is still working on alone.
+
+    - submitted rows are looked up with one JSON-RPC batch of receipts per
+      page, covering the original and every fee-bump replacement sent for
+      each row: mined rows are completed, reverted ones failed and refunded. A
+      transaction the node no longer knows about may still be held by another
+      node, so if its nonce is unused a cancel is sent at that nonce (which
+      also fills the gap later payouts wait behind) and the row is refunded
+      on a later pass, once the cancel is mined. If the nonce was used by
+      something else a replacement may have paid it and it is left for
+      manual review.
+    - pending and processing rows never reached the chain. When running next
+      to a PayoutQueue they are handed to it once it is idle; standalone they
+      are failed and refunded.
+
+    notify(user_id, tx_row, ok, result) is called for every settled row, like
+    PayoutQueue's."""
+
+    def __init__(self, notify=None, payout_queue=None, batch_size=None, interval=None, min_age=None):
+        self.notify = notify
+        self.payout_queue = payout_queue
+        self.batch_size = batch_size or config.RECONCILE_BATCH_SIZE
+        self.interval = interval or config.RECONCILE_INTERVAL
+        self.min_age = min_age if min_age is not None else config.RECONCILE_MIN_AGE
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="reconciler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.exception(f"Reconciliation pass failed: {e}")
+
+    def run_once(self):
+        """Scan every in-flight status once. Returns counts per outcome."""
+        totals = {}
+        for status in SCANNED_STATUSES:
+            while True:
+                page = self._next_page(status)
+                if not page:
+                    # End of the table; the next pass starts over
+                    self._save_checkpoint(status, 0)
+                    break
+                for outcome, count in self._reconcile(status, page).items():
+                    totals[outcome] = totals.get(outcome, 0) + count
+                self._save_checkpoint(status, page[-1]['tx_id'])
+        if any(k != 'unchanged' for k in totals):
+            logger.info(f"Reconciliation pass: {totals}")
+        return totals
+
+    def _next_page(self, status):
+        """The next page of old enough rows after the checkpoint."""
+        conn = get_db_connection()
+        row = conn.execute('SELECT last_tx_id FROM reconciler_checkpoints WHERE name = ?', (status,)).fetchone()
+        last_tx_id = row['last_tx_id'] if row else 0
+        return conn.execute(
+            'SELECT * FROM transactions WHERE status = ? AND tx_id > ? '
+            "AND COALESCE(updated_at, created_at) <= datetime('now', ?) ORDER BY tx_id LIMIT ?",
+            (status, last_tx_id, f'-{int(self.min_age)} seconds', self.batch_size)
+        ).fetchall()
+
+    def _save_checkpoint(self, name, last_tx_id):
+        conn = get_db_connection()
+        try:
+            conn.execute(
+                'INSERT INTO reconciler_checkpoints (name, last_tx_id) VALUES (?, ?) '
+                'ON CONFLICT(name) DO UPDATE SET last_tx_id = excluded.last_tx_id, updated_at = CURRENT_TIMESTAMP',
+                (name, last_tx_id)
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f"Error saving reconciler checkpoint {name}: {e}")
+
+    def _reconcile(self, status, page):
+        if status == 'submitted':
+            return self._reconcile_submitted(page)
+        counts = {'unchanged': 0}
+        for tx in page:
+            if status == 'processing':
+                # Claimed by a worker that died before signing
+                if not claim_transaction(tx['tx_id'], 'processing', 'pending'):
+                    counts['unchanged'] += 1
+                    continue
+            if self.payout_queue is None:
+                self._settle(tx, 'pending', False, "Payout was never sent", counts)
+            elif self.payout_queue.qsize() == 0:
+                # An idle queue has lost this row (e.g. a submit that never
+                # happened); a busy one may just not have reached it yet
+                self.payout_queue.submit(tx['tx_id'])
+                counts['requeued'] = counts.get('requeued', 0) + 1
+            else:
+                counts['unchanged'] += 1
+        return counts
+
+    def _reconcile_submitted(self, page):
+        counts = {'unchanged': 0}
+        # The original and every replacement may be the one mined, and the
+        # cancel (last in each list) takes the nonce from all of them
+        hashes = {tx['tx_id']: sent_hashes(tx) + ([tx['cancel_hash']] if tx['cancel_hash'] else []) for tx in page}
+        lookups = [(tx, h) for tx in page for h in hashes[tx['tx_id']]]
+        receipts = chain.rpc_pool.batch([('eth_getTransactionReceipt', [h]) for _, h in lookups])
+        mined = {}
+        for (tx, h), receipt in zip(lookups, receipts):
+            if receipt is not None:
+                mined.setdefault(tx['tx_id'], (h, receipt))
+
+        missing = []
+        for tx in page:
+            if tx['tx_id'] not in mined:
+                missing.append(tx)
+                continue
+            tx_hash, receipt = mined[tx['tx_id']]
+            if tx_hash == tx['cancel_hash']:
+                # The cancel took the nonce, so nothing can pay this row any more
+                self._settle(tx, 'submitted', False, chain.TX_CANCELLED, counts)
+            elif quantity(receipt['status']) == 1:
+                self._settle(tx, 'submitted', True, tx_hash, counts)
+            else:
+                self._settle(tx, 'submitted', False, "Transaction reverted on-chain", counts)
+        if not missing:
+            return counts
+
+        # Any of them still waiting in the mempool is enough
+        lookups = [(tx, h) for tx in missing for h in hashes[tx['tx_id']]]
+        known = chain.rpc_pool.batch(
+            [('eth_getTransactionByHash', [h]) for _, h in lookups]
+            + [('eth_getTransactionCount', [chain.PAYOUT_FROM_ADDRESS, 'latest'])]
+        )
+        used_nonces = quantity(known[-1])
+        in_mempool = {tx['tx_id'] for (tx, _), found in zip(lookups, known) if found is not None}
+
+        cancels = {}  # nonce -> cancel hash sent this pass; batch rows share one
+        for tx in missing:
+            if tx['tx_id'] in in_mempool:
+                counts['unchanged'] += 1
+            elif tx['nonce'] is not None and tx['nonce'] >= used_nonces:
+                self._cancel(tx, cancels, counts)
+            else:
+                logger.warning(f"Payout {tx['tx_id']} ({tx['tx_hash']}) is not on chain but its nonce "
+                               f"{tx['nonce']} was used; check it by hand")
+                counts['review'] = counts.get('review', 0) + 1
+        return counts
+
+    def _cancel(self, tx, cancels, counts):
+        """Send a cancel at the unused nonce of a dropped payout. Refunding
+        waits until it is mined: until then another node may still mine the
+        payout itself."""
+        nonce = tx['nonce']
+        if nonce not in cancels:
+            ok, res = chain.send_cancel(nonce, chain.gas_oracle.bump(chain.gas_oracle.fees()))
+            if ok is False:
+                logger.warning(f"Could not cancel nonce {nonce} of payout {tx['tx_id']}: {res}")
+                res = None
+            else:
+                logger.info(f"Payout {tx['tx_id']} ({tx['tx_hash']}) was dropped, cancelling nonce {nonce} with {res}")
+            cancels[nonce] = res
+        if cancels[nonce] is not None and claim_transaction(tx['tx_id'], 'submitted', 'submitted', cancel_hash=cancels[nonce]):
+            counts['cancelling'] = counts.get('cancelling', 0) + 1
+        else:
+            counts['unchanged'] += 1
+
+    def _settle(self, tx, status, ok, res, counts):
+        if ok:
+            # res is the hash that was mined
+            settled = claim_transaction(tx['tx_id'], status, 'completed', res)
+        else:
+            settled = fail_transaction(tx['tx_id'], from_status=status)
+        if not settled:
+            # Someone else moved it in the meantime
+            counts['unchanged'] += 1
+            return
+        outcome = 'completed' if ok else 'failed'
+        counts[outcome] = counts.get(outcome, 0) + 1
+        logger.info(f"Reconciled payout {tx['tx_id']} ({status}) as {outcome}: {res}")
+        if self.notify is not None:
+            try:
+                self.notify(tx['user_id'], tx, ok, res)
+            except Exception as e:
+                logger.error(f"Failed to notify user {tx['user_id']} about payout {tx['tx_id']}: {e}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    from database import init_db
+    init_db()
+    print(Reconciler().run_once())
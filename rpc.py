@@ -0,0 +1,294 @@
+import logging
+import random
+import threading
+import time
+
+import requests
+from hexbytes import HexBytes
+from requests.adapters import HTTPAdapter
+from web3 import Web3
+from web3._utils.encoding import FriendlyJsonSerde, Web3JsonEncoder
+from web3.providers.base import JSONBaseProvider
+
+import config
+from metrics import RPC_SECONDS, RPC_ERRORS, register_stats
+
+logger = logging.getLogger(__name__)
+
+# JSON-RPC errors public nodes use for throttling; these count against the
+# endpoint and the request is tried on another one
+THROTTLE_CODES = (-32005, -32029, 429)
+THROTTLE_MESSAGES = ('rate limit', 'limit exceeded', 'too many requests')
+
+
+def quantity(value):
+    # JSON-RPC quantities are hex strings; some providers return ints
+    return int(value, 16) if isinstance(value, str) else int(value)
+
+
+def _throttled(response):
+    items = response if isinstance(response, list) else [response]
+    for item in items:
+        error = item.get('error') if isinstance(item, dict) else None
+        if not error:
+            continue
+        message = str(error.get('message', '')).lower()
+        if error.get('code') in THROTTLE_CODES or any(m in message for m in THROTTLE_MESSAGES):
+            return True
+    return False
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures and stays open for
+    `cooldown` seconds. After that requests are let through again and the
+    first failure opens it for another cooldown."""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def available(self, now):
+        return self.failures < self.threshold or now >= self.open_until
+
+    def is_open(self, now):
+        return not self.available(now)
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+
+    def failure(self, now):
+        """Record a failure. Returns True if this opened the breaker."""
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold and now >= self.open_until:
+                self.open_until = now + self.cooldown
+                return True
+            return False
+
+
+class Endpoint:
+    """One RPC URL with its own keep-alive session, breaker and latency."""
+
+    def __init__(self, url, weight, pool_size, breaker_failures, breaker_cooldown):
+        self.url = url
+        self.weight = weight
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+        self.breaker = CircuitBreaker(breaker_failures, breaker_cooldown)
+        self.latency = None  # moving average, seconds
+        self.block = None    # latest block seen by the health probe
+        self.requests = 0
+        self.errors = 0
+
+    def post(self, body, timeout):
+        """Send an encoded JSON-RPC body and return the decoded response.
+        Raises on transport and HTTP errors."""
+        started = time.monotonic()
+        self.requests += 1
+        response = self.session.post(self.url, data=body, timeout=timeout)
+        response.raise_for_status()
+        decoded = FriendlyJsonSerde().json_decode(response.text)
+        elapsed = time.monotonic() - started
+        self.latency = elapsed if self.latency is None else self.latency * 0.8 + elapsed * 0.2
+        return decoded
+
+    def name(self):
+        # Keys are often part of the URL; only log the host
+        return self.url.split('/')[2] if '://' in self.url else self.url
+
+
+class RpcPool:
+    """Spreads JSON-RPC traffic over the BSC_RPC_URLS endpoints.
+
+    Each request goes to an endpoint picked at random, weighted by its
+    configured weight divided by its recent latency, so faster nodes get more
+    of the traffic. Endpoints that fail or throttle RPC_BREAKER_FAILURES times
+    in a row are skipped for RPC_BREAKER_COOLDOWN seconds, and a failed request
+    is tried on the next endpoint. A health probe checks every endpoint each
+    RPC_HEALTH_INTERVAL seconds and skips nodes more than RPC_MAX_BLOCK_LAG
+    blocks behind the others."""
+
+    def __init__(self, endpoints=None, timeout=None, batch_limit=None, health_interval=None, max_block_lag=None):
+        endpoints = endpoints if endpoints is not None else config.BSC_RPC_URLS
+        self.endpoints = [
+            Endpoint(url, weight, config.RPC_POOL_SIZE, config.RPC_BREAKER_FAILURES, config.RPC_BREAKER_COOLDOWN)
+            for url, weight in endpoints
+        ]
+        self.timeout = timeout or config.RPC_TIMEOUT
+        self.batch_limit = batch_limit or config.RPC_BATCH_LIMIT
+        self.health_interval = health_interval or config.RPC_HEALTH_INTERVAL
+        self.max_block_lag = max_block_lag if max_block_lag is not None else config.RPC_MAX_BLOCK_LAG
+        self._thread = None
+        self._stop = threading.Event()
+        register_stats('mat_rpc_endpoint', self.stats, label='endpoint')
+
+    def start(self):
+        """Start the background health probe."""
+        if not self.endpoints:
+            logger.warning("No RPC endpoints configured. Check BSC_RPC_URLS")
+            return
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="rpc-health", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _candidates(self, tried):
+        now = time.monotonic()
+        untried = [e for e in self.endpoints if e not in tried]
+        best = max((e.block for e in self.endpoints if e.block is not None), default=None)
+        ready = [
+            e for e in untried
+            if e.breaker.available(now) and (best is None or e.block is None or best - e.block <= self.max_block_lag)
+        ]
+        # With every breaker open, trying anyway beats failing every call
+        return ready or untried
+
+    def _choose(self, tried):
+        candidates = self._candidates(tried)
+        if not candidates:
+            return None
+        # Endpoints not measured yet get the average latency
+        known = [e.latency for e in candidates if e.latency]
+        default = sum(known) / len(known) if known else 1.0
+        scores = [e.weight / max(e.latency or default, 0.001) for e in candidates]
+        return random.choices(candidates, weights=scores)[0]
+
+    def post(self, body, method):
+        """Send an encoded body to one endpoint, moving on to the next one on
+        transport errors, HTTP errors and throttling. Returns
+        (endpoint, decoded_response, attempts). method only labels metrics."""
+        started = time.perf_counter()
+        try:
+            return self._post(body)
+        except ConnectionError:
+            RPC_ERRORS.inc(method=method)
+            raise
+        finally:
+            RPC_SECONDS.observe(time.perf_counter() - started, method=method)
+
+    def _post(self, body):
+        if not self.endpoints:
+            raise ConnectionError("No RPC endpoints configured")
+        tried = []
+        last_error = None
+        while True:
+            endpoint = self._choose(tried)
+            if endpoint is None:
+                raise ConnectionError(f"All RPC endpoints failed: {last_error}")
+            tried.append(endpoint)
+            try:
+                response = endpoint.post(body, self.timeout)
+            except (requests.RequestException, ValueError) as e:
+                last_error = e
+            else:
+                if not _throttled(response):
+                    endpoint.breaker.success()
+                    return endpoint, response, len(tried)
+                last_error = "throttled"
+            endpoint.errors += 1
+            if endpoint.breaker.failure(time.monotonic()):
+                logger.warning(f"RPC endpoint {endpoint.name()} disabled for {endpoint.breaker.cooldown}s: {last_error}")
+
+    def call(self, method, params):
+        """Send one call and return its result. Raises on a JSON-RPC error."""
+        body = FriendlyJsonSerde().json_encode(
+            {'jsonrpc': '2.0', 'id': 0, 'method': method, 'params': params}, Web3JsonEncoder)
+        _, response, _ = self.post(body, method)
+        if 'error' in response:
+            raise RuntimeError(f"{method} failed: {response['error']}")
+        return response.get('result')
+
+    def batch(self, calls):
+        """Send [(method, params), ...] as JSON-RPC batch requests of at most
+        RPC_BATCH_LIMIT calls and return the results in the same order.
+        Raises if any call failed."""
+        results = [None] * len(calls)
+        for start in range(0, len(calls), self.batch_limit):
+            chunk = calls[start:start + self.batch_limit]
+            payload = [{'jsonrpc': '2.0', 'id': start + i, 'method': method, 'params': params}
+                       for i, (method, params) in enumerate(chunk)]
+            body = FriendlyJsonSerde().json_encode(payload, Web3JsonEncoder)
+            _, response, _ = self.post(body, f'batch:{chunk[0][0]}')
+            if isinstance(response, dict):
+                # A node that rejects the whole batch answers with one error
+                raise RuntimeError(f"Batch request failed: {response.get('error')}")
+            # Responses may come back in any order
+            for item in response:
+                if 'error' in item:
+                    raise RuntimeError(f"{calls[item['id']][0]} failed: {item['error']}")
+                results[item['id']] = item.get('result')
+        return results
+
+    def _run(self):
+        while True:
+            self.probe()
+            if self._stop.wait(self.health_interval):
+                return
+
+    def probe(self):
+        """Ask every endpoint for its block number. Returns the number of
+        endpoints that answered."""
+        body = FriendlyJsonSerde().json_encode({'jsonrpc': '2.0', 'id': 0, 'method': 'eth_blockNumber', 'params': []})
+        healthy = 0
+        for endpoint in self.endpoints:
+            was_open = endpoint.breaker.is_open(time.monotonic())
+            try:
+                block = quantity(endpoint.post(body, self.timeout)['result'])
+            except Exception as e:
+                endpoint.errors += 1
+                if endpoint.breaker.failure(time.monotonic()):
+                    logger.warning(f"RPC endpoint {endpoint.name()} failed its health check, disabled "
+                                   f"for {endpoint.breaker.cooldown}s: {e}")
+                continue
+            endpoint.block = block
+            endpoint.breaker.success()
+            healthy += 1
+            if was_open:
+                logger.info(f"RPC endpoint {endpoint.name()} is healthy again")
+        if not healthy:
+            logger.warning("No RPC endpoint is reachable. Check BSC_RPC_URLS")
+        return healthy
+
+    def stats(self):
+        now = time.monotonic()
+        return [{
+            'endpoint': e.name(),
+            'weight': e.weight,
+            'latency': e.latency,
+            'block': e.block,
+            'open': e.breaker.is_open(now),
+            'requests': e.requests,
+            'errors': e.errors,
+        } for e in self.endpoints]
+
+
+class PooledProvider(JSONBaseProvider):
+    """web3 provider that sends every request through an RpcPool."""
+
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    def make_request(self, method, params):
+        body = self.encode_rpc_request(method, params)
+        _, response, attempts = self.pool.post(body, method)
+        if method == 'eth_sendRawTransaction' and attempts > 1 and 'error' in response:
+            # The first endpoint may have accepted it before failing; the node
+            # that answered has then heard of it from the network
+            message = str(response['error'].get('message', '')).lower()
+            if 'already known' in message or 'known transaction' in message:
+                return {'jsonrpc': '2.0', 'id': response.get('id'), 'result': Web3.to_hex(Web3.keccak(HexBytes(params[0])))}
+        return response
+
+    def is_connected(self, show_traceback=False):
+        return any(e.block is not None and not e.breaker.is_open(time.monotonic()) for e in self.pool.endpoints)
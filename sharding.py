@@ -0,0 +1,313 @@
+"""Multi-process mode: python sharding.py instead of python bot.py.
+
+The parent process receives updates (long polling, or the webhook when
+WEBHOOK_URL / WEBHOOK_PORT is set) and hands each one to one of
+SHARD_PROCESSES worker processes, chosen by the sender's user id, so one
+user's updates are always handled in order by the same process while
+different users use different cores. Workers run bot.py's handlers.
+
+Only the parent sends payouts: a withdrawal handled by a worker is passed to
+it over a shared channel, so one NonceManager owns the hot wallet's nonces.
+Broadcasts go the same way: a worker only records a /broadcast and passes
+its id on, so the sending never runs in a process that a restart would
+kill. The parent also runs the reconciler, resumes broadcasts and sends
+payout results.
+
+A worker that dies is restarted (with a backoff if it keeps dying). Send the
+parent SIGHUP for a rolling restart: each worker finishes the updates
+queued before it, then a fresh process, running the code now on disk, takes
+over its queue. The state that workers keep in memory is adjusted for this:
+user rows are cached for SHARD_USER_CACHE_TTL seconds, the leaderboard is
+reloaded every SHARD_LEADERBOARD_REFRESH seconds, abuse checks use the
+database and each process gets an equal share of OUTBOX_GLOBAL_RATE."""
+import importlib
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+import config
+from webhook import update_user_id
+
+logger = logging.getLogger(__name__)
+
+POLL_TIMEOUT = 20  # seconds per getUpdates long poll
+
+
+class PayoutChannel:
+    """Stands in for handlers.payout_queue in worker processes."""
+
+    def __init__(self, channel):
+        self._channel = channel
+
+    def submit(self, tx_id):
+        self._channel.put(tx_id)
+
+    def qsize(self):
+        return 0
+
+
+class BroadcastChannel:
+    """Stands in for handlers.broadcaster in worker processes: it records the
+    broadcast and leaves the sending to the parent."""
+
+    def __init__(self, channel, broadcaster):
+        self._channel = channel
+        self._broadcaster = broadcaster
+
+    def start(self, text):
+        broadcast_id = self._broadcaster.create(text)
+        if broadcast_id is not None:
+            self._channel.put(broadcast_id)
+        return broadcast_id
+
+
+def _shared_settings(processes):
+    """Settings for every process. Set in the parent's environment before
+    bot is imported, and inherited by the workers."""
+    return {
+        # Telegram's limit is per bot, not per process
+        'OUTBOX_GLOBAL_RATE': str(config.OUTBOX_GLOBAL_RATE / (processes + 1)),
+        'USER_CACHE_TTL': str(min(config.USER_CACHE_TTL, config.SHARD_USER_CACHE_TTL)),
+    }
+
+
+def _refresh_leaderboard(interval):
+    from database import reload_leaderboard
+    while True:
+        time.sleep(interval)
+        try:
+            reload_leaderboard()
+        except Exception as e:
+            logger.warning(f"Could not reload the leaderboard: {e}")
+
+
+def _worker_main(index, updates, payouts, broadcasts, env):
+    os.environ.update(env)
+    importlib.reload(config)
+    # Ctrl-C reaches the whole process group; the parent stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import abuse
+    import bot
+    import handlers
+    import metrics
+    from telebot.types import Update
+
+    handlers.payout_queue = PayoutChannel(payouts)
+    handlers.broadcaster = BroadcastChannel(broadcasts, handlers.broadcaster)
+    abuse.detector.shared = True
+    bot.bot.threaded = False
+    metrics.start_server()
+    bot.outbox.start()
+    threading.Thread(target=_refresh_leaderboard, args=(config.SHARD_LEADERBOARD_REFRESH,),
+                     name="leaderboard-refresh", daemon=True).start()
+    logger.info(f"Shard worker {index} started (pid {os.getpid()})")
+
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        try:
+            bot.bot.process_new_updates([Update.de_json(data)])
+        except Exception as e:
+            logger.exception(f"Error handling update {data.get('update_id')}: {e}")
+
+    # Send the replies still queued before exiting
+    deadline = time.monotonic() + config.SHARD_DRAIN_TIMEOUT
+    while bot.outbox.qsize() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    logger.info(f"Shard worker {index} stopped")
+
+
+class ShardedDispatcher:
+    """Routes updates to worker processes by user id and keeps them running."""
+
+    def __init__(self, processes=None, queue_size=None):
+        self.processes = processes or config.SHARD_PROCESSES or os.cpu_count() or 1
+        queue_size = queue_size or config.SHARD_QUEUE_SIZE
+        # Fresh interpreters: no inherited threads or connections, and a
+        # restarted worker runs the current code
+        self._ctx = multiprocessing.get_context('spawn')
+        self._queues = [self._ctx.Queue(queue_size) for _ in range(self.processes)]
+        self._payouts = self._ctx.Queue()
+        self._broadcasts = self._ctx.Queue()
+        self._workers = [None] * self.processes
+        self._started = [0.0] * self.processes
+        self._failures = [0] * self.processes
+        self._restarting = set()
+        self.restarts = [0] * self.processes
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def _env(self, index):
+        # Each worker serves its own /metrics on the next ports
+        return {'METRICS_PORT': str(config.METRICS_PORT + 1 + index) if config.METRICS_PORT else '0'}
+
+    def _spawn(self, index):
+        process = self._ctx.Process(
+            target=_worker_main, args=(index, self._queues[index], self._payouts, self._broadcasts, self._env(index)),
+            name=f"shard-{index}", daemon=True)
+        process.start()
+        self._workers[index] = process
+        self._started[index] = time.monotonic()
+
+    def start(self, payout_queue, broadcaster):
+        """Start the workers, and forward their withdrawals to payout_queue
+        and their broadcasts to broadcaster."""
+        for index in range(self.processes):
+            self._spawn(index)
+        threading.Thread(target=self._forward_payouts, args=(payout_queue,), name="payout-channel", daemon=True).start()
+        threading.Thread(target=self._forward_broadcasts, args=(broadcaster,), name="broadcast-channel", daemon=True).start()
+        threading.Thread(target=self._monitor, name="shard-monitor", daemon=True).start()
+        logger.info(f"Dispatching updates to {self.processes} worker processes")
+
+    def _forward_payouts(self, payout_queue):
+        while True:
+            payout_queue.submit(self._payouts.get())
+
+    def _forward_broadcasts(self, broadcaster):
+        while True:
+            broadcaster.send(self._broadcasts.get())
+
+    def _monitor(self):
+        retry_at = {}
+        while not self._stopping.wait(1):
+            now = time.monotonic()
+            with self._lock:
+                for index, process in enumerate(self._workers):
+                    if process.is_alive() or index in self._restarting or self._stopping.is_set():
+                        continue
+                    if index not in retry_at:
+                        # Updates it had taken off its queue are lost
+                        logger.error(f"Shard worker {index} exited with code {process.exitcode}")
+                        # Back off while it keeps dying soon after starting
+                        self._failures[index] = self._failures[index] + 1 if now - self._started[index] < 30 else 0
+                        retry_at[index] = now + min(30, 2 ** self._failures[index] - 1)
+                    if now >= retry_at[index]:
+                        del retry_at[index]
+                        logger.info(f"Restarting shard worker {index}")
+                        self.restarts[index] += 1
+                        self._spawn(index)
+
+    def restart(self):
+        """Rolling restart, one worker at a time."""
+        for index in range(self.processes):
+            with self._lock:
+                self._restarting.add(index)
+                old = self._workers[index]
+            try:
+                # The worker exits after the updates queued before the sentinel
+                self._queues[index].put(None)
+                old.join(config.SHARD_DRAIN_TIMEOUT + 30)
+                if old.is_alive():
+                    logger.warning(f"Shard worker {index} did not stop in time, terminating it")
+                    old.terminate()
+                    old.join()
+                with self._lock:
+                    self.restarts[index] += 1
+                    self._spawn(index)
+            finally:
+                with self._lock:
+                    self._restarting.discard(index)
+        logger.info("Rolling restart finished")
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        for q in self._queues:
+            try:
+                q.put_nowait(None)
+            except queue.Full:
+                # A saturated worker is terminated at the deadline instead
+                pass
+        deadline = time.monotonic() + (timeout or config.SHARD_DRAIN_TIMEOUT + 5)
+        for process in self._workers:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+
+    def _shard(self, data):
+        user_id = update_user_id(data)
+        return (user_id if user_id is not None else data.get('update_id', 0)) % self.processes
+
+    def enqueue(self, data):
+        """Queue a decoded update. Returns False if its worker is saturated."""
+        try:
+            self._queues[self._shard(data)].put_nowait(data)
+            return True
+        except queue.Full:
+            return False
+
+    def put(self, data):
+        """Queue a decoded update, waiting while its worker is saturated."""
+        self._queues[self._shard(data)].put(data)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self):
+        return [{
+            'shard': str(index),
+            'queued': self._queues[index].qsize(),
+            'alive': process.is_alive(),
+            'restarts': self.restarts[index],
+        } for index, process in enumerate(self._workers)]
+
+    def poll(self, token):
+        """Long-poll Telegram and dispatch every update until stopped."""
+        from telebot import apihelper
+        offset = None
+        while not self._stopping.is_set():
+            try:
+                updates = apihelper.get_updates(token, offset, 100, POLL_TIMEOUT)
+            except Exception as e:
+                logger.error(f"getUpdates failed: {e}")
+                time.sleep(3)
+                continue
+            for data in updates:
+                self.put(data)
+                offset = data['update_id'] + 1
+
+
+def main():
+    # Before bot is imported, so its objects are built with these values
+    processes = config.SHARD_PROCESSES or os.cpu_count() or 1
+    os.environ.update(_shared_settings(processes))
+    importlib.reload(config)
+
+    import bot
+    import metadata
+    import metrics
+
+    if config.STATE_BACKEND == 'memory':
+        logger.warning("STATE_BACKEND=memory: registrations in progress are lost when a worker restarts")
+    dispatcher = ShardedDispatcher(processes)
+    metrics.register_stats('mat_shard', dispatcher.stats, label='shard')
+    metrics.start_server()
+    metadata.warm()
+    bot.outbox.start()
+    bot.broadcaster.resume()
+    bot.payout_queue.start()
+    bot.reconciler.start()
+    dispatcher.start(bot.payout_queue, bot.broadcaster)
+
+    signal.signal(signal.SIGHUP, lambda *_: threading.Thread(target=dispatcher.restart, daemon=True).start())
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        if config.WEBHOOK_URL or config.WEBHOOK_PORT:
+            from webhook import run_webhook
+            run_webhook(bot.bot, dispatcher)
+        else:
+            dispatcher.poll(bot.bot.token)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        logger.info("Stopping shard workers")
+        dispatcher.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""Conversation state (registration step and the wallet awaiting confirmation)
+kept per user with a TTL, so abandoned registrations don't pile up"""
+import logging
+import sqlite3
+import threading
+import time
+
+import config
+from database import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ('state', 'wallet', 'expires')
+
+    def __init__(self, state, wallet, expires):
+        self.state = state
+        self.wallet = wallet
+        self.expires = expires
+
+
+class MemoryStateStore:
+    """In-process store. Expired entries are swept at most every
+    sweep_interval seconds, on the next write."""
+
+    def __init__(self, ttl=None, sweep_interval=None):
+        self.ttl = ttl or config.STATE_TTL
+        self.sweep_interval = sweep_interval or config.STATE_SWEEP_INTERVAL
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + self.sweep_interval
+
+    def _get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry.expires <= time.monotonic():
+            return None
+        return entry
+
+    def get_state(self, user_id):
+        entry = self._get(user_id)
+        return entry.state if entry else None
+
+    def get_wallet(self, user_id):
+        entry = self._get(user_id)
+        return entry.wallet if entry else None
+
+    def set_state(self, user_id, state):
+        """Move the user to state, keeping any wallet already entered."""
+        with self._lock:
+            entry = self._get(user_id)
+            self._put(user_id, state, entry.wallet if entry else None)
+
+    def set_wallet(self, user_id, wallet, state):
+        with self._lock:
+            self._put(user_id, state, wallet)
+
+    def clear(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def _put(self, user_id, state, wallet):
+        now = time.monotonic()
+        self._entries[user_id] = _Entry(state, wallet, now + self.ttl)
+        if now >= self._next_sweep:
+            self._sweep(now)
+
+    def _sweep(self, now):
+        expired = [user_id for user_id, entry in self._entries.items() if entry.expires <= now]
+        for user_id in expired:
+            del self._entries[user_id]
+        self._next_sweep = now + self.sweep_interval
+        if expired:
+            logger.info(f"Expired {len(expired)} conversation states, {len(self._entries)} left")
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteStateStore:
+    """Store in the bot database, shared by every worker process that opens
+    it. Expired rows are deleted at most every sweep_interval seconds."""
+
+    def __init__(self, ttl=None, sweep_interval=None):
+        self.ttl = ttl or config.STATE_TTL
+        self.sweep_interval = sweep_interval or config.STATE_SWEEP_INTERVAL
+        self._next_sweep = time.time() + self.sweep_interval
+        conn = get_db_connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_state (
+                user_id INTEGER PRIMARY KEY,
+                state TEXT,
+                wallet TEXT,
+                expires_at REAL NOT NULL
+            ) WITHOUT ROWID
+        ''')
+        conn.commit()
+
+    def _get(self, user_id):
+        conn = get_db_connection()
+        return conn.execute(
+            'SELECT state, wallet FROM conversation_state WHERE user_id = ? AND expires_at > ?',
+            (user_id, time.time())
+        ).fetchone()
+
+    def get_state(self, user_id):
+        row = self._get(user_id)
+        return row['state'] if row else None
+
+    def get_wallet(self, user_id):
+        row = self._get(user_id)
+        return row['wallet'] if row else None
+
+    def set_state(self, user_id, state):
+        """Move the user to state, keeping any wallet already entered."""
+        now = time.time()
+        self._write('''
+            INSERT INTO conversation_state (user_id, state, wallet, expires_at) VALUES (?, ?, NULL, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                state = excluded.state,
+                wallet = CASE WHEN conversation_state.expires_at > ? THEN conversation_state.wallet END,
+                expires_at = excluded.expires_at
+        ''', (user_id, state, now + self.ttl, now), now)
+
+    def set_wallet(self, user_id, wallet, state):
+        now = time.time()
+        self._write(
+            'INSERT OR REPLACE INTO conversation_state (user_id, state, wallet, expires_at) VALUES (?, ?, ?, ?)',
+            (user_id, state, wallet, now + self.ttl), now
+        )
+
+    def clear(self, user_id):
+        self._write('DELETE FROM conversation_state WHERE user_id = ?', (user_id,), time.time())
+
+    def _write(self, sql, params, now):
+        conn = get_db_connection()
+        try:
+            conn.execute(sql, params)
+            if now >= self._next_sweep:
+                self._next_sweep = now + self.sweep_interval
+                cursor = conn.execute('DELETE FROM conversation_state WHERE expires_at <= ?', (now,))
+                if cursor.rowcount:
+                    logger.info(f"Expired {cursor.rowcount} conversation states")
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f"Error saving conversation state for {params[0]}: {e}")
+
+
+def create_state_store(backend=None):
+    backend = backend or config.STATE_BACKEND
+    if backend == 'sqlite':
+        return SQLiteStateStore()
+    if backend != 'memory':
+        raise ValueError(f"Unknown STATE_BACKEND: {backend}")
+    return MemoryStateStore()
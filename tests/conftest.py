@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    from local_chain import LocalChain
+except ImportError:  # eth-tester is not installed
+    LocalChain = None
+
+# Set before any bot module is imported. Fixed values win over .env, which
+# load_dotenv never overrides.
+os.environ.update({
+    'BOT_TOKEN': '1:test',
+    'BSC_RPC_URLS': 'http://127.0.0.1:9',
+    'BSC_RPC_URL': '',
+    'PRIVATE_KEY': '',
+    'PAYOUT_FROM_ADDRESS': '',
+    'MAT_TOKEN_ADDRESS': '',
+    'DISPERSE_CONTRACT_ADDRESS': '',
+    'ADMIN_IDS': '',
+    'METRICS_PORT': '0',
+    'WEBHOOK_URL': '',
+    'WEBHOOK_PORT': '0',
+    'WEBHOOK_SECRET': '',
+    'BLOCK_POLL_INTERVAL': '0.05',
+    'RPC_HEALTH_INTERVAL': '3600',
+    'PAYOUT_RECEIPT_TIMEOUT': '2',
+})
+
+LOCAL_CHAIN = None
+if LocalChain is not None:
+    LOCAL_CHAIN = LocalChain()
+    LOCAL_CHAIN.token = LOCAL_CHAIN.deploy('Token', 10**30)
+    LOCAL_CHAIN.disperse = LOCAL_CHAIN.deploy('Disperse')
+    os.environ.update({
+        'BSC_RPC_URLS': LOCAL_CHAIN.url,
+        'PRIVATE_KEY': LOCAL_CHAIN.account.key.hex(),
+        'PAYOUT_FROM_ADDRESS': LOCAL_CHAIN.account.address,
+        'MAT_TOKEN_ADDRESS': LOCAL_CHAIN.token.address,
+        # Used only by tests that raise PAYOUT_BATCH_SIZE
+        'DISPERSE_CONTRACT_ADDRESS': LOCAL_CHAIN.disperse.address,
+    })
+
+# The database lives in the working directory
+os.chdir(tempfile.mkdtemp(prefix='mat-tests-'))
+
+
+@pytest.fixture(scope='session')
+def db():
+    import database
+    database.init_db()
+    return database
+
+
+@pytest.fixture
+def local_chain(db):
+    if LOCAL_CHAIN is None:
+        pytest.skip('eth-tester is not installed')
+    return LOCAL_CHAIN
@@ -0,0 +1,19 @@
+# @version 0.3.10
+# Disperse contract for the batch payout tests.
+# Disperse.json holds the output of: vyper -f abi,bytecode Disperse.vy
+interface ERC20:
+    def transferFrom(_from: address, _to: address, _value: uint256) -> bool: nonpayable
+
+@external
+def disperseTokenSimple(token: address, recipients: DynArray[address, 256], values: DynArray[uint256, 256]):
+    for i in range(256):
+        if i >= len(recipients):
+            break
+        ERC20(token).transferFrom(msg.sender, recipients[i], values[i])
+
+@external
+def disperseToken(token: address, recipients: DynArray[address, 256], values: DynArray[uint256, 256]):
+    for i in range(256):
+        if i >= len(recipients):
+            break
+        ERC20(token).transferFrom(msg.sender, recipients[i], values[i])
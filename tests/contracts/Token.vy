@@ -0,0 +1,30 @@
+# @version 0.3.10
+# Minimal ERC-20 with 18 decimals for the payout tests.
+# Token.json holds the output of: vyper -f abi,bytecode Token.vy
+balanceOf: public(HashMap[address, uint256])
+allowance: public(HashMap[address, HashMap[address, uint256]])
+decimals: public(uint8)
+
+@external
+def __init__(supply: uint256):
+    self.balanceOf[msg.sender] = supply
+    self.decimals = 18
+
+@external
+def transfer(_to: address, _value: uint256) -> bool:
+    self.balanceOf[msg.sender] -= _value
+    self.balanceOf[_to] += _value
+    return True
+
+@external
+def approve(_spender: address, _value: uint256) -> bool:
+    self.allowance[msg.sender][_spender] = _value
+    return True
+
+@external
+def transferFrom(_from: address, _to: address, _value: uint256) -> bool:
+    if self.allowance[_from][msg.sender] != max_value(uint256):
+        self.allowance[_from][msg.sender] -= _value
+    self.balanceOf[_from] -= _value
+    self.balanceOf[_to] += _value
+    return True
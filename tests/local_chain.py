@@ -0,0 +1,108 @@
+"""An in-process chain for the payout tests: eth-tester behind a JSON-RPC
+HTTP server, so the bot's RpcPool talks to it exactly as to a real node.
+
+eth-tester mines every transaction as soon as it is accepted. fail_next()
+makes the server answer the next call of a method with an HTTP 500, before
+or after handing it to the chain, to play a node that times out."""
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from eth_account import Account
+from eth_tester import EthereumTester
+from web3 import EthereumTesterProvider, Web3
+
+CONTRACTS = os.path.join(os.path.dirname(__file__), 'contracts')
+
+
+def _camel(key):
+    first, *rest = key.split('_')
+    return first + ''.join(part.title() for part in rest)
+
+
+def _encode(value):
+    return value.hex() if hasattr(value, 'hex') else str(value)
+
+
+class LocalChain:
+    def __init__(self):
+        self.tester = EthereumTester()
+        self.w3 = Web3(EthereumTesterProvider(self.tester))
+        self.account = Account.from_key('0x' + '42' * 32)
+        self.tester.add_account(self.account.key.hex())
+        self.w3.eth.send_transaction({'from': self.w3.eth.accounts[0], 'to': self.account.address, 'value': 10**20})
+        self.calls = {}
+        self._faults = {}
+        self._lock = threading.Lock()
+        chain = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                response = chain.handle(request)
+                if response is None:
+                    self.send_response(500)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = json.dumps(response, default=_encode).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def deploy(self, name, *args):
+        with open(os.path.join(CONTRACTS, f'{name}.json')) as f:
+            compiled = json.load(f)
+        contract = self.w3.eth.contract(abi=compiled['abi'], bytecode=compiled['bytecode'])
+        tx_hash = contract.constructor(*args).transact({'from': self.account.address})
+        address = self.w3.eth.get_transaction_receipt(tx_hash).contractAddress
+        return self.w3.eth.contract(address=address, abi=compiled['abi'])
+
+    def fail_next(self, method, after=False):
+        """Answer the next `method` call with an HTTP 500. With after=True the
+        call still reaches the chain first."""
+        with self._lock:
+            self._faults[method] = after
+
+    def handle(self, request):
+        requests = request if isinstance(request, list) else [request]
+        responses = []
+        with self._lock:
+            failed = False
+            for item in requests:
+                method = item['method']
+                self.calls[method] = self.calls.get(method, 0) + 1
+                if method in self._faults:
+                    failed = True
+                    if not self._faults.pop(method):
+                        continue
+                responses.append(self._call(item))
+        if failed:
+            return None
+        return responses if isinstance(request, list) else responses[0]
+
+    def _call(self, item):
+        method, params = item['method'], item['params']
+        if method == 'eth_getBlockByNumber' and params[0].startswith('0x'):
+            params[0] = int(params[0], 16)
+        if method in ('eth_call', 'eth_estimateGas'):
+            params[0].setdefault('from', self.account.address)
+        try:
+            response = self.w3.provider.make_request(method, params)
+        except Exception as e:
+            response = {'error': {'code': -32000, 'message': str(e)}}
+        if isinstance(response.get('result'), dict):
+            # eth-tester answers with snake_case keys
+            response['result'] = {_camel(k): v for k, v in response['result'].items()}
+        response.update({'jsonrpc': '2.0', 'id': item['id']})
+        return response
@@ -0,0 +1,68 @@
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+import pytest
+from eth_account import Account
+
+_user_ids = itertools.count(3000)
+
+
+@pytest.fixture
+def referral(db):
+    """A referrer and a referee who has not registered yet."""
+    referrer, referee = next(_user_ids), next(_user_ids)
+    db.add_user(referrer, f'user{referrer}')
+    db.add_user(referee, f'user{referee}', referrer)
+    return referrer, referee
+
+
+def test_registering_again_pays_nothing(db, referral):
+    import abuse
+    referrer, referee = referral
+    wallet = Account.create().address
+    assert abuse.register(referee, wallet) == (True, False)
+    assert abuse.register(referee, wallet) == (False, False)
+    assert abuse.register(referee, Account.create().address) == (False, False)
+
+    assert db.get_user(referee)['balance_minor'] == 2 * db.MINOR_UNITS
+    assert db.get_user(referee)['wallet_address'] == wallet
+    row = db.get_user(referrer)
+    assert (row['balance_minor'], row['referrals']) == (800000, 1)
+
+
+def test_async_registration_pays_once(db, referral):
+    import abuse
+    referrer, referee = referral
+    wallet = Account.create().address
+
+    async def register():
+        return [await abuse.register_async(referee, wallet, asyncio.to_thread) for _ in range(2)]
+
+    assert asyncio.run(register()) == [(True, False), (False, False)]
+    assert db.get_user(referee)['balance_minor'] == 2 * db.MINOR_UNITS
+    assert db.get_user(referrer)['balance_minor'] == 800000
+
+
+def test_racing_confirms_are_paid_once(db, referral):
+    referrer, referee = referral
+    wallet = Account.create().address
+    # Both passed the registered check before either was committed
+    assert db.update_user_wallet(referee, wallet, referrer)
+    assert db.update_user_wallet(referee, wallet, referrer)
+    assert db.hold_credit(referee, 'registration', 2, ['duplicate_wallet'], wallet_address=wallet) is None
+    assert db.get_user(referee)['balance_minor'] == 2 * db.MINOR_UNITS
+    assert db.get_user(referrer)['balance_minor'] == 800000
+
+
+def test_registration_buttons_are_refused_once_registered(db, referral):
+    import abuse
+    import handlers
+    _, referee = referral
+    abuse.register(referee, Account.create().address)
+    call = SimpleNamespace(data='check_tasks', id='1', from_user=SimpleNamespace(id=referee, first_name='Ann'),
+                           message=SimpleNamespace(chat=SimpleNamespace(id=referee), message_id=7))
+    handlers.button_handler(call, handlers.outbox)
+    assert handlers.states.get_state(referee) is None
+    [job] = [job for _, _, job in handlers.outbox._ready if job.chat_id == referee]
+    assert job.args[0] == handlers.already_registered_text(db.get_user(referee))
@@ -0,0 +1,104 @@
+import asyncio
+import itertools
+import threading
+import time
+
+import pytest
+
+_user_ids = itertools.count(2000)
+
+
+@pytest.fixture
+def user(db):
+    def create(balance=0):
+        user_id = next(_user_ids)
+        db.add_user(user_id, f'user{user_id}')
+        if balance:
+            db.update_balance(user_id, balance)
+        return user_id
+    return create
+
+
+def test_concurrent_credits_are_all_committed(db, user):
+    referrer = user()
+    referees = [user() for _ in range(200)]
+    batcher = db.CreditBatcher(flush_ms=20, max_events=50)
+    results = []
+
+    def credit(referee):
+        results.append(batcher.submit(referrer, 'referral', 0.8, referrals=1, referee_id=referee))
+
+    threads = [threading.Thread(target=credit, args=(r,)) for r in referees]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == [True] * 200
+    row = db.get_user(referrer)
+    assert row['balance_minor'] == 200 * 800000
+    assert row['referrals'] == 200
+    conn = db.get_db_connection()
+    assert conn.execute('SELECT COUNT(*) FROM credits WHERE user_id = ?', (referrer,)).fetchone()[0] == 200
+    assert conn.execute('SELECT COUNT(*) FROM referrals WHERE referrer_id = ?', (referrer,)).fetchone()[0] == 200
+
+
+def test_credits_submitted_together_share_one_flush(db, user):
+    first, second = user(), user()
+    batcher = db.CreditBatcher(flush_ms=1000)
+    started = time.monotonic()
+    assert batcher.submit_many([(first, 'registration', 2, 0, None, None), (second, 'referral', 0.8, 1, None, first)])
+    assert time.monotonic() - started < 2
+    assert db.get_user(first)['balance_minor'] == 2000000
+    assert db.get_user(second)['balance_minor'] == 800000
+
+
+def test_a_failed_flush_does_not_stop_the_batcher(db, user):
+    user_id = user()
+    batcher = db.CreditBatcher(flush_ms=1)
+    # Too large for an SQLite integer
+    assert not batcher.submit(user_id, 'registration', 10**20)
+    assert batcher._thread.is_alive()
+    assert batcher.submit(user_id, 'registration', 2)
+    assert db.get_user(user_id)['balance_minor'] == 2000000
+
+
+def test_submit_gives_up_after_the_timeout(db, user):
+    user_id = user()
+    batcher = db.CreditBatcher(timeout=0.1)
+    # A flusher that never runs
+    batcher._thread = threading.Thread(target=lambda: None)
+    assert not batcher.submit(user_id, 'registration', 2)
+    # The abandoned credit is dropped, not committed later
+    assert batcher._pending == []
+    assert db.get_user(user_id)['balance_minor'] == 0
+
+
+def test_a_referee_is_only_paid_for_once(db, user):
+    referrer, other, referee = user(), user(), user()
+    batcher = db.CreditBatcher(flush_ms=1)
+    assert batcher.submit(referrer, 'referral', 0.8, referrals=1, referee_id=referee)
+    # The same edge again, alone and twice within one flush, and from another referrer
+    assert batcher.submit(referrer, 'referral', 0.8, referrals=1, referee_id=referee)
+    assert batcher.submit_many([(referrer, 'referral', 0.8, 1, None, referee)] * 2)
+    assert batcher.submit(other, 'referral', 0.8, referrals=1, referee_id=referee)
+
+    for user_id, paid in ((referrer, 1), (other, 0)):
+        row = db.get_user(user_id)
+        assert (row['balance_minor'], row['referrals']) == (paid * 800000, paid)
+    conn = db.get_db_connection()
+    assert conn.execute('SELECT COUNT(*) FROM credits WHERE user_id IN (?, ?)', (referrer, other)).fetchone()[0] == 1
+    assert conn.execute('SELECT referrals FROM referral_leaderboard WHERE user_id = ?', (referrer,)).fetchone()[0] == 1
+    assert conn.execute('SELECT COUNT(*) FROM referral_leaderboard WHERE user_id = ?', (other,)).fetchone()[0] == 0
+
+
+def test_async_credits_are_awaited(db, user):
+    user_id = user()
+    batcher = db.CreditBatcher(flush_ms=20)
+
+    async def credit():
+        return await asyncio.gather(*(batcher.submit_many_async([(user_id, 'bonus', 1, 0, None, None)])
+                                      for _ in range(10)))
+
+    assert asyncio.run(credit()) == [True] * 10
+    assert db.get_user(user_id)['balance_minor'] == 10 * db.MINOR_UNITS
@@ -0,0 +1,22 @@
+import csv
+
+from test_payouts import withdrawal
+
+
+def test_in_flight_payouts_are_exported_again_once_settled(db, tmp_path):
+    import export
+    _, settled = withdrawal(db, 1)
+    _, in_flight = withdrawal(db, 2)
+    assert db.claim_transaction(settled, 'pending', 'completed', '0x01')
+
+    files, rows, last_key = export.export_table('transactions', str(tmp_path), after=settled - 1)
+    assert rows == 2
+    # The watermark stops before the payout that is still pending
+    assert last_key == export.read_watermark(str(tmp_path), 'transactions') == settled
+
+    assert db.claim_transaction(in_flight, 'pending', 'completed', '0x02')
+    files, rows, last_key = export.export_table('transactions', str(tmp_path), incremental=True)
+    assert (rows, last_key) == (1, in_flight)
+    with open(tmp_path / files[0], newline='') as f:
+        [row] = csv.DictReader(f)
+    assert (int(row['tx_id']), row['status'], row['tx_hash']) == (in_flight, 'completed', '0x02')
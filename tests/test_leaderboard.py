@@ -0,0 +1,22 @@
+import random
+
+from leaderboard import Leaderboard
+
+
+def test_matches_a_sorted_ranking():
+    rng = random.Random(7)
+    scores = {user_id: rng.randint(0, 5) for user_id in range(50)}
+    board = Leaderboard()
+    board.load(scores.items())
+    for _ in range(1000):
+        user_id, delta = rng.randint(0, 80), rng.choice([1, 1, 2, -1, -3])
+        board.add(user_id, delta)
+        scores[user_id] = max(scores.get(user_id, 0) + delta, 0)
+
+        ranking = sorted((user_id for user_id, score in scores.items() if score > 0),
+                         key=lambda user_id: (-scores[user_id], user_id))
+        assert board.top(5) == [(user_id, scores[user_id]) for user_id in ranking[:5]]
+        assert len(board) == len(ranking)
+        probe = rng.randint(0, 80)
+        expected = (ranking.index(probe) + 1, scores[probe]) if probe in ranking else None
+        assert board.rank(probe) == expected
@@ -0,0 +1,61 @@
+import pytest
+from eth_account import Account
+from web3 import EthereumTesterProvider, Web3
+
+from nonce_manager import NonceManager, is_nonce_error
+
+pytest.importorskip('eth_tester')
+
+
+@pytest.fixture
+def w3():
+    return Web3(EthereumTesterProvider())
+
+
+def test_allocates_distinct_nonces_from_pending_count(w3):
+    sender = w3.eth.accounts[0]
+    w3.eth.send_transaction({'from': sender, 'to': sender, 'value': 0})
+    nonces = NonceManager(w3, sender)
+    assert [nonces.allocate() for _ in range(3)] == [1, 2, 3]
+
+
+def test_released_nonce_is_reused_first(w3):
+    nonces = NonceManager(w3, Account.create().address)
+    assert [nonces.allocate() for _ in range(3)] == [0, 1, 2]
+    nonces.release(1)
+    assert nonces.allocate() == 1
+    assert nonces.allocate() == 3
+
+
+def test_release_at_the_top_is_not_a_gap(w3):
+    nonces = NonceManager(w3, Account.create().address)
+    for _ in range(3):
+        nonces.allocate()
+    nonces.release(2)
+    nonces.release(1)
+    assert nonces.take_gaps() == []
+    assert nonces.allocate() == 1
+
+
+def test_take_gaps_returns_released_nonces_lowest_first(w3):
+    nonces = NonceManager(w3, Account.create().address)
+    for _ in range(5):
+        nonces.allocate()
+    nonces.release(3)
+    nonces.release(0)
+    assert nonces.take_gaps() == [0, 3]
+    assert nonces.take_gaps() == []
+    assert nonces.allocate() == 5
+
+
+def test_stale_nonce_error_resyncs_from_the_node(w3):
+    sender = w3.eth.accounts[0]
+    nonces = NonceManager(w3, sender)
+    assert nonces.allocate() == 0
+    # Another sender used the same account behind our back
+    for _ in range(2):
+        w3.eth.send_transaction({'from': sender, 'to': sender, 'value': 0})
+    assert nonces.handle_error('nonce too low: next nonce 2, tx nonce 1')
+    assert nonces.allocate() == 2
+    assert not nonces.handle_error('insufficient funds for gas')
+    assert is_nonce_error('Replacement transaction underpriced')
@@ -0,0 +1,176 @@
+import asyncio
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import telebot
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from loadtest import FakeBotApi
+from outbox import Outbox, AsyncOutbox, Replies, HIGH
+
+
+class RecordingBotApi(FakeBotApi):
+    """FakeBotApi that records each call and can answer some with a 429."""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []       # (time, method, chat_id, text)
+        self.limited = {}    # chat_id -> 429s still to answer
+        self.unmodified = False
+
+    def handle(self, path, body):
+        method = urlparse(path).path.rsplit('/', 1)[-1]
+        params = {k: v[0] for k, v in parse_qs(urlparse(path).query).items()}
+        params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+        chat_id = int(params.get('chat_id') or 0)
+        with self._lock:
+            if self.limited.get(chat_id):
+                self.limited[chat_id] -= 1
+                return {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                        'parameters': {'retry_after': 1}}
+            if method == 'editMessageText' and self.unmodified:
+                return {'ok': False, 'error_code': 400, 'description': 'Bad Request: message is not modified'}
+            self.sent.append((time.monotonic(), method, chat_id, params.get('text')))
+        return super().handle(path, body)
+
+
+@pytest.fixture
+def bot_api(monkeypatch):
+    api = RecordingBotApi()
+    monkeypatch.setattr(telebot.apihelper, 'API_URL', api.url)
+    monkeypatch.setattr(asyncio_helper, 'API_URL', api.url)
+    yield api
+    api.server.shutdown()
+    api.server.server_close()
+
+
+def outbox(global_rate=1000, chat_rate=1000, chat_burst=1, workers=4):
+    return Outbox(telebot.TeleBot('1:test', threaded=False), global_rate=global_rate, chat_rate=chat_rate,
+                  chat_burst=chat_burst, workers=workers)
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_one_chat_is_sent_at_the_chat_rate(bot_api):
+    box = outbox(chat_rate=5)
+    box.start()
+    for i in range(5):
+        box.send_message(42, f'm{i}')
+    assert wait_for(lambda: len(bot_api.sent) == 5)
+    times = [t for t, *_ in bot_api.sent]
+    assert [text for *_, text in bot_api.sent] == [f'm{i}' for i in range(5)]
+    # 5 per second with no burst: 0.2s apart
+    assert times[-1] - times[0] >= 0.75
+
+
+def test_all_chats_share_the_global_rate(bot_api):
+    box = outbox(global_rate=10)
+    box.start()
+    started = time.monotonic()
+    for chat_id in range(1, 11):
+        box.send_message(chat_id, 'hello')
+    assert wait_for(lambda: len(bot_api.sent) == 10)
+    assert bot_api.sent[-1][0] - started >= 0.85
+
+
+def test_high_priority_goes_first(bot_api):
+    box = outbox(workers=1)
+    for chat_id in range(1, 6):
+        box.send_message(chat_id, 'menu')
+    box.send_message(99, 'payout', priority=HIGH)
+    assert box.stats()['lanes'] == {'high': 1, 'normal': 5, 'bulk': 0}
+    box.start()
+    assert wait_for(lambda: len(bot_api.sent) == 6)
+    assert bot_api.sent[0][2:] == (99, 'payout')
+
+
+def test_queued_edits_of_one_message_are_coalesced(bot_api):
+    box = outbox()
+    for text in ('one', 'two', 'three'):
+        box.edit_message_text(text, 42, 7)
+    box.start()
+    assert wait_for(lambda: box.stats()['sent'] == 1)
+    time.sleep(0.1)
+    assert [(method, text) for _, method, _, text in bot_api.sent] == [('editMessageText', 'three')]
+    assert box.stats()['coalesced'] == 2
+
+
+def test_high_edit_merged_into_a_normal_edit_goes_first(bot_api):
+    box = outbox(workers=1)
+    for chat_id in range(1, 6):
+        box.send_message(chat_id, 'menu')
+    box.edit_message_text('old', 42, 7)
+    box.edit_message_text('new', 42, 7, priority=HIGH)
+    assert box.stats()['lanes'] == {'high': 1, 'normal': 5, 'bulk': 0}
+    box.start()
+    assert wait_for(lambda: len(bot_api.sent) == 6)
+    assert bot_api.sent[0][1:] == ('editMessageText', 42, 'new')
+
+
+def test_unmodified_edit_counts_as_sent(bot_api):
+    bot_api.unmodified = True
+    box = outbox()
+    box.start()
+    box.edit_message_text('same', 42, 7)
+    assert wait_for(lambda: box.stats()['sent'] == 1)
+    assert box.stats()['failed'] == 0
+
+
+def test_429_pauses_the_chat_and_retries(bot_api):
+    bot_api.limited[42] = 1
+    box = outbox()
+    box.start()
+    done = threading.Event()
+    results = []
+    started = time.monotonic()
+    box.send_message(42, 'hello', callback=lambda ok, error: (results.append(ok), done.set()))
+    assert done.wait(10)
+    assert results == [True]
+    assert bot_api.sent[0][0] - started >= 1
+    stats = box.stats()
+    assert (stats['sent'], stats['retried'], stats['failed']) == (1, 1, 0)
+
+
+def test_gives_up_after_max_attempts(bot_api):
+    bot_api.limited[42] = 10
+    box = Outbox(telebot.TeleBot('1:test', threaded=False), global_rate=1000, chat_rate=1000, workers=1,
+                 max_attempts=1)
+    box.start()
+    done = threading.Event()
+    results = []
+    box.send_message(42, 'hello', callback=lambda ok, error: (results.append((ok, error.error_code)), done.set()))
+    assert done.wait(10)
+    assert results == [(False, 429)]
+    assert box.stats()['failed'] == 1
+
+
+def test_awaited_replies_share_the_outbox_limits(bot_api):
+    box = outbox(chat_rate=5)
+    box.start()
+    box.send_message(42, 'queued')
+    replies = Replies()
+    replies.send_message(42, 'awaited')
+    replies.edit_message_text('edited', 42, 7)
+
+    async def deliver():
+        bot = AsyncTeleBot('1:test')
+        try:
+            await AsyncOutbox(bot, box).deliver(replies)
+        finally:
+            await bot.close_session()
+
+    asyncio.run(deliver())
+    assert wait_for(lambda: len(bot_api.sent) == 3)
+    assert [text for *_, text in bot_api.sent] == ['queued', 'awaited', 'edited']
+    times = [t for t, *_ in bot_api.sent]
+    # One chat budget: 5 per second across the outbox's thread and the loop
+    assert times[-1] - times[0] >= 0.35
+    assert box.stats()['sent'] == 3
@@ -0,0 +1,140 @@
+import itertools
+from decimal import Decimal
+
+import pytest
+from eth_account import Account
+
+_user_ids = itertools.count(1000)
+
+
+@pytest.fixture
+def payouts(local_chain):
+    import chain
+    import payouts
+    chain.nonces.sync()
+    return payouts
+
+
+def withdrawal(db, amount=5, dest=None):
+    """A pending payout of `amount` MAT from a new user who had exactly that."""
+    user_id = next(_user_ids)
+    db.add_user(user_id, f'user{user_id}')
+    db.update_balance(user_id, amount)
+    tx_id = db.create_withdrawal(user_id, amount, dest or Account.create().address)
+    return user_id, tx_id
+
+
+def run(payouts, tx_ids):
+    results = []
+    queue = payouts.PayoutQueue(lambda user_id, tx, ok, res: results.append((tx['tx_id'], ok, res)))
+    queue._process(tx_ids)
+    return results
+
+
+def paid(local_chain, dest):
+    return Decimal(local_chain.token.functions.balanceOf(dest).call()) / 10**18
+
+
+def test_single_payout_is_sent_and_completed(db, local_chain, payouts):
+    dest = Account.create().address
+    user_id, tx_id = withdrawal(db, 7, dest)
+    [(_, ok, tx_hash)] = run(payouts, [tx_id])
+    assert ok
+    assert db.get_transaction(tx_id)['status'] == 'completed'
+    assert paid(local_chain, dest) == 7
+    assert db.get_user(user_id)['balance_minor'] == 0
+
+
+def test_rejected_broadcast_refunds_and_frees_the_nonce(db, local_chain, payouts, monkeypatch):
+    import chain
+    user_id, tx_id = withdrawal(db, 3)
+    nonce = chain.nonces.allocate()
+    chain.nonces.release(nonce)
+    # A transaction the node refuses outright can never be mined
+    sign = chain.sign_mat_transfer
+    monkeypatch.setattr(chain, 'sign_mat_transfer', lambda dest, amount, nonce, fees=None: sign(dest, amount, nonce, {'gasPrice': 1}))
+    [(_, ok, error)] = run(payouts, [tx_id])
+    assert not ok
+    assert db.get_transaction(tx_id)['status'] == 'failed'
+    assert db.get_user(user_id)['balance_minor'] == 3 * db.MINOR_UNITS
+    assert chain.nonces.allocate() == nonce
+
+
+def test_timed_out_broadcast_that_landed_is_not_refunded(db, local_chain, payouts):
+    dest = Account.create().address
+    user_id, tx_id = withdrawal(db, 4, dest)
+    # The node takes the transaction, then the response is lost
+    local_chain.fail_next('eth_sendRawTransaction', after=True)
+    [(_, ok, tx_hash)] = run(payouts, [tx_id])
+    assert ok
+    assert db.get_transaction(tx_id)['status'] == 'completed'
+    assert paid(local_chain, dest) == 4
+    assert db.get_user(user_id)['balance_minor'] == 0
+
+
+def test_dropped_payout_is_refunded_only_after_its_nonce_is_cancelled(db, local_chain, payouts):
+    import chain
+    dest = Account.create().address
+    user_id, tx_id = withdrawal(db, 6, dest)
+    local_chain.fail_next('eth_sendRawTransaction')
+    [(_, ok, error)] = run(payouts, [tx_id])
+    assert not ok and error == chain.TX_CANCELLED
+    tx = db.get_transaction(tx_id)
+    assert tx['status'] == 'failed'
+    # The cancel took the payout's nonce, so the signed payout can never land
+    receipt = local_chain.w3.eth.get_transaction_receipt(tx['cancel_hash'])
+    assert local_chain.w3.eth.get_transaction(tx['cancel_hash'])['nonce'] == tx['nonce']
+    assert receipt['status'] == 1
+    assert paid(local_chain, dest) == 0
+    assert db.get_user(user_id)['balance_minor'] == 6 * db.MINOR_UNITS
+
+
+def test_dropped_payout_stays_submitted_if_the_cancel_cannot_be_sent(db, local_chain, payouts, monkeypatch):
+    import chain
+    user_id, tx_id = withdrawal(db, 2)
+    local_chain.fail_next('eth_sendRawTransaction')
+    monkeypatch.setattr(chain, 'send_cancel', lambda nonce, fees=None: (False, 'insufficient funds for gas'))
+    assert run(payouts, [tx_id]) == []
+    assert db.get_transaction(tx_id)['status'] == 'submitted'
+    assert db.get_user(user_id)['balance_minor'] == 0
+
+
+def test_batch_pays_every_row_in_one_transaction(db, local_chain, payouts, monkeypatch):
+    import chain
+    monkeypatch.setattr(chain.config, 'PAYOUT_BATCH_SIZE', 10)
+    assert chain.batching_enabled()
+    dests = [Account.create().address for _ in range(5)]
+    rows = [withdrawal(db, i + 1, dest) for i, dest in enumerate(dests)]
+    bad_user, bad_tx = withdrawal(db, 9, '0xbad')
+    blocks = local_chain.w3.eth.block_number
+
+    results = run(payouts, [tx_id for _, tx_id in rows] + [bad_tx])
+
+    # The bad address is failed alone before signing, so it cannot revert the batch
+    assert (bad_tx, False, "Invalid wallet address") in results
+    assert db.get_user(bad_user)['balance_minor'] == 9 * db.MINOR_UNITS
+    hashes = {db.get_transaction(tx_id)['tx_hash'] for _, tx_id in rows}
+    assert len(hashes) == 1
+    assert all(db.get_transaction(tx_id)['status'] == 'completed' for _, tx_id in rows)
+    assert [paid(local_chain, dest) for dest in dests] == [1, 2, 3, 4, 5]
+    # The one-time approval and the batch itself
+    assert local_chain.w3.eth.block_number - blocks <= 2
+    assert chain.disperse_allowance() == chain.MAX_UINT256
+
+
+def test_reverted_batch_refunds_every_row(db, local_chain, payouts, monkeypatch):
+    import chain
+    monkeypatch.setattr(chain.config, 'PAYOUT_BATCH_SIZE', 10)
+    rows = [withdrawal(db, 1), withdrawal(db, 2)]
+    # Empty the payout wallet so transferFrom reverts
+    token, wallet, other = local_chain.token, local_chain.account.address, local_chain.w3.eth.accounts[0]
+    balance = token.functions.balanceOf(wallet).call()
+    token.functions.transfer(other, balance).transact({'from': wallet})
+    try:
+        results = run(payouts, [tx_id for _, tx_id in rows])
+    finally:
+        token.functions.transfer(wallet, balance).transact({'from': other})
+    assert [ok for _, ok, _ in results] == [False, False]
+    for user_id, tx_id in rows:
+        assert db.get_transaction(tx_id)['status'] == 'failed'
+        assert db.get_user(user_id)['balance_minor'] > 0
@@ -0,0 +1,93 @@
+import pytest
+from eth_account import Account
+
+from test_payouts import withdrawal
+
+
+@pytest.fixture
+def chain(local_chain):
+    import chain
+    chain.nonces.sync()
+    return chain
+
+
+def submitted(db, chain, amount):
+    """A payout a crashed worker signed and recorded but never broadcast."""
+    user_id, tx_id = withdrawal(db, amount)
+    nonce = chain.nonces.allocate()
+    ok, signed = chain.sign_mat_transfer(Account.create().address, amount, nonce)
+    assert ok
+    db.claim_transaction(tx_id, 'pending', 'processing')
+    db.claim_transaction(tx_id, 'processing', 'submitted', chain.w3.to_hex(signed.hash), nonce)
+    return user_id, tx_id
+
+
+def reconciler(results):
+    from reconciler import Reconciler
+    return Reconciler(lambda user_id, tx, ok, res: results.append((tx['tx_id'], ok, res)), min_age=0)
+
+
+def test_dropped_payout_is_refunded_once_its_cancel_is_mined(db, chain, local_chain):
+    user_id, tx_id = submitted(db, chain, 5)
+    results = []
+    used = local_chain.w3.eth.get_transaction_count(chain.PAYOUT_FROM_ADDRESS)
+
+    # First pass: the payout is unknown and its nonce unused, so it is cancelled
+    assert reconciler(results).run_once().get('cancelling')
+    tx = db.get_transaction(tx_id)
+    assert tx['status'] == 'submitted' and tx['cancel_hash']
+    assert db.get_user(user_id)['balance_minor'] == 0
+    # The cancel filled the gap at the payout's nonce
+    assert local_chain.w3.eth.get_transaction_count(chain.PAYOUT_FROM_ADDRESS) == used + 1
+    assert local_chain.w3.eth.get_transaction(tx['cancel_hash'])['nonce'] == tx['nonce']
+
+    # Next pass: the cancel is mined, so the payout can no longer land
+    reconciler(results).run_once()
+    assert (tx_id, False, chain.TX_CANCELLED) in results
+    assert db.get_transaction(tx_id)['status'] == 'failed'
+    assert db.get_user(user_id)['balance_minor'] == 5 * db.MINOR_UNITS
+
+
+def test_dropped_payout_whose_nonce_was_used_is_left_for_review(db, chain, local_chain):
+    user_id, tx_id = submitted(db, chain, 3)
+    # Something else took the nonce, e.g. a replacement the row does not know of
+    ok, res = chain.send_cancel(db.get_transaction(tx_id)['nonce'])
+    assert ok
+    results = []
+    assert reconciler(results).run_once().get('review', 0) >= 1
+    assert [r for r in results if r[0] == tx_id] == []
+    assert db.get_transaction(tx_id)['status'] == 'submitted'
+    assert db.get_user(user_id)['balance_minor'] == 0
+
+
+def test_uncancellable_payout_stays_submitted(db, chain, monkeypatch):
+    user_id, tx_id = submitted(db, chain, 2)
+    monkeypatch.setattr(chain, 'send_cancel', lambda nonce, fees=None: (False, 'insufficient funds for gas'))
+    reconciler([]).run_once()
+    tx = db.get_transaction(tx_id)
+    assert tx['status'] == 'submitted' and tx['cancel_hash'] is None
+    assert db.get_user(user_id)['balance_minor'] == 0
+
+
+def test_payout_mined_under_an_earlier_hash_is_completed(db, chain):
+    user_id, tx_id = withdrawal(db, 4)
+    nonce = chain.nonces.allocate()
+    dest = Account.create().address
+    ok, original = chain.sign_mat_transfer(dest, 4, nonce)
+    assert ok and chain.broadcast(original)[0]
+    original = chain.w3.to_hex(original.hash)
+    db.claim_transaction(tx_id, 'pending', 'processing')
+    db.claim_transaction(tx_id, 'processing', 'submitted', original, nonce)
+    # A fee bump that was never mined, recorded before a restart
+    ok, bumped = chain.sign_mat_transfer(dest, 4, nonce, chain.gas_oracle.bump(chain.gas_oracle.fees()))
+    bumped = chain.w3.to_hex(bumped.hash)
+    db.claim_transaction(tx_id, 'submitted', 'submitted', bumped)
+    tx = db.get_transaction(tx_id)
+    assert tx['tx_hash'] == bumped and db.sent_hashes(tx) == [original, bumped]
+
+    results = []
+    assert reconciler(results).run_once().get('completed')
+    assert (tx_id, True, original) in results
+    tx = db.get_transaction(tx_id)
+    assert (tx['status'], tx['tx_hash']) == ('completed', original)
+    assert db.get_user(user_id)['balance_minor'] == 0
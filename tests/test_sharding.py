@@ -0,0 +1,33 @@
+import queue
+import time
+from types import SimpleNamespace
+
+from sharding import BroadcastChannel, ShardedDispatcher
+
+
+def test_worker_broadcasts_are_sent_by_the_parent(db):
+    from broadcast import Broadcaster
+    sent = []
+    broadcaster = Broadcaster(outbox=None)
+    broadcaster._spawn = sent.append
+    channel = queue.Queue()
+
+    broadcast_id = BroadcastChannel(channel, broadcaster).start('Hello all')
+    # Recorded by the worker, not sent from it
+    assert broadcast_id and sent == []
+    row = db.get_db_connection().execute('SELECT text, status FROM broadcasts WHERE broadcast_id = ?', (broadcast_id,)).fetchone()
+    assert tuple(row) == ('Hello all', 'running')
+    assert channel.get_nowait() == broadcast_id
+
+
+def test_stop_does_not_block_on_a_full_queue():
+    dispatcher = ShardedDispatcher(processes=1, queue_size=1)
+    dispatcher.put({'update_id': 1})
+    time.sleep(0.1)  # The queue's feeder thread hands it over
+    terminated = []
+    dispatcher._workers = [SimpleNamespace(join=lambda timeout: None, is_alive=lambda: True,
+                                           terminate=lambda: terminated.append(True))]
+    started = time.monotonic()
+    dispatcher.stop(timeout=0.1)
+    assert time.monotonic() - started < 1
+    assert terminated == [True]
@@ -0,0 +1,103 @@
+import asyncio
+import http.client
+import json
+import socket
+import threading
+import time
+
+import pytest
+import telebot
+
+from webhook import WebhookServer, update_user_id
+
+SECRET = 'test-secret_1'
+
+# As Telegram delivers it
+START_UPDATE = {
+    'update_id': 10001,
+    'message': {
+        'message_id': 7,
+        'date': 1700000000,
+        'chat': {'id': 42, 'type': 'private', 'first_name': 'Ann'},
+        'from': {'id': 42, 'is_bot': False, 'first_name': 'Ann', 'username': 'ann'},
+        'text': '/start 99',
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+    },
+}
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def served():
+    bot = telebot.TeleBot('1:test', threaded=False)
+    received = []
+
+    @bot.message_handler(commands=['start'])
+    def start(message):
+        received.append((message.from_user.id, message.text))
+
+    server = WebhookServer(bot, host='127.0.0.1', port=_free_port(), path='/telegram', secret=SECRET, workers=2)
+    threading.Thread(target=asyncio.run, args=(server.serve_forever(),), daemon=True).start()
+    deadline = time.monotonic() + 5
+    while server._server is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return server, received
+
+
+def post(server, body, secret=SECRET, path='/telegram', method='POST'):
+    conn = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+    headers = {'Content-Type': 'application/json'}
+    if secret is not None:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+    conn.request(method, path, body=body if isinstance(body, bytes) else json.dumps(body).encode(), headers=headers)
+    status = conn.getresponse().status
+    conn.close()
+    return status
+
+
+def test_recorded_update_reaches_the_handler(served):
+    server, received = served
+    assert post(server, START_UPDATE) == 200
+    deadline = time.monotonic() + 5
+    while not received and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert received == [(42, '/start 99')]
+
+
+@pytest.mark.parametrize('secret', [None, '', 'wrong'])
+def test_requests_without_the_secret_are_refused(served, secret):
+    server, received = served
+    assert post(server, START_UPDATE, secret=secret) == 403
+    time.sleep(0.1)
+    assert received == []
+
+
+def test_bad_requests(served):
+    server, _ = served
+    assert post(server, START_UPDATE, path='/other') == 404
+    assert post(server, START_UPDATE, method='PUT') == 405
+    assert post(server, b'not json') == 400
+    assert post(server, [START_UPDATE]) == 400
+
+
+def test_refuses_to_serve_without_a_secret():
+    with pytest.raises(ValueError):
+        WebhookServer(telebot.TeleBot('1:test'), secret='')
+
+
+def test_full_queue_answers_429():
+    server = WebhookServer(telebot.TeleBot('1:test'), secret=SECRET, workers=1, queue_size=1)
+    # No workers started, so the first update fills the queue
+    assert server.enqueue(START_UPDATE)
+    assert not server.enqueue(START_UPDATE)
+
+
+def test_update_user_id():
+    assert update_user_id(START_UPDATE) == 42
+    assert update_user_id({'update_id': 1, 'callback_query': {'id': '1', 'from': {'id': 5}}}) == 5
+    assert update_user_id({'update_id': 1, 'poll': {'id': '1'}}) is None
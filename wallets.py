@@ -0,0 +1,113 @@
+"""BNB Smart Chain (EVM) wallet address validation and EIP-55 checksumming."""
+import logging
+import re
+import sqlite3
+from functools import lru_cache
+
+import config
+from database import get_db_connection, invalidate_user
+
+try:
+    # safe-pysha3 is several times faster than the eth-hash backends
+    from sha3 import keccak_256
+
+    def _keccak(data):
+        return keccak_256(data).digest()
+except ImportError:
+    from eth_hash.auto import keccak as _keccak
+
+logger = logging.getLogger(__name__)
+
+_ADDRESS_RE = re.compile(r'^(?:0[xX])?([0-9a-fA-F]{40})$')
+_ZERO_ADDRESS = '0x' + '0' * 40
+
+INVALID_FORMAT = "That is not a BNB (BEP-20) address. It should be 0x followed by 40 letters and digits."
+BAD_CHECKSUM = "That address has a typo: its capital letters don't match its checksum. Copy it again from your wallet."
+ZERO_ADDRESS = "That is the zero address, tokens sent there are lost."
+
+
+@lru_cache(maxsize=config.WALLET_CACHE_SIZE)
+def _checksum(lower):
+    """EIP-55 checksum of 40 lowercase hex digits, with the 0x prefix."""
+    digest = _keccak(lower.encode()).hex()
+    return '0x' + ''.join(c.upper() if d >= '8' else c for c, d in zip(lower, digest))
+
+
+def to_checksum(address):
+    """Checksummed form of an address in any case, or None if it isn't one.
+    Like Web3.to_checksum_address, mixed case is not checked."""
+    match = _ADDRESS_RE.match(address.strip())
+    if not match:
+        return None
+    return _checksum(match.group(1).lower())
+
+
+def validate(text):
+    """Check an address typed by a user. Returns (ok:bool,
+    checksummed_address_or_error_str). All-lowercase and all-uppercase
+    addresses carry no checksum and are accepted; mixed case must match it."""
+    match = _ADDRESS_RE.match(text.strip())
+    if not match:
+        return False, INVALID_FORMAT
+    body = match.group(1)
+    checksummed = _checksum(body.lower())
+    if checksummed == _ZERO_ADDRESS:
+        return False, ZERO_ADDRESS
+    if body != body.lower() and body != body.upper() and body != checksummed[2:]:
+        return False, BAD_CHECKSUM
+    return True, checksummed
+
+
+def normalize_all(batch_size=None):
+    """Validate every users.wallet_address and rewrite valid ones in checksum
+    form, one batch of rows per transaction. Invalid addresses are left as they
+    are and logged. Run it before a batch distribution so every payout in a
+    disperse call has a valid recipient. Returns counts plus the user_ids with
+    invalid addresses."""
+    batch_size = batch_size or config.MIGRATION_BATCH_SIZE
+    conn = get_db_connection()
+    counts = {'checked': 0, 'normalized': 0, 'invalid': 0}
+    invalid = []
+    last_user_id = 0
+    while True:
+        rows = conn.execute(
+            'SELECT user_id, wallet_address FROM users WHERE wallet_address IS NOT NULL AND user_id > ? '
+            'ORDER BY user_id LIMIT ?',
+            (last_user_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        last_user_id = rows[-1][0]
+        updates = []
+        for user_id, wallet in rows:
+            counts['checked'] += 1
+            ok, result = validate(wallet)
+            if not ok:
+                invalid.append(user_id)
+                logger.debug(f"User {user_id} has an invalid wallet address {wallet!r}: {result}")
+            elif result != wallet:
+                updates.append((result, user_id))
+        try:
+            conn.executemany('UPDATE users SET wallet_address = ? WHERE user_id = ?', updates)
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            logger.error(f"Error normalizing wallet addresses: {e}")
+            raise
+        for _, user_id in updates:
+            invalidate_user(user_id)
+        counts['normalized'] += len(updates)
+    counts['invalid'] = len(invalid)
+    if invalid:
+        logger.warning(f"{len(invalid)} users have an invalid wallet address, e.g. user_ids {invalid[:20]}")
+    return counts, invalid
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    from database import init_db
+    init_db()
+    counts, invalid = normalize_all()
+    print(counts)
+    if invalid:
+        print('Users with an invalid wallet address:', ' '.join(map(str, invalid)))
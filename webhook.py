@@ -0,0 +1,173 @@
+import asyncio
+import hmac
+import json
+import logging
+import queue
+import threading
+
+from telebot.types import Update
+
+import config
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+MAX_BODY = 1024 * 1024
+
+REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large', 429: 'Too Many Requests'}
+
+
+def update_user_id(update):
+    """The id of the user an update (as decoded JSON) came from, if any."""
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(value.get('from'), dict):
+            return value['from'].get('id')
+    return None
+
+
+class WebhookServer:
+    """Receives Telegram updates over HTTP and feeds them to the bot's handlers.
+
+    The asyncio side only parses the request, checks the secret token and
+    queues the update, so it answers Telegram immediately. Handlers run on
+    WEBHOOK_WORKERS threads. Updates are sharded by user id so each user's
+    updates are handled in order, e.g. a wallet address is never processed
+    before the check_tasks callback that asked for it. When a worker's queue
+    is full the server answers 429 and Telegram redelivers the update later.
+    With a dispatcher (sharding.ShardedDispatcher) updates go to its worker
+    processes instead of threads here."""
+
+    def __init__(self, bot, host=None, port=None, path=None, secret=None, workers=None, queue_size=None,
+                 dispatcher=None):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.host = host or config.WEBHOOK_HOST
+        self.port = port or config.WEBHOOK_PORT or 8443
+        self.path = path or config.WEBHOOK_PATH
+        self.secret = secret if secret is not None else config.WEBHOOK_SECRET
+        if not self.secret:
+            # Without it anyone who can reach the port can post updates as any
+            # user, admins included
+            raise ValueError("WEBHOOK_SECRET must be set to serve a webhook")
+        self.workers = workers or config.WEBHOOK_WORKERS
+        queue_size = queue_size or config.WEBHOOK_QUEUE_SIZE
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(self.workers)]
+        self._threads = []
+        self._server = None
+
+    def start_workers(self):
+        if self.dispatcher is not None:
+            return
+        # Handlers run directly on our worker threads instead of telebot's pool
+        self.bot.threaded = False
+        for i, q in enumerate(self._queues):
+            t = threading.Thread(target=self._worker, args=(q,), name=f"webhook-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def qsize(self):
+        if self.dispatcher is not None:
+            return self.dispatcher.qsize()
+        return sum(q.qsize() for q in self._queues)
+
+    def _worker(self, q):
+        while True:
+            data = q.get()
+            try:
+                self.bot.process_new_updates([Update.de_json(data)])
+            except Exception as e:
+                logger.exception(f"Error handling update {data.get('update_id')}: {e}")
+            finally:
+                q.task_done()
+
+    def enqueue(self, data):
+        """Queue a decoded update. Returns False if its worker is saturated."""
+        if self.dispatcher is not None:
+            return self.dispatcher.enqueue(data)
+        user_id = update_user_id(data)
+        shard = (user_id if user_id is not None else data.get('update_id', 0)) % self.workers
+        try:
+            self._queues[shard].put_nowait(data)
+            return True
+        except queue.Full:
+            return False
+
+    async def start(self):
+        self.start_workers()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Webhook listening on {self.host}:{self.port}{self.path} with {self.workers} workers")
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            # Telegram keeps connections open, so serve requests until it closes
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length') or 0)
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, close=True)
+                    break
+                body = await reader.readexactly(length) if length else b''
+                status = self._dispatch(request_line, headers, body)
+                close = headers.get('connection', '').lower() == 'close'
+                await self._respond(writer, status, close)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _dispatch(self, request_line, headers, body):
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            return 400
+        if target.split('?', 1)[0] != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+        if not hmac.compare_digest(headers.get(SECRET_HEADER, '').encode(), self.secret.encode()):
+            return 403
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400
+        if not isinstance(data, dict):
+            return 400
+        return 200 if self.enqueue(data) else 429
+
+    async def _respond(self, writer, status, close=False):
+        headers = f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\nContent-Length: 0\r\n"
+        if close:
+            headers += "Connection: close\r\n"
+        writer.write((headers + "\r\n").encode('latin-1'))
+        await writer.drain()
+
+
+def run_webhook(bot, dispatcher=None):
+    """Register the webhook with Telegram and serve updates until stopped."""
+    server = WebhookServer(bot, dispatcher=dispatcher)
+    if config.WEBHOOK_URL:
+        # Idempotent, so every replica behind the load balancer can call it
+        bot.set_webhook(
+            url=config.WEBHOOK_URL,
+            secret_token=server.secret,
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        )
+    asyncio.run(server.serve_forever())